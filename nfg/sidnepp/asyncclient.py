@@ -0,0 +1,374 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import ssl
+import time
+import socket
+import asyncore
+from collections import OrderedDict
+from lxml import etree
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from nfg.sidnepp.client import SIDNEppClient, SIDNEppError
+from nfg.sidnepp import tls
+from nfg.sidnepp.templates import TEMPLATES
+from nfg.sidnepp.dispatcher import SIDNEppDispatcher, _SSL_RETRY
+from nfg.sidnepp.state import (
+    STATE_INIT,
+    STATE_CONNECTED,
+    STATE_SESSION,
+    STATE_LOGGEDIN
+)
+
+import logging
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+log.addHandler(ch)
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class SIDNEppFuture(object):
+    """
+    reply to a command that may still be in flight
+
+    Callbacks added with add_callback() are called with the future once
+    the reply arrived or the command failed. result() runs the client's
+    event loop until then.
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        if not self._done:
+            self._client.wait(self, timeout)
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_callback(self, fn):
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class SIDNEppClientChannel(SIDNEppDispatcher):
+    """ non-blocking connection carrying an AsyncSIDNEppClient """
+
+    def __init__(self, client, map):
+        SIDNEppDispatcher.__init__(self, map=map)
+        self.client = client
+        self._handshaking = False
+        self._want_write = False
+
+    def handle_connect(self):
+        if not self.client.ssl:
+            self.client._connected()
+            return
+        client = self.client
+        self.socket = tls.wrap(self.socket, client.host, client.port,
+                               client.ssl, handshake=False)
+        self._handshaking = True
+        self._handshake()
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, why:
+            if why.args[0] not in _SSL_RETRY:
+                raise
+            self._want_write = why.args[0] == ssl.SSL_ERROR_WANT_WRITE
+            return
+        self._handshaking = self._want_write = False
+        tls.remember(self.socket, self.client.host, self.client.port)
+        self.client._connected()
+
+    def writable(self):
+        return SIDNEppDispatcher.writable(self) or self._want_write
+
+    def handle_read(self):
+        if self._handshaking:
+            self._handshake()
+        else:
+            SIDNEppDispatcher.handle_read(self)
+
+    def handle_write(self):
+        if self._handshaking:
+            self._handshake()
+        else:
+            SIDNEppDispatcher.handle_write(self)
+
+    def handle_frame(self, frame):
+        self.client._frame(frame)
+
+    def handle_close(self):
+        self.close()
+        self.client._lost(IOError("connection closed by server"))
+
+    def handle_error(self):
+        why = sys.exc_info()[1]
+        log.debug("channel error: %r" % why)
+        self.close()
+        self.client._lost(why)
+
+
+class AsyncSIDNEppClient(SIDNEppClient):
+    """
+    non-blocking EPP client
+
+    Offers the command methods of SIDNEppClient, but every command
+    returns a SIDNEppFuture instead of the parsed reply. Commands do not
+    wait for each other: any number can be in flight, their replies are
+    matched by clTRID. The connection
+    is driven by an asyncore event loop: pass the `map` of a loop that
+    is already running, or let future.result() run it.
+
+    Connecting, greeting and logging in happen in the background;
+    `ready` is resolved once the session is logged in. Commands issued
+    before that are held back and sent right after the login.
+    """
+
+    def __init__(self, host=None, port=None, username=None, password=None,
+                 ssl=True, map=None):
+        if map is None:
+            map = asyncore.socket_map
+        self._map = map
+        self._pending = OrderedDict()
+        self._backlog = []
+        # futures waiting for a frame that answers no command
+        self._readers = []
+        self._channel = None
+        self.ready = None
+        super(AsyncSIDNEppClient, self).__init__(host, port, username,
+                                                 password, ssl)
+
+    def connect(self):
+        assert(self._state == STATE_INIT)
+        self.ready = SIDNEppFuture(self)
+        self._channel = SIDNEppClientChannel(self, self._map)
+        self._channel.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._channel.connect((self.host, self.port))
+        return self.ready
+
+    def _connected(self):
+        self._state = STATE_CONNECTED
+        self.hello()
+
+    def _greeted(self, future):
+        if future.exception():
+            return
+        self._state = STATE_SESSION
+        self._greeting = etree.tostring(future.result())
+        if self.username and self.password:
+            self.login(self.username, self.password)
+        else:
+            self.ready.set_result(future.result())
+
+    def _logged_in(self, future):
+        if future.exception():
+            return
+        s = future.result()
+        r = self.query(s, "//epp:result")
+        if not r or r[0].get('code') != '1000':
+            msg = r and self.query(r[0], "epp:msg/text()")
+            self.ready.set_exception(SIDNEppError(
+                r and r[0].get('code'), msg and msg[0], s))
+            self.close()
+            return
+        self._state = STATE_LOGGEDIN
+        self._login = self.render(s)
+        backlog, self._backlog = self._backlog, []
+        for message, cltrid, f in backlog:
+            self._send(message, cltrid, f)
+        self.ready.set_result(s)
+
+    def _send(self, message, cltrid=None, future=None):
+        if future is None:
+            future = SIDNEppFuture(self)
+        self._pending[cltrid or object()] = future
+        self._channel.write_frame(message)
+        return future
+
+    def _frame(self, frame):
+        result = self.parse(frame)
+        if result is not None and self._state != STATE_CONNECTED and \
+                not self._readers and \
+                self.query(result, '/epp:epp/epp:greeting'):
+            # the greeting the server sends on connect, unasked
+            return
+        cltrid = result is not None and self.get_cltrid(result)
+        if cltrid in self._pending:
+            future = self._pending.pop(cltrid)
+        elif self._pending:
+            # no (known) clTRID, the reply is for the oldest command
+            future = self._pending.popitem(last=False)[1]
+        elif self._readers:
+            future = self._readers.pop(0)
+        else:
+            log.debug("unexpected frame: %s" % frame)
+            return
+        future.set_result(result)
+
+    def _lost(self, why):
+        self._state = STATE_INIT
+        failed = self._pending.values() + [f for m, c, f in self._backlog]
+        failed += self._readers
+        self._pending.clear()
+        self._backlog = []
+        self._readers = []
+        if not self.ready.done():
+            failed.append(self.ready)
+        for f in failed:
+            f.set_exception(why)
+
+    def wait(self, future, timeout=None):
+        """ run the event loop until the future is resolved """
+        deadline = timeout is not None and time.time() + timeout
+        while not future.done():
+            if deadline:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise CommandTimeout("no reply after %.2fs" % timeout)
+            else:
+                remaining = 1.0
+            if not self._map:
+                raise IOError("no open connections")
+            asyncore.loop(remaining, True, self._map, count=1)
+
+    def write(self, message):
+        message, cltrid = self.prepare(message)
+        if self._state != STATE_LOGGEDIN:
+            future = SIDNEppFuture(self)
+            self._backlog.append((message, cltrid, future))
+            return future
+        return self._send(message, cltrid)
+
+    def read(self):
+        """ a future for the next frame that is not the reply to a
+        command, such as a greeting asked for with a raw hello """
+        future = SIDNEppFuture(self)
+        self._readers.append(future)
+        return future
+
+    def close(self):
+        if self._channel:
+            self._channel.close()
+        self._state = STATE_INIT
+        if self._pending or self._backlog or self._readers:
+            self._lost(IOError("connection closed"))
+
+    def _check_many(self, objtype, names, chunk=None, window=4):
+        """ at most `window` check commands are outstanding; the next
+        chunk goes out as soon as one is answered """
+        result = SIDNEppFuture(self)
+        avail = {}
+        pending = []
+        chunks = self._chunks(names, chunk or self.max_check)
+
+        def send():
+            for c in chunks:
+                future = self.write(self._build_check(objtype, c))
+                pending.append(future)
+                future.add_callback(lambda f, c=c: done(f, c))
+                return True
+            return False
+
+        def done(future, names):
+            if result.done():
+                return
+            try:
+                avail.update(self._parse_check(future.result(), names))
+            except Exception, why:
+                result.set_exception(why)
+                return
+            pending.remove(future)
+            if not send() and not pending:
+                result.set_result(avail)
+
+        for i in range(window):
+            if not send():
+                break
+        if not pending and not result.done():
+            result.set_result(avail)
+        return result
+
+    def _resolved(self, result):
+        future = SIDNEppFuture(self)
+        future.set_result(result)
+        return future
+
+# 6.4 SESSION
+
+    def hello(self):
+        if self._state >= STATE_SESSION and self._greeting:
+            return self._resolved(self.parse(self._greeting))
+
+        assert(self._state == STATE_CONNECTED)
+        e = self.e_epp
+        future = self._send(self.render(e.epp(e.hello()), pretty=False))
+        future.add_callback(self._greeted)
+        return future
+
+    def login(self, login, password, newpassword=None, lang='NL'):
+        if self._state == STATE_LOGGEDIN and self._login:
+            return self._resolved(self.parse(self._login))
+
+        assert(self._state == STATE_SESSION)
+        future = self._send(
+            *self.prepare(self._build_login(login, password, lang)))
+        future.add_callback(self._logged_in)
+        return future
+
+    def logout(self):
+        e = self.e_epp
+        future = self.write(e.epp(e.command(e.logout())))
+        future.add_callback(lambda f: self.close())
+        return future
+
+    def poll(self, ack=None):
+        if ack:
+            return self.write(TEMPLATES['poll_ack'].fill(msgid=ack))
+        return self.write(TEMPLATES['poll_req'].fill())
@@ -0,0 +1,724 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import time
+import socket
+import asyncore
+import heapq
+import itertools
+import threading
+from collections import deque
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.client import SIDNEppClient, SIDNEppError
+from nfg.sidnepp.dispatcher import SIDNEppDispatcher
+from nfg.sidnepp.proxy import SIDNEppLocalHandler
+from nfg.sidnepp.protocol import classify, result_code, HELLO
+from nfg.sidnepp import tls
+from nfg.sidnepp.metrics import SIDNEppMetrics, SIDNEppMetricsServer
+from nfg.sidnepp.ratelimit import SIDNEppRateLimiter, parse_rates
+from nfg.sidnepp.retry import retryable, idempotent, backoff
+from nfg.sidnepp.coalesce import (
+    READS,
+    flight_key,
+    find_cltrid,
+    substitute_cltrid,
+)
+from nfg.sidnepp.scheduler import (
+    SIDNEppFairQueue,
+    parse_weights,
+    parse_priorities,
+)
+from nfg.sidnepp.state import STATE_LOGGEDIN
+from nfg.sidnepp.pool import MAX_SESSIONS
+from nfg.sidnepp.cache import SIDNEppInfoCache, SIDNEppCheckCache, TRANSFORM
+
+import logging
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+log.addHandler(ch)
+
+
+class SIDNEppAsyncUpstream(SIDNEppDispatcher):
+    """
+    logged-in session to the remote EPP service, driven by the proxy's
+    event loop. Carries one command at a time.
+    """
+
+    def __init__(self, proxy, client):
+        self.proxy = proxy
+        self.client = client
+        self.callback = None
+        self.sent = None
+        # when the session last sent anything
+        self.active = time.time()
+        SIDNEppDispatcher.__init__(self, client._fd, proxy._map)
+
+    def forward(self, message, callback):
+        self.callback = callback
+        self.sent = self.active = time.time()
+        self.write_frame(message)
+
+    def handle_frame(self, frame):
+        callback, self.callback = self.callback, None
+        elapsed = time.time() - self.sent
+        self.proxy._release(self)
+        if callback:
+            callback(frame, elapsed)
+
+    def handle_close(self):
+        self.close()
+        self.proxy._lost(self)
+
+
+class SIDNEppAsyncProxyHandler(SIDNEppDispatcher, SIDNEppLocalHandler):
+    """
+    downstream connection. Commands are handled in the order they arrive,
+    the next one is only looked at after the previous one was answered.
+    """
+
+    def __init__(self, server, sock, client_address):
+        SIDNEppDispatcher.__init__(self, sock, server._map)
+        SIDNEppLocalHandler.__init__(self)
+        self.server = server
+        self.client_address = client_address
+        self._pending = deque()
+        self._busy = False
+        self._req = None
+        self._frame = None
+        self._command = None
+        self._t0 = None
+        self._throttled = 0.0
+        log.debug("handle %s" % client_address[0])
+
+    def handle_frame(self, frame):
+        self._pending.append(frame)
+        self._next()
+
+    def _next(self):
+        while self._pending and not self._busy and not self._closing:
+            frame = self._pending.popleft()
+            self._command = command = classify(frame)
+            self._t0 = time.time()
+            if command and command not in self.commands and \
+                    self.server.passthrough and not self.server.caches():
+                self._forward(None, frame)
+                continue
+            req = self.parse(frame)
+            if req is None:
+                self._handle_error(req, '2001', 'Command syntax error')
+                continue
+            self._frame = frame
+            self.dispatch(req)
+            if self.done:
+                self.close_when_done()
+
+    def _handle_command(self, req, description):
+        self._forward(req, self._frame, description)
+
+    def _forward(self, req, frame, description=None):
+        caches = self.server.caches()
+        if caches and description is None:
+            description = self.describe(req)
+        for cache in caches:
+            reply = cache.lookup(req, description)
+            if reply is not None:
+                self.write(reply)
+                return
+        self._busy = True
+        self._req = req
+        self._frame = frame
+        self._description = description
+        self._started = time.time()
+        self._throttled = self.server.forward(frame, self._reply,
+                                              self._command, self.identity())
+
+    def _account(self, message, upstream=0.0):
+        throttled, self._throttled = self._throttled, 0.0
+        self.server.metrics.command(self._command, time.time() - self._t0,
+                                    upstream, result_code(message), throttled)
+
+    def _reply(self, frame, upstream=0.0, started=None):
+        """ the reply to the command forwarded; `started` is when it was
+        asked for upstream, if that was before this command was """
+        self._busy = False
+        if frame is None:
+            req = self._req
+            if req is None:
+                req = self.parse(self._frame)
+            self._handle_error(req)
+        else:
+            caches = self.server.caches()
+            reply = None
+            if caches and self._req is not None:
+                reply = self.parse(frame)
+            if reply is not None:
+                for cache in caches:
+                    cache.update(self._req, reply, self._description,
+                                 started or self._started)
+            self._account(frame, upstream)
+            self.write_frame(frame)
+        self._next()
+
+    def write(self, message):
+        if not isinstance(message, basestring):
+            message = self.render(message)
+        self._account(message)
+        self.write_frame(message)
+
+    def close(self):
+        if self._fileno is not None:
+            self.server._connections -= 1
+        SIDNEppDispatcher.close(self)
+
+
+class SIDNEppAsyncProxy(asyncore.dispatcher):
+    """
+    single threaded EPP proxy
+
+    All downstream connections and upstream sessions are multiplexed on
+    one asyncore event loop, so an idle downstream connection costs a
+    socket and a dispatcher rather than a thread. Forwarded commands
+    queue for the first free upstream session.
+    """
+    handler = SIDNEppAsyncProxyHandler
+    max_connections = 1024
+
+    # SIDNEppInfoCache for info responses, if any
+    cache = None
+
+    # SIDNEppCheckCache for check results, if any
+    checks = None
+
+    # forward commands without parsing them, unless a cache needs to
+    # look inside
+    passthrough = True
+
+    # seconds an idle upstream session may be quiet before it gets a
+    # hello, None for never
+    keepalive = None
+
+    # seconds between attempts to re-open upstream sessions that were
+    # lost, at most
+    reconnect = 5.0
+
+    # SIDNEppRateLimiter for commands to the remote EPP service, if any
+    limiter = None
+
+    # weight per downstream client (clID or address), default 1, and
+    # priority per command class, see SIDNEppFairQueue
+    weights = None
+    priorities = None
+
+    # let identical reads in flight at the same time share one round
+    # trip
+    coalesce = True
+
+    # a frame whose session broke, or that was answered with a
+    # retryable result, is sent again up to `retries` times, with
+    # backoff, as SIDNEppClient.write() does
+    retries = SIDNEppClient.retries
+    backoff_base = SIDNEppClient.backoff_base
+    backoff_cap = SIDNEppClient.backoff_cap
+
+    def __init__(self, (host, port), handler=None, max_connections=None):
+        self._map = {}
+        asyncore.dispatcher.__init__(self, map=self._map)
+        if handler:
+            self.handler = handler
+        if max_connections:
+            self.max_connections = max_connections
+        self._queue = SIDNEppFairQueue()
+        # (due, seq, message, callback, command, client) held back by the
+        # rate limiter
+        self._delayed = []
+        self._seq = itertools.count()
+        # key -> (started, [(callback, clTRID)]) of reads waiting for an
+        # identical one in flight
+        self._flights = {}
+        self._coalesced = 0
+        self._idle = []
+        self._upstream = []
+        self._connections = 0
+        self._reconnects = 0
+        self._sessions = 0
+        self._maintained = time.time()
+        self.metrics = SIDNEppMetrics()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.server_address = self.socket.getsockname()
+
+    def login(self, remote_host, remote_port, username, password,
+              sessions=1, ssl=True, keepalive=None):
+        """setup connections to remote EPP service: `sessions` are
+        logged in up front, in parallel, and kept alive with a hello
+        every `keepalive` seconds
+        """
+        assert(0 < sessions <= MAX_SESSIONS)
+        self._remote = (remote_host, remote_port, username, password, ssl)
+        self._sessions = sessions
+        self._queue = SIDNEppFairQueue(self.weights, self.priorities)
+        if keepalive:
+            self.keepalive = keepalive
+        clients = []
+        failed = []
+
+        def connect():
+            try:
+                clients.append(SIDNEppClient(*self._remote))
+            except Exception, why:
+                failed.append(why)
+
+        workers = [threading.Thread(target=connect) for i in range(sessions)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        if failed:
+            for client in clients:
+                client.logout()
+            raise failed[0]
+        for client in clients:
+            upstream = SIDNEppAsyncUpstream(self, client)
+            self._upstream.append(upstream)
+            self._idle.append(upstream)
+        return upstream.client._login
+
+    def logout(self):
+        """close all connections to remote EPP service
+        """
+        for upstream in self._upstream:
+            upstream.del_channel()
+            upstream.socket.setblocking(1)
+            try:
+                upstream.client.logout()
+            except (socket.error, IOError):
+                pass
+        self._upstream = []
+        self._idle = []
+
+    def caches(self):
+        return [c for c in (self.cache, self.checks) if c is not None]
+
+    def status(self):
+        """ upstream sessions, queue and caches, for the metrics """
+        sessions = {}
+        for upstream in list(self._upstream):
+            state = upstream.client.getState()
+            sessions[state] = sessions.get(state, 0) + 1
+        return dict(
+            sessions=sessions,
+            queue=len(self._queue),
+            reconnects=self._reconnects,
+            connections=self._connections,
+            coalesced=self._coalesced,
+            caches=dict((name, c.stats()) for name, c in (
+                ('info', self.cache), ('check', self.checks)) if c),
+        )
+
+    def ready(self):
+        """ whether at least one upstream session is logged in """
+        return self.status()['sessions'].get(STATE_LOGGEDIN, 0) > 0
+
+    def _open(self):
+        client = SIDNEppClient(*self._remote)
+        return SIDNEppAsyncUpstream(self, client)
+
+    def _release(self, upstream):
+        self._idle.append(upstream)
+        self._dispatch()
+
+    def _reopen(self):
+        """ open a session in place of a lost one, None if that failed """
+        try:
+            upstream = self._open()
+        except (socket.error, IOError, SIDNEppError):
+            log.exception("re-connect failed")
+            return None
+        self._upstream.append(upstream)
+        self._release(upstream)
+        return upstream
+
+    def _lost(self, upstream):
+        if upstream not in self._upstream:
+            # closed before
+            return
+        log.debug("lost upstream session %r" % upstream)
+        self._reconnects += 1
+        self._upstream.remove(upstream)
+        if upstream in self._idle:
+            self._idle.remove(upstream)
+        callback, upstream.callback = upstream.callback, None
+        # re-opening blocks the loop, but only once per lost session
+        self._reopen()
+        if callback:
+            # sent again on the new session, if there is one
+            callback(None)
+        if not self._upstream:
+            while len(self._queue):
+                self._queue.pop()[1](None)
+            while self._delayed:
+                heapq.heappop(self._delayed)[3](None)
+
+    def _maintain(self):
+        """ hello on idle sessions that have been quiet for `keepalive`
+        seconds, if set, and re-open sessions that could not be
+        re-opened when they were lost """
+        now = time.time()
+        for upstream in list(self._idle):
+            if self.keepalive and now - upstream.active >= self.keepalive:
+                self._idle.remove(upstream)
+                upstream.forward(HELLO, None)
+        if len(self._upstream) < self._sessions:
+            self._reopen()
+
+    def _dispatch(self):
+        while len(self._queue) and self._idle:
+            message, callback = self._queue.pop()
+            self._idle.pop().forward(message, callback)
+
+    def forward(self, message, callback, command=None, client=None):
+        """ queue a frame for the remote EPP service; callback is called
+        with the reply frame, or None if the session was lost, and the
+        seconds spent upstream. A read that shares the reply to an
+        identical one gets when that one was started as well. Frames
+        take turns by the priority of their command and the weight of
+        the downstream client they came from, see SIDNEppFairQueue.
+        Returns the seconds the frame is held back by the rate limiter.
+        """
+        if not self._upstream:
+            callback(None)
+            return 0.0
+        if self.coalesce and command in READS:
+            key = flight_key(message, command)
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._coalesced += 1
+                flight[1].append((callback, find_cltrid(message)))
+                return 0.0
+            flight = self._flights[key] = (time.time(), [])
+            callback = self._landing(key, flight, callback)
+        elif command in TRANSFORM:
+            callback = self._changed(callback)
+        callback = self._retrying(message, callback, command, client)
+        delay = self.limiter and self.limiter.delay(command) or 0.0
+        if delay > 0:
+            heapq.heappush(self._delayed, (time.time() + delay,
+                                           next(self._seq), message,
+                                           callback, command, client))
+            return delay
+        self._queue.push(client, (message, callback), command)
+        self._dispatch()
+        return 0.0
+
+    def _retrying(self, message, callback, command, client):
+        """ callback that sends `message` again, after a backoff, when
+        its session broke or the reply has a retryable result code """
+        attempts = [0]
+        safe = idempotent(message)
+
+        def reply(frame, upstream=0.0):
+            if (frame is None or retryable(result_code(frame), safe)) and \
+                    attempts[0] < self.retries and self._upstream:
+                wait = backoff(attempts[0], self.backoff_base,
+                               self.backoff_cap)
+                log.debug("no answer to %s, retry in %.2fs" % (command,
+                                                                wait))
+                attempts[0] += 1
+                heapq.heappush(self._delayed, (time.time() + wait,
+                                               next(self._seq), message,
+                                               reply, command, client))
+                return
+            callback(frame, upstream)
+        return reply
+
+    def _landing(self, key, flight, callback):
+        """ callback for a read that others may be waiting on: they get
+        the same reply, with their own clTRID """
+        def land(frame, upstream=0.0):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            callback(frame, upstream)
+            started, waiters = flight
+            for waiter, cltrid in waiters:
+                if frame is None:
+                    waiter(None)
+                else:
+                    waiter(substitute_cltrid(frame, cltrid), 0.0, started)
+        return land
+
+    def _changed(self, callback):
+        """ callback for a command that changes an object: reads in
+        flight may have started before the change, so reads that come
+        after it must not share their replies """
+        def changed(frame, upstream=0.0):
+            self._flights.clear()
+            callback(frame, upstream)
+        return changed
+
+    def _due(self):
+        """ queue the held back frames whose time has come; returns the
+        seconds until the next one, or None """
+        now = time.time()
+        while self._delayed and self._delayed[0][0] <= now:
+            due, seq, message, callback, command, client = \
+                heapq.heappop(self._delayed)
+            self._queue.push(client, (message, callback), command)
+        self._dispatch()
+        return self._delayed and self._delayed[0][0] - now or None
+
+    def readable(self):
+        # stop accepting when full, new connections wait in the backlog
+        return self._connections < self.max_connections
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, addr = pair
+        self._connections += 1
+        self.handler(self, sock, addr)
+
+    def serve_forever(self, timeout=1.0):
+        self._serving = True
+        while self._serving and self._map:
+            wait = timeout
+            if self._delayed:
+                wait = min(timeout, self._due() or timeout)
+            asyncore.loop(wait, True, self._map, count=1)
+            interval = self.reconnect
+            if self.keepalive:
+                interval = min(interval, self.keepalive / 4.0)
+            if time.time() - self._maintained >= interval:
+                self._maintained = time.time()
+                self._maintain()
+
+    def shutdown(self):
+        """ stop serve_forever() within `timeout` seconds """
+        self._serving = False
+
+    def server_close(self):
+        self.logout()
+        for channel in self._map.values():
+            channel.close()
+
+
+def usage():
+    print """
+
+asynchronous EPP Proxy server for SIDN
+
+usage:
+
+asyncproxy.py <options>
+
+options:
+
+    parameters for connecting to remote EPP service:
+
+  -s <addr> --server=<epp server>           default: testdrs.domain-registry.nl
+  -p <port> --port=<epp server>             default: 700
+  -u <username> --username=<epp username>
+  -w <password> --password=<epp password>
+  -n <sessions> --sessions=<sessions>       default: 1
+  -A --keepalive=<seconds>                  hello on sessions that have
+                                            been idle this long, default:
+                                            0 (off)
+  --cafile=<file>                           verify the EPP server against
+                                            these CA certificates
+  --certfile=<file>                         client certificate
+  --keyfile=<file>                          key of the client certificate,
+                                            if not in --certfile
+
+    parameters for setting up local proxy service:
+
+  -a --address=<listen to address>          default: localhost
+  -l --listen=<listen to port>              default: 7000
+  -c --connections=<connections>            default: %d
+  -t --info-ttl=<seconds>                   cache info responses,
+                                            default: 0 (off)
+  -k --check-ttl=<seconds>                  cache "available" check
+                                            results, default: 0 (off)
+  -K --taken-ttl=<seconds>                  cache "taken" check results,
+                                            default: 0 (off)
+  -x --parse                                parse every forwarded command,
+                                            instead of passing it through
+  -r --rate=<class>:<per second>[,...]      commands per second upstream,
+                                            per class: check, info,
+                                            transform or poll. default:
+                                            no limit
+  -W --weight=<client>:<weight>[,...]       share of the upstream per
+                                            downstream clID or address,
+                                            default: 1 each
+  -P --priority=<class>:<level>[,...]       priority per command class,
+                                            lower goes first. default:
+                                            transform:0,info:1,check:1,
+                                            poll:1
+  --no-coalesce                             send every check and info
+                                            upstream, also while an
+                                            identical one is in flight
+  -M --metrics=<port>                       serve /metrics and /ready over
+                                            HTTP on this port, default: off
+
+  """ % SIDNEppAsyncProxy.max_connections
+
+if __name__ == '__main__':
+    import getopt
+
+    server = 'testdrs.domain-registry.nl'
+    port = 700
+    username = False
+    password = False
+    sessions = 1
+    keepalive = None
+    cafile = certfile = keyfile = None
+
+    address = '127.0.0.1'
+    listen = 7000
+    connections = None
+    infottl = 0
+    checkttl = takenttl = 0
+    passthrough = True
+    metrics = None
+    rates = None
+    weights = priorities = None
+    coalesce = True
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], "s:p:u:w:n:A:a:l:c:t:k:K:xr:W:P:M:", [
+            'server=',
+            'port=',
+            'username=',
+            'password=',
+            'sessions=',
+            'keepalive=',
+            'cafile=',
+            'certfile=',
+            'keyfile=',
+            'address=',
+            'listen=',
+            'connections=',
+            'info-ttl=',
+            'check-ttl=',
+            'taken-ttl=',
+            'parse',
+            'rate=',
+            'weight=',
+            'priority=',
+            'no-coalesce',
+            'metrics='])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in optlist:
+        if o in ('-s', '--server'):
+            server = a
+        elif o in ('-p', '--port'):
+            port = int(a)
+        elif o in ('-u', '--username'):
+            username = a
+        elif o in ('-w', '--password'):
+            password = a
+        elif o in ('-n', '--sessions'):
+            sessions = int(a)
+        elif o in ('-A', '--keepalive'):
+            keepalive = float(a) or None
+        elif o == '--cafile':
+            cafile = a
+        elif o == '--certfile':
+            certfile = a
+        elif o == '--keyfile':
+            keyfile = a
+        elif o in ('-a', '--address'):
+            address = a
+        elif o in ('-l', '--listen'):
+            listen = int(a)
+        elif o in ('-c', '--connections'):
+            connections = int(a)
+        elif o in ('-t', '--info-ttl'):
+            infottl = int(a)
+        elif o in ('-k', '--check-ttl'):
+            checkttl = int(a)
+        elif o in ('-K', '--taken-ttl'):
+            takenttl = int(a)
+        elif o in ('-x', '--parse'):
+            passthrough = False
+        elif o in ('-r', '--rate'):
+            try:
+                rates = parse_rates(a)
+            except ValueError, err:
+                print str(err)
+                usage()
+                sys.exit(2)
+        elif o in ('-W', '--weight'):
+            try:
+                weights = parse_weights(a)
+            except ValueError, err:
+                print str(err)
+                usage()
+                sys.exit(2)
+        elif o in ('-P', '--priority'):
+            try:
+                priorities = parse_priorities(a)
+            except ValueError, err:
+                print str(err)
+                usage()
+                sys.exit(2)
+        elif o == '--no-coalesce':
+            coalesce = False
+        elif o in ('-M', '--metrics'):
+            metrics = int(a)
+
+    if not (username and password):
+        usage()
+        sys.exit(2)
+
+    print "Starting SIDNEppAsyncProxy"
+    proxy = SIDNEppAsyncProxy((address, listen), max_connections=connections)
+    if infottl:
+        proxy.cache = SIDNEppInfoCache(ttl=infottl)
+    if checkttl or takenttl:
+        proxy.checks = SIDNEppCheckCache(avail_ttl=checkttl,
+                                         taken_ttl=takenttl)
+    proxy.passthrough = passthrough
+    if rates:
+        proxy.limiter = SIDNEppRateLimiter(rates)
+    proxy.weights = weights
+    proxy.priorities = priorities
+    proxy.coalesce = coalesce
+    if metrics:
+        SIDNEppMetricsServer((address, metrics), proxy).start()
+        print "Metrics on: %s:%d" % (address, metrics)
+    proxy.login(server, port, username, password, sessions,
+                ssl=tls.context(cafile, certfile, keyfile),
+                keepalive=keepalive)
+    print "Connected to: %s:%d" % (server, port)
+    print "Listen on: %s:%d" % (address, listen)
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    proxy.server_close()
+    print "parent done"
+    sys.exit(0)
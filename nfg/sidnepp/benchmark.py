@@ -0,0 +1,750 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import gc
+import time
+import json
+import socket
+import struct
+import threading
+from contextlib import contextmanager
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.framing import SIDNEppFrameReader, BUFSIZE, frame, nodelay
+from nfg.sidnepp.protocol import SIDNEppProtocol, classify
+from nfg.sidnepp.client import SIDNEppClient
+from nfg.sidnepp.proxy import SIDNEppProxyHandler
+from nfg.sidnepp.cache import SIDNEppInfoCache
+from nfg.sidnepp.metrics import SIDNEppMetrics
+from nfg.sidnepp.coalesce import SIDNEppSingleFlight
+from nfg.sidnepp.state import STATE_LOGGEDIN
+from nfg.sidnepp.whois import SIDNWhois, SIDNWhoisResult, NAMESPACES
+import lxml.etree as et
+
+# layout of the stored results
+VERSION = 1
+
+CHECK = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<epp xmlns="urn:ietf:params:xml:ns:epp-1.0">
+  <command>
+    <check>
+      <domain:check xmlns:domain="urn:ietf:params:xml:ns:domain-1.0">
+        <domain:name>doris.nl</domain:name>
+        <domain:name>dyris.nl</domain:name>
+      </domain:check>
+    </check>
+    <clTRID>ABC-12345</clTRID>
+  </command>
+</epp>"""
+
+CHECK_RESPONSE = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<epp xmlns="urn:ietf:params:xml:ns:epp-1.0">
+  <response>
+    <result code="1000">
+      <msg>The availability of the domain names has been checked.</msg>
+    </result>
+    <resData>
+      <domain:chkData xmlns:domain="urn:ietf:params:xml:ns:domain-1.0">
+        <domain:cd>
+          <domain:name avail="false">doris.nl</domain:name>
+        </domain:cd>
+        <domain:cd>
+          <domain:name avail="true">dyris.nl</domain:name>
+        </domain:cd>
+      </domain:chkData>
+    </resData>
+    <trID>
+      <clTRID>ABC-12345</clTRID>
+      <svTRID>AB75F31C-0111-DF51-A78D-7E7747FE632B</svTRID>
+    </trID>
+  </response>
+</epp>"""
+
+INFO = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<epp xmlns="urn:ietf:params:xml:ns:epp-1.0">
+  <command>
+    <info>
+      <domain:info xmlns:domain="urn:ietf:params:xml:ns:domain-1.0">
+        <domain:name hosts="all">doris.nl</domain:name>
+      </domain:info>
+    </info>
+    <clTRID>ABC-12345</clTRID>
+  </command>
+</epp>"""
+
+# from the examples in docs/
+INFO_RESPONSE = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<epp xmlns="urn:ietf:params:xml:ns:epp-1.0">
+  <response>
+    <result code="1000">
+      <msg>The domain name has been queried.</msg>
+    </result>
+    <resData>
+      <domain:infData xmlns:domain="urn:ietf:params:xml:ns:domain-1.0">
+        <domain:name>doris.nl</domain:name>
+        <domain:roid>DNM_700-SIDN</domain:roid>
+        <domain:status s="ok"/>
+        <domain:registrant>TES000079-SL1SL</domain:registrant>
+        <domain:contact type="admin">TES000079-SO1SO</domain:contact>
+        <domain:contact type="tech">TES000079-SL1SL</domain:contact>
+        <domain:ns>
+          <domain:hostObj>ns1.doris.nl</domain:hostObj>
+        </domain:ns>
+        <domain:host>ns2.doris.nl</domain:host>
+        <domain:host>ns3.doris.nl</domain:host>
+        <domain:host>ns1.doris.nl</domain:host>
+        <domain:clID>SIDN0</domain:clID>
+        <domain:crID>SIDN0</domain:crID>
+        <domain:crDate>2009-08-10T00:00:00.000Z</domain:crDate>
+        <domain:upID>SIDN0</domain:upID>
+        <domain:upDate>2009-08-10T00:00:00.000Z</domain:upDate>
+      </domain:infData>
+    </resData>
+    <extension>
+      <sidn-ext-epp:ext
+        xmlns:sidn-ext-epp="http://rxsd.domain-registry.nl/sidn-ext-epp-1.0">
+        <sidn-ext-epp:infData>
+          <sidn-ext-epp:domain>
+            <sidn-ext-epp:optOut>false</sidn-ext-epp:optOut>
+            <sidn-ext-epp:limited>false</sidn-ext-epp:limited>
+          </sidn-ext-epp:domain>
+        </sidn-ext-epp:infData>
+      </sidn-ext-epp:ext>
+    </extension>
+    <trID>
+      <clTRID>ABC-12345</clTRID>
+      <svTRID>9F2ABEDA-3236-B7CB-AA92-F405CEF89E2F</svTRID>
+    </trID>
+  </response>
+</epp>"""
+
+HELLO = '<epp xmlns="urn:ietf:params:xml:ns:epp-1.0"><hello/></epp>'
+
+WHOIS_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<whois-response xmlns="http://rxsd.domain-registry.nl/sidn-whois-drs50">
+  <domain>
+    <name>nfg.nl</name>
+    <status><code>active</code><explain>in use</explain></status>
+    <date-registered>1999-05-26</date-registered>
+    <date-last-change>2012-09-14</date-last-change>
+  </domain>
+  <registrar>
+    <handle>NFG001</handle>
+    <name>NFG Net Facilities Group BV</name>
+    <street>Maagdenburgstraat 7</street>
+    <postal-code>7421ZA</postal-code>
+    <city>Deventer</city>
+    <country>NL</country>
+  </registrar>
+  <contact role="admin">
+    <handle>STE002126-NFGNT</handle>
+    <name>Paul Stevens</name>
+    <email>paul@nfg.nl</email>
+  </contact>
+  <contact role="tech">
+    <handle>NFG001-NFGNT</handle>
+    <name>NFG Hostmaster</name>
+    <email>hostmaster@nfg.nl</email>
+  </contact>
+  <nameserver><name>ns1.nfgs.net</name></nameserver>
+  <nameserver><name>ns2.nfgs.net</name></nameserver>
+  <nameserver><name>ns3.nfgs.net</name></nameserver>
+</whois-response>"""
+
+DOMAIN = dict(
+    ns=['ns1.nfg.nl', 'ns2.nfg.nl'],
+    owner='STE002126-NFGNT',
+    admin='STE002126-NFGNT',
+    tech='STE002126-NFGNT',
+)
+
+CONTACT = dict(
+    name='Jan Janssen',
+    org='NFG Net Facilities Group BV',
+    street=['Wolvenplein 16'],
+    city='Utrecht',
+    pc='3512CK',
+    cc='NL',
+    voice='+31.0858779997',
+    fax='+31.0858779996',
+    email='info@nfg.nl',
+    legalForm='BV',
+    legalFormRegNo='14633770',
+)
+
+# (name, setup) in the order they run; setup returns the callable that
+# is timed
+BENCHMARKS = []
+# (name, setup) where setup returns a factory of the objects whose size
+# is measured
+FOOTPRINTS = []
+
+
+def benchmark(name):
+    """ register a setup function under `name` """
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+def footprint(name):
+    """ register a setup function under `name`, for retained() """
+    def register(setup):
+        FOOTPRINTS.append((name, setup))
+        return setup
+    return register
+
+
+def measure(fn, mintime=0.2, repeat=3):
+    """ seconds per call of fn: the loop count is raised until a loop
+    takes at least `mintime`, and the best of `repeat` loops is kept """
+    number = 1
+    while 1:
+        start = time.time()
+        for i in xrange(number):
+            fn()
+        best = time.time() - start
+        if best >= mintime:
+            break
+        number *= 10
+    for r in range(repeat - 1):
+        start = time.time()
+        for i in xrange(number):
+            fn()
+        best = min(best, time.time() - start)
+    return best / number
+
+
+def _rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def retained(factory, count=2000):
+    """ bytes per object kept alive by `count` objects from factory, from
+    the growth of the resident set; None where that can't be read """
+    try:
+        _rss()
+    except (IOError, OSError, ValueError):
+        return None
+    gc.collect()
+    before = _rss()
+    kept = [factory() for i in xrange(count)]
+    gc.collect()
+    size = max(0, _rss() - before) / float(count)
+    del kept
+    return size
+
+
+# building commands
+
+class _Builder(SIDNEppClient):
+    """ client that returns the command it would have sent """
+
+    _state = STATE_LOGGEDIN
+
+    def __init__(self):
+        SIDNEppProtocol.__init__(self)
+
+    def write(self, message):
+        return self.prepare(message)[0]
+
+BUILDS = (
+    ('domain_check', ('doris.nl',)),
+    ('domain_info', ('doris.nl',)),
+    ('domain_create', ('doris.nl', DOMAIN)),
+    ('domain_update', ('doris.nl', {
+        'add': {'ns': ['ns3.nfg.nl'], 'tech': 'STE002126-NFGNT'},
+        'rem': {'ns': ['ns1.nfg.nl']},
+        'chg': {'owner': 'STE002126-NFGNT'}})),
+    ('domain_delete', ('doris.nl',)),
+    ('domain_cancel_delete', ('doris.nl',)),
+    ('domain_transfer', ('doris.nl', 'request', '4LMPTS01TFGN')),
+    ('contact_check', ('STE002126-NFGNT',)),
+    ('contact_info', ('STE002126-NFGNT',)),
+    ('contact_create', ('STE002126-NFGNT', CONTACT)),
+    ('contact_update', ('STE002126-NFGNT', CONTACT)),
+    ('contact_delete', ('STE002126-NFGNT',)),
+    ('host_check', ('ns1.nfg.nl',)),
+    ('host_info', ('ns1.nfg.nl',)),
+    ('host_create', ('ns1.nfg.nl', ['192.0.2.1', '192.0.2.2'])),
+    ('host_update', ('ns1.nfg.nl', {'add': ['192.0.2.3'],
+                                    'rem': ['192.0.2.1']})),
+    ('host_delete', ('ns1.nfg.nl',)),
+    ('poll', ()),
+)
+
+
+def _build(method, args):
+    def setup():
+        fn = getattr(_Builder(), method)
+        return lambda: fn(*args)
+    return setup
+
+for _method, _args in BUILDS:
+    benchmark('build.%s' % _method)(_build(_method, _args))
+
+
+def legacy_build(command, name):
+    """ a command the way SIDNEppClient built it before templates """
+    p = SIDNEppProtocol()
+    e = p.e_epp
+    d = p.e_domain
+    if command == 'domain_check':
+        x = e.epp(e.command(e.check(d.check(d.name(name)))))
+    elif command == 'domain_info':
+        x = e.epp(e.command(e.info(d.info(d.name(name, hosts='all')))))
+    elif command == 'domain_delete':
+        x = e.epp(e.command(e.delete(d.delete(d.name(name)))))
+    else:
+        x = e.epp(e.command(e.poll(op='req')))
+    p.set_cltrid(x)
+    return p.render(x)
+
+for _command in ('domain_check', 'domain_info', 'domain_delete', 'poll'):
+    benchmark('legacy.build.%s' % _command)(
+        lambda command=_command: lambda: legacy_build(command, 'doris.nl'))
+
+
+# parsing, rendering and querying
+
+@benchmark('protocol.parse.check')
+def parse_check():
+    p = SIDNEppProtocol()
+    return lambda: p.parse(CHECK_RESPONSE)
+
+
+@benchmark('protocol.parse.info')
+def parse_info():
+    p = SIDNEppProtocol()
+    return lambda: p.parse(INFO_RESPONSE)
+
+
+@benchmark('protocol.render.info')
+def render_info():
+    p = SIDNEppProtocol()
+    x = p.parse(INFO_RESPONSE)
+    return lambda: p.render(x)
+
+
+@benchmark('protocol.render.info.compact')
+def render_info_compact():
+    p = SIDNEppProtocol()
+    x = p.parse(INFO_RESPONSE)
+    return lambda: p.render(x, pretty=False)
+
+
+@benchmark('protocol.query.result')
+def query_result():
+    p = SIDNEppProtocol()
+    x = p.parse(INFO_RESPONSE)
+    return lambda: p.query(x, "/epp:epp/epp:response/epp:result/@code")
+
+
+@benchmark('protocol.query.cltrid')
+def query_cltrid():
+    p = SIDNEppProtocol()
+    x = p.parse(INFO_RESPONSE)
+    return lambda: p.get_cltrid(x)
+
+
+@benchmark('protocol.describe')
+def describe():
+    p = SIDNEppProtocol()
+    x = p.parse(INFO)
+    return lambda: p.describe(x)
+
+
+@benchmark('protocol.classify')
+def classify_info():
+    return lambda: classify(INFO)
+
+
+# framing
+
+def _feed(data):
+    """ the reading end of a socket pair that a thread keeps writing
+    `data` into, so reads time the socket and not a stand-in """
+    a, b = socket.socketpair()
+    # whole frames per write, so every read starts on a frame
+    block = data * max(1, BUFSIZE // len(data))
+
+    def produce():
+        try:
+            while 1:
+                a.sendall(block)
+        except socket.error:
+            # the reading end was dropped with the benchmark
+            a.close()
+
+    t = threading.Thread(target=produce)
+    t.daemon = True
+    t.start()
+    return b
+
+
+def legacy_read(sock):
+    """ a frame read the way it was before the framing module """
+    def readall(size):
+        got = ""
+        while size > 0:
+            buf = sock.recv(size)
+            if not buf:
+                raise IOError("connection closed by peer")
+            got += buf
+            size -= len(buf)
+        return got
+    size = struct.unpack(">L", readall(4))[0]
+    return readall(size - 4)
+
+
+def legacy_write(sock, message):
+    """ a frame written the way it was before the framing module """
+    sock.sendall(struct.pack(">L", len(message) + 4))
+    sock.sendall(message)
+
+
+def _readall(sock):
+    """ a frame read with SIDNEppProtocol.readall() """
+    p = SIDNEppProtocol()
+    return lambda: p.readall(sock, struct.unpack(">L", p.readall(sock, 4))[0]
+                             - 4)
+
+FRAMES = (
+    ('small', frame(CHECK_RESPONSE)),
+    ('large', frame('<epp>%s</epp>' % ('x' * (1 << 20)))),
+)
+
+for _size, _data in FRAMES:
+    benchmark('framing.reader.%s' % _size)(
+        lambda data=_data: SIDNEppFrameReader(_feed(data)).read)
+    benchmark('framing.readall.%s' % _size)(
+        lambda data=_data: _readall(_feed(data)))
+    benchmark('legacy.read.%s' % _size)(
+        lambda data=_data: lambda sock=_feed(data): legacy_read(sock))
+
+
+@benchmark('framing.frame')
+def frame_check():
+    return lambda: frame(CHECK)
+
+
+def _pair():
+    """ connected TCP sockets on the loopback interface """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    a = socket.create_connection(listener.getsockname())
+    b = listener.accept()[0]
+    listener.close()
+    return a, b
+
+
+@benchmark('framing.roundtrip')
+def roundtrip():
+    """ a command and its reply over loopback TCP """
+    a, b = _pair()
+    nodelay(a)
+    nodelay(b)
+    ra = SIDNEppFrameReader(a)
+    rb = SIDNEppFrameReader(b)
+
+    def exchange():
+        a.sendall(frame(CHECK))
+        rb.read()
+        b.sendall(frame(CHECK_RESPONSE))
+        ra.read()
+    return exchange
+
+
+@benchmark('legacy.roundtrip')
+def legacy_roundtrip():
+    """ framing.roundtrip with the header and body written apart, and
+    Nagle left on """
+    a, b = _pair()
+
+    def exchange():
+        legacy_write(a, CHECK)
+        legacy_read(b)
+        legacy_write(b, CHECK_RESPONSE)
+        legacy_read(a)
+    return exchange
+
+
+# handling of one message by the proxy, with the upstream session and
+# the downstream socket stubbed out
+
+class _Session(object):
+
+    def forward(self, message):
+        return CHECK_RESPONSE
+
+    def write(self, message):
+        return SIDNEppProtocol().parse(INFO_RESPONSE)
+
+
+class _Pool(object):
+
+    @contextmanager
+    def session(self, timeout=None):
+        yield _Session()
+
+
+class _Server(object):
+
+    def __init__(self, passthrough=True, cache=None):
+        self.passthrough = passthrough
+        self.cache = cache
+        self.pool = _Pool()
+        self.metrics = SIDNEppMetrics()
+        self.limiter = None
+        self.scheduler = None
+        self.coalesce = True
+        self.flights = SIDNEppSingleFlight()
+
+    def caches(self):
+        return [c for c in (self.cache,) if c is not None]
+
+
+class _Sink(object):
+
+    def sendall(self, data):
+        pass
+
+
+class _Handler(SIDNEppProxyHandler):
+
+    def __init__(self, server):
+        SIDNEppProtocol.__init__(self)
+        self.server = server
+        self.request = _Sink()
+
+
+def _handle(message, **options):
+    def setup():
+        h = _Handler(_Server(**options))
+
+        def handle():
+            h._upstream = 0.0
+            h._code = None
+            command = classify(message)
+            h._handle(message, command)
+            h.server.metrics.command(command, 0.0, h._upstream, h._code)
+        return handle
+    return setup
+
+benchmark('proxy.handle.passthrough')(_handle(CHECK))
+benchmark('proxy.handle.parsed')(_handle(CHECK, passthrough=False))
+benchmark('proxy.handle.hello')(_handle(HELLO))
+
+
+@benchmark('proxy.handle.cached')
+def handle_cached():
+    p = SIDNEppProtocol()
+    cache = SIDNEppInfoCache()
+    cache.update(p.parse(INFO), p.parse(INFO_RESPONSE))
+    return _handle(INFO, cache=cache)()
+
+
+# whois results: querying the tree as it was done, against extracting
+# once with compiled queries
+
+# what callers look up
+WHOIS_QUERIES = (
+    '/whois-response/domain/name',
+    '/whois-response/domain/status/code',
+    '/whois-response/registrar',
+    '/whois-response/contact',
+    '/whois-response/nameserver',
+)
+
+
+@benchmark('whois.parse')
+def whois_parse():
+    return lambda: et.fromstring(WHOIS_RESPONSE)
+
+
+@benchmark('legacy.whois.query')
+def legacy_whois_query():
+    """ the queries the way SIDNWhois.xpath() ran them before: rewritten
+    and compiled on every call """
+    tree = et.fromstring(WHOIS_RESPONSE)
+
+    def query():
+        for q in WHOIS_QUERIES:
+            tree.xpath(q.replace("/", "/w:"), namespaces=NAMESPACES)
+    return query
+
+
+@benchmark('whois.query')
+def whois_query():
+    whois = SIDNWhois('nfg.nl', response=WHOIS_RESPONSE)
+
+    def query():
+        for q in WHOIS_QUERIES:
+            whois.xpath(q)
+    return query
+
+
+@benchmark('whois.extract')
+def whois_extract():
+    tree = et.fromstring(WHOIS_RESPONSE)
+    return lambda: SIDNWhoisResult.extract(tree)
+
+
+@footprint('whois.tree')
+def whois_tree():
+    return lambda: SIDNWhois('nfg.nl', response=WHOIS_RESPONSE)
+
+
+@footprint('whois.result')
+def whois_result():
+    return lambda: SIDNWhois('nfg.nl', response=WHOIS_RESPONSE).result()
+
+
+# running and comparing
+
+def run(prefix=None, mintime=0.2):
+    """ seconds per operation of every benchmark whose name starts with
+    `prefix` """
+    results = {}
+    for name, setup in BENCHMARKS:
+        if prefix and not name.startswith(prefix):
+            continue
+        results[name] = measure(setup(), mintime)
+    footprints = {}
+    for name, setup in FOOTPRINTS:
+        if prefix and not name.startswith(prefix):
+            continue
+        footprints[name] = retained(setup())
+    return dict(
+        version=VERSION,
+        python=sys.version.split()[0],
+        date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        results=results,
+        footprints=footprints,
+    )
+
+
+def compare(old, new, threshold=10):
+    """ (name, old, new, change in percent, slower) for every benchmark
+    in both results; slower is set when the change exceeds `threshold`
+
+    >>> old = dict(results={'a': 1e-5, 'b': 1e-5, 'c': 1e-5})
+    >>> new = dict(results={'a': 1.2e-5, 'b': 1.05e-5})
+    >>> [(n, int(round(c)), s) for n, o, w, c, s in compare(old, new)]
+    [('a', 20, True), ('b', 5, False)]
+    """
+    rows = []
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        a = old['results'][name]
+        b = new['results'][name]
+        change = a and (b - a) * 100.0 / a or 0.0
+        rows.append((name, a, b, change, change > threshold))
+    return rows
+
+
+def report(result, old=None, threshold=10):
+    """ print the results, against `old` if given; returns the number of
+    benchmarks that got slower """
+    footprints = result.get('footprints')
+    if footprints:
+        print "%-32s %12s" % ('', 'bytes/obj')
+        for name, setup in FOOTPRINTS:
+            if footprints.get(name) is not None:
+                print "%-32s %12d" % (name, footprints[name])
+        print
+    if old is None:
+        print "%-32s %12s" % ('', 'us/op')
+        for name, setup in BENCHMARKS:
+            if name in result['results']:
+                print "%-32s %12.2f" % (name, result['results'][name] * 1e6)
+        return 0
+    print "%-32s %12s %12s %8s" % ('', 'was us/op', 'now us/op', 'change')
+    slower = 0
+    for name, a, b, change, regressed in compare(old, result, threshold):
+        print "%-32s %12.2f %12.2f %+7.1f%%%s" % (
+            name, a * 1e6, b * 1e6, change, regressed and ' SLOWER' or '')
+        slower += regressed
+    return slower
+
+
+def usage():
+    print """
+
+microbenchmarks of building commands, parsing, framing, the proxy's
+handling of a message and whois results, and the memory whois results
+take
+
+usage:
+
+benchmark.py <options>
+
+options:
+
+  -f --filter=<prefix>                      only run benchmarks whose name
+                                            starts with prefix
+  -m --mintime=<seconds>                    shortest timed loop, default: 0.2
+  -o --output=<file>                        store the results as JSON
+  -c --compare=<file>                       compare with stored results,
+                                            exit 1 if any got slower
+  -t --threshold=<percent>                  slowdown that counts,
+                                            default: 10
+
+  """
+
+if __name__ == '__main__':
+    import getopt
+    import logging
+
+    # the proxy logs every message it handles
+    logging.disable(logging.INFO)
+
+    prefix = None
+    mintime = 0.2
+    output = None
+    old = None
+    threshold = 10
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], "f:m:o:c:t:", [
+            'filter=',
+            'mintime=',
+            'output=',
+            'compare=',
+            'threshold='])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in optlist:
+        if o in ('-f', '--filter'):
+            prefix = a
+        elif o in ('-m', '--mintime'):
+            mintime = float(a)
+        elif o in ('-o', '--output'):
+            output = a
+        elif o in ('-c', '--compare'):
+            old = json.load(open(a))
+        elif o in ('-t', '--threshold'):
+            threshold = float(a)
+
+    result = run(prefix, mintime)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if report(result, old, threshold):
+        sys.exit(1)
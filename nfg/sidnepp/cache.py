@@ -0,0 +1,310 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import re
+import time
+import threading
+from copy import deepcopy
+from collections import OrderedDict
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.protocol import SIDNEppProtocol, new_trid
+
+# commands that change the object they name
+TRANSFORM = frozenset([
+    'create',
+    'delete',
+    'update',
+    'renew',
+    'transfer',
+    'domainCancelDelete',
+])
+
+WORD = re.compile("[\w.-]+")
+
+
+class LRUCache(object):
+    """
+    bounded, thread-safe mapping whose entries expire
+
+    >>> c = LRUCache(size=2, ttl=60)
+    >>> c.put('a', 1)
+    >>> c.put('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.put('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> sorted(c.stats().items())
+    [('hits', 1), ('misses', 1), ('size', 2)]
+    """
+
+    def __init__(self, size=1024, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.misses += 1
+                return default
+            # most recently used go last
+            self._data[key] = item
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            return self._data.pop(key, (None, None))[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return dict(size=len(self._data), hits=self.hits, misses=self.misses)
+
+
+class SIDNEppInfoCache(SIDNEppProtocol):
+    """
+    info responses, kept until they expire or until a command or a poll
+    message touches the object
+
+    Responses to domain:info, contact:info and host:info are cached per
+    object. Any create, update, delete, renew, transfer or
+    domainCancelDelete of an object drops its entry, as does any poll
+    message that mentions it.
+    """
+
+    # variants of domain:info
+    HOSTS = (None, 'all', 'del', 'sub', 'none')
+
+    def __init__(self, size=10000, ttl=300):
+        SIDNEppProtocol.__init__(self)
+        self._cache = LRUCache(size, ttl)
+        # when objects were last changed, so that an info response that
+        # was under way during a change is not cached
+        self._changed = LRUCache(size, ttl)
+
+    def _id(self, objtype, objid):
+        # domain and host names are case insensitive, contact ids are not
+        if objtype in ('domain', 'host'):
+            return objid.lower()
+        return objid
+
+    def _key(self, req, (command, objtype, ids)):
+        if command != 'info' or objtype is None or len(ids) != 1:
+            return None
+        if self.query(req, "//domain:authInfo|//contact:authInfo"):
+            # answers depend on who is asking
+            return None
+        hosts = None
+        if objtype == 'domain':
+            hosts = self.query(req, "//domain:name/@hosts")
+            hosts = hosts and hosts[0] or None
+        return objtype, self._id(objtype, ids[0]), hosts
+
+    def invalidate(self, objtype, objid):
+        objid = self._id(objtype, objid)
+        self._changed.put((objtype, objid), time.time())
+        if objtype == 'domain':
+            for hosts in self.HOSTS:
+                self._cache.invalidate((objtype, objid, hosts))
+        else:
+            self._cache.invalidate((objtype, objid, None))
+
+    def _invalidate_poll(self, reply):
+        for objtype, q in (('domain', "//domain:name/text()"),
+                           ('host', "//host:name/text()"),
+                           ('contact', "//contact:id/text()")):
+            for objid in self.query(reply, q):
+                self.invalidate(objtype, objid)
+        # the message text names objects too, e.g.
+        # "1202 Change to name server ns1.bol.nl processed"
+        for text in self.query(reply, "//epp:msgQ/epp:msg/text()"):
+            for word in WORD.findall(text):
+                word = word.strip('.')
+                for objtype in ('domain', 'host', 'contact'):
+                    self.invalidate(objtype, word)
+
+    def lookup(self, req, description=None):
+        """ cached response to an info command, carrying the clTRID of
+        `req`, or None """
+        if description is None:
+            description = self.describe(req)
+        key = self._key(req, description)
+        if key is None:
+            return None
+        reply = self._cache.get(key)
+        if reply is None:
+            return None
+        reply = deepcopy(reply)
+        r = self.query(reply, "/epp:epp/epp:response/epp:trID")
+        if r:
+            r[0].clear()
+            r[0].append(self.e_epp.svTRID(new_trid('PROXY')))
+        cltrid = self.get_cltrid(req)
+        if cltrid:
+            self.set_cltrid(reply, cltrid)
+        return reply
+
+    def update(self, req, reply, description=None, started=None):
+        """ learn from a command the remote EPP service answered;
+        `started` is when the command was sent """
+        if description is None:
+            description = self.describe(req)
+        command, objtype, ids = description
+        if command in TRANSFORM and objtype:
+            for objid in ids:
+                self.invalidate(objtype, objid)
+        elif command == 'poll':
+            self._invalidate_poll(reply)
+        else:
+            key = self._key(req, description)
+            if key is None:
+                return
+            r = self.query(reply, "/epp:epp/epp:response/epp:result/@code")
+            if not r or r[0] != '1000':
+                return
+            changed = self._changed.get(key[:2])
+            if started and changed and changed >= started:
+                return
+            self._cache.put(key, reply)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class SIDNEppCheckCache(SIDNEppProtocol):
+    """
+    short-lived availability of domains, contacts and hosts
+
+    Check results are kept per object, "available" answers for
+    `avail_ttl` seconds and "taken" answers for `taken_ttl` seconds.
+    A check for objects that are all known is answered locally, with a
+    response built from the cached results. A create, delete or
+    domainCancelDelete of an object drops its entry.
+    """
+
+    MSG = {
+        'domain': 'The availability of the domain name has been checked.',
+        'contact': 'The availability of the contact person has been '
+                   'checked.',
+        'host': 'The availability of the name server has been checked.',
+    }
+
+    def __init__(self, size=100000, avail_ttl=10, taken_ttl=60):
+        SIDNEppProtocol.__init__(self)
+        self.avail_ttl = avail_ttl
+        self.taken_ttl = taken_ttl
+        self._cache = LRUCache(size, taken_ttl)
+        self._changed = LRUCache(size, max(avail_ttl, taken_ttl))
+
+    def _key(self, objtype, objid):
+        if objtype in ('domain', 'host'):
+            return objtype, objid.lower()
+        return objtype, objid
+
+    def invalidate(self, objtype, objid):
+        key = self._key(objtype, objid)
+        self._changed.put(key, time.time())
+        self._cache.invalidate(key)
+
+    def lookup(self, req, description=None):
+        """ response to a check command, if all its objects are cached """
+        if description is None:
+            description = self.describe(req)
+        command, objtype, ids = description
+        if command != 'check' or objtype is None or not ids:
+            return None
+        cds = []
+        for objid in ids:
+            item = self._cache.get(self._key(objtype, objid))
+            if item is None:
+                return None
+            cds.append(item)
+
+        e = self.e_epp
+        m = getattr(self, 'e_' + objtype)
+        key = objtype == 'contact' and 'id' or 'name'
+        chk = []
+        for name, avail, reason in cds:
+            cd = [getattr(m, key)(name, avail=avail and 'true' or 'false')]
+            if reason is not None:
+                cd.append(m.reason(reason))
+            chk.append(m.cd(*cd))
+        trid = [e.svTRID(new_trid('PROXY'))]
+        cltrid = self.get_cltrid(req)
+        if cltrid:
+            trid.insert(0, e.clTRID(cltrid))
+        return e.epp(
+            e.response(
+                e.result(e.msg(self.MSG[objtype]), code='1000'),
+                e.resData(m.chkData(*chk)),
+                e.trID(*trid)
+            )
+        )
+
+    def update(self, req, reply, description=None, started=None):
+        """ learn from a command the remote EPP service answered;
+        `started` is when the command was sent """
+        if description is None:
+            description = self.describe(req)
+        command, objtype, ids = description
+        if objtype is None:
+            return
+        if command in ('create', 'delete', 'domainCancelDelete'):
+            for objid in ids:
+                self.invalidate(objtype, objid)
+            return
+        if command != 'check':
+            return
+        r = self.query(reply, "/epp:epp/epp:response/epp:result/@code")
+        if not r or r[0] != '1000':
+            return
+        for cd in self.query(reply, "//%s:cd" % objtype):
+            name = cd[0]
+            key = self._key(objtype, name.text)
+            changed = self._changed.get(key)
+            if started and changed and changed >= started:
+                continue
+            avail = name.get('avail') in ('true', '1')
+            reason = len(cd) > 1 and cd[1].text or None
+            ttl = self.taken_ttl
+            if avail:
+                ttl = self.avail_ttl
+            self._cache.put(key, (name.text, avail, reason), ttl)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
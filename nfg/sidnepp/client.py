@@ -10,9 +10,10 @@
 
 from zope.interface import implements
 import socket
-import struct
-import ssl
 import time
+import itertools
+import threading
+from collections import OrderedDict
 from lxml import etree
 
 import re
@@ -21,7 +22,24 @@ import os.path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
 from nfg.sidnepp.interfaces import IEpp
-from nfg.sidnepp.protocol import SIDNEppProtocol
+from nfg.sidnepp.protocol import SIDNEppProtocol, HELLO, result_code
+from nfg.sidnepp import tls
+from nfg.sidnepp.framing import SIDNEppFrameReader, frame, nodelay
+from nfg.sidnepp.retry import (
+    retryable,
+    idempotent,
+    backoff,
+    breaker,
+    CircuitOpen,
+    CLOSING,
+    UNAVAILABLE
+)
+from nfg.sidnepp.templates import (
+    TEMPLATES,
+    SIDNEppCommand,
+    Raw,
+    fragment
+)
 from nfg.sidnepp.state import (
     STATE_INIT,
     STATE_CONNECTED,
@@ -42,15 +60,43 @@ log.addHandler(ch)
 PHONE = re.compile("(\+[0 9]{1,3}\.[0 9]{1,14})?")
 
 
+class SIDNEppError(Exception):
+    """ the registry answered a command with an error result """
+
+    def __init__(self, code, msg, response=None):
+        Exception.__init__(self, "%s: %s" % (code, msg))
+        self.code = code
+        self.msg = msg
+        self.response = response
+
+
 class SIDNEppClient(SIDNEppProtocol):
     implements(IEpp)
 
     _state = STATE_INIT
+    _fd = None
+    # when the session last sent anything
+    _active = 0
 
     # server frames
     _greeting = None
     _login = None
 
+    # most objects the registry accepts in a single <check>
+    max_check = 10
+
+    # times a command is sent again after the session broke or the
+    # registry answered with a retryable code, see write()
+    retries = 5
+    # seconds of the first backoff, doubling per retry up to the cap
+    backoff_base = 0.1
+    backoff_cap = 5.0
+    # failures in a row after which the registry is not tried for
+    # breaker_reset seconds, by any session, see SIDNEppCircuitBreaker
+    breaker_threshold = 5
+    breaker_reset = 30.0
+    connect_timeout = 10
+
     def __init__(self, host=None, port=None, username=None, password=None,
                  ssl=True):
         super(SIDNEppClient, self).__init__()
@@ -58,17 +104,40 @@ class SIDNEppClient(SIDNEppProtocol):
         self.port = port
         self.username = username
         self.password = password
+        # True, False, or an SSLContext, see tls.context()
         self.ssl = ssl
+        self.breaker = breaker(host, port, self.breaker_threshold,
+                               self.breaker_reset)
         self.connect()
 
     def connect(self):
+        """ open a connection and set up the session: hello, and login
+        if there are credentials """
         assert(self._state == STATE_INIT)
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((self.host, self.port))
+        self.breaker.allow()
+        try:
+            self._connect()
+        except SIDNEppError, why:
+            self.close()
+            if why.code in UNAVAILABLE:
+                self.breaker.failure()
+            raise
+        except (socket.error, IOError):
+            self.close()
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+
+    def _connect(self):
+        s = socket.create_connection((self.host, self.port),
+                                     self.connect_timeout)
+        s.settimeout(None)
+        nodelay(s)
         if self.ssl:
-            self._fd = ssl.wrap_socket(s, suppress_ragged_eofs=False)
+            self._fd = tls.wrap(s, self.host, self.port, self.ssl)
         else:
             self._fd = s
+        self._reader = SIDNEppFrameReader(self._fd)
         self._state = STATE_CONNECTED
 
         self._greeting = '<?xml version="1.0" encoding="UTF-8"?>%s' % \
@@ -77,42 +146,149 @@ class SIDNEppClient(SIDNEppProtocol):
             self._login = '<?xml version="1.0" encoding="UTF-8"?>%s' % \
                 etree.tostring(self.login(self.username, self.password))
 
-    def write(self, message):
-        assert(self._state > STATE_INIT)
-        # validate
+    def prepare(self, message):
+        """ validate a message and give commands a unique clTRID
 
+        Returns the message as it goes on the wire, and its clTRID.
+        """
+        if isinstance(message, SIDNEppCommand):
+            # filled in from a template, nothing to check
+            return message, message.cltrid
         if type(message) == etree._Element:
-            message = self.render(message)
-        else:
-            self.parse(message)
-
-        #log.debug(message)
+            cltrid = self.set_cltrid(message)
+            return self.render(message, pretty=False), cltrid
+
+        element = self.parse(message)
+        if element is None:
+            return message, None
+        cltrid = self.get_cltrid(element)
+        if cltrid is None:
+            cltrid = self.set_cltrid(element)
+            if cltrid is not None:
+                message = self.render(element, pretty=False)
+        return message, cltrid
+
+    def send(self, message):
+        """ send a prepared message, without waiting for the reply """
+        self._fd.sendall(frame(message))
+        self._active = time.time()
+
+    def idle(self):
+        """ seconds since the session last sent anything """
+        return time.time() - self._active
+
+    def _exchange(self, message):
+        self.send(message)
+        return self.read()
+
+    def _code(self, reply):
+        r = self.query(reply, "/epp:epp/epp:response/epp:result/@code")
+        return r and r[0] or None
 
-        l = len(message) + 4
-        data = struct.pack(">L", l)
-        loop = 1
-        while loop < 10:
+    def write(self, message):
+        """ send a message and return the reply
+
+        A session that broke is set up again, from the greeting through
+        the login, and the message is sent again. So is a message the
+        registry answered with a retryable result code, see RETRYABLE;
+        after a 2400 only if the command is idempotent(). Retries wait
+        with exponential backoff and jitter. Once the registry failed
+        breaker_threshold times in a row, by broken connections or by
+        the codes in UNAVAILABLE, every session to it fails at once with
+        CircuitOpen instead, until it has had breaker_reset seconds of
+        rest.
+        """
+        return self._resilient(self.prepare(message)[0], self._exchange,
+                               self._code)
+
+    def _resilient(self, message, exchange, code):
+        """ exchange(message) on a working session, as write() describes;
+        code(reply) is the result code of a reply """
+        safe = idempotent(message)
+        attempt = 0
+        while 1:
             try:
-                self._fd.send(data)
-                self._fd.send(message)
-                return self.read()
-            except Exception:
-                # re-connect
-                print "Oops, reconnecting"
-                self.close()
-                self.connect()
-            loop += 1
-            time.sleep(1)
+                if self._state == STATE_INIT:
+                    self.connect()
+                else:
+                    self.breaker.allow()
+                reply = exchange(message)
+            except CircuitOpen:
+                raise
+            except SIDNEppError, why:
+                # logging in again failed
+                if not retryable(why.code, safe=True) or \
+                        attempt >= self.retries:
+                    raise
+                failure = "login failed with %s" % why.code
+            except (socket.error, IOError), why:
+                if self._state != STATE_INIT:
+                    # connect() has done this for its own failures
+                    self.close()
+                    self.breaker.failure()
+                if attempt >= self.retries:
+                    raise
+                failure = repr(why)
+            else:
+                result = code(reply)
+                if result in UNAVAILABLE:
+                    self.breaker.failure()
+                else:
+                    # answered, whatever the answer
+                    self.breaker.success()
+                if result in CLOSING:
+                    self.close()
+                if not retryable(result, safe) or attempt >= self.retries:
+                    return reply
+                failure = "result %s" % result
+            wait = backoff(attempt, self.backoff_base, self.backoff_cap)
+            log.debug("%s from %s:%s, retry in %.2fs" % (
+                failure, self.host, self.port, wait))
+            time.sleep(wait)
+            attempt += 1
+
+    def pipeline(self, messages, window=16):
+        """ send commands without waiting for each reply in turn
+
+        At most `window` commands are in flight at once. Replies are
+        matched to their commands by clTRID and returned in the order
+        of `messages`.
+        """
+        assert(self._state == STATE_LOGGEDIN)
+        messages = [self.prepare(m) for m in messages]
+        replies = [None] * len(messages)
+        inflight = OrderedDict()
+        sent = 0
+        while sent < len(messages) or inflight:
+            while sent < len(messages) and len(inflight) < window:
+                message, cltrid = messages[sent]
+                inflight[cltrid or object()] = sent
+                self.send(message)
+                sent += 1
+            reply = self.read()
+            cltrid = self.get_cltrid(reply)
+            if cltrid in inflight:
+                replies[inflight.pop(cltrid)] = reply
+            else:
+                replies[inflight.popitem(last=False)[1]] = reply
+        return replies
 
     def read(self):
-        buf = self.readall(self._fd, 4)
-        need = struct.unpack(">L", buf)
-        need = need[0] - 4
-        buf = self.readall(self._fd, need)
-        return self.parse(buf)
+        return self.parse(self._reader.read())
+
+    def forward(self, message):
+        """ send a message as is and return the reply as received, for
+        callers that don't need to look inside either. Broken sessions
+        and retryable results are dealt with as by write(). """
+        return self._resilient(message, self._transfer, result_code)
+
+    def _transfer(self, message):
+        self.send(message)
+        return self._reader.read()
 
     def close(self):
-        self._fd.close()
+        if self._fd is not None:
+            self._fd.close()
         self._state = STATE_INIT
 
     def getState(self):
@@ -127,24 +303,27 @@ class SIDNEppClient(SIDNEppProtocol):
             return self.parse(self._greeting)
 
         assert(self._state == STATE_CONNECTED)
-        xml = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
-        <epp xmlns="urn:ietf:params:xml:ns:epp-1.0">
-          <hello/>
-        </epp>"""
-        result = self.write(xml)
+        result = self._exchange(HELLO)
         assert(self.query(result, "//epp:greeting"))
         self._state = STATE_SESSION
         self._greeting = '<?xml version="1.0" encoding="UTF-8"?>%s' % \
                 etree.tostring(result)
         return result
 
-    def login(self, login, password, newpassword=None, lang='NL'):
-        if self._state == STATE_LOGGEDIN and self._login:
-            return self.parse(self._login)
+    def keepalive(self):
+        """ hello on a logged-in session, so that the server does not
+        close it for being idle; no retries, a session that broke is
+        left closed """
+        assert(self._state == STATE_LOGGEDIN)
+        try:
+            return self._exchange(HELLO)
+        except (socket.error, IOError):
+            self.close()
+            raise
 
-        assert(self._state == STATE_SESSION)
+    def _build_login(self, login, password, lang='NL'):
         e = self.e_epp
-        x = e.epp(
+        return e.epp(
             e.command(
                 e.login(
                     e.clID(login),
@@ -161,14 +340,22 @@ class SIDNEppClient(SIDNEppProtocol):
                 )
             )
         )
-        s = self.write(x)
+
+    def login(self, login, password, newpassword=None, lang='NL'):
+        if self._state == STATE_LOGGEDIN and self._login:
+            return self.parse(self._login)
+
+        assert(self._state == STATE_SESSION)
+        s = self._exchange(self.prepare(self._build_login(login, password,
+                                                          lang))[0])
         r = self.query(s, "//epp:result")
         if not r:
+            # the answer to hello, after the greeting sent on connect
             s = self.read()
             r = self.query(s, "//epp:result")
-        if int(r[0].get('code')) != 1000:
-            raise Exception("login failed. code was %s\nfull message:\n%s" % (
-                r[0].get('code'), self.render(r[0])))
+        if not r or r[0].get('code') != '1000':
+            msg = r and self.query(r[0], "epp:msg/text()")
+            raise SIDNEppError(r and r[0].get('code'), msg and msg[0], s)
 
         self._state = STATE_LOGGEDIN
         self._login = self.render(s)
@@ -185,42 +372,78 @@ class SIDNEppClient(SIDNEppProtocol):
         </command>
         </epp>
         """
-        r = self.write(xml)
-        self.close()
-        return r
+        try:
+            return self._exchange(xml)
+        finally:
+            self.close()
 
     def poll(self, ack=None):
         assert(self._state == STATE_LOGGEDIN)
-        e = self.e_epp
         if ack:
-            poll = e.poll(op='ack', msgID=ack)
-        else:
-            poll = e.poll(op='req')
-        return self.write(e.epp(e.command(poll)))
+            return self.write(TEMPLATES['poll_ack'].fill(msgid=ack))
+        return self.write(TEMPLATES['poll_req'].fill())
+
+# batch checks
+
+    def _chunks(self, names, size):
+        names = iter(names)
+        while 1:
+            chunk = list(itertools.islice(names, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _build_check(self, objtype, names):
+        key = objtype == 'contact' and 'id' or 'name'
+        ids = ''.join([fragment('%s:%s' % (objtype, key), n) for n in names])
+        return TEMPLATES[objtype + '_check'].fill(ids=Raw(ids))
+
+    def _parse_check(self, s, names):
+        r = self.query(s, "//epp:result")
+        if not r or int(r[0].get('code')) != 1000:
+            msg = r and self.query(r[0], "epp:msg/text()")
+            raise SIDNEppError(r and r[0].get('code'), msg and msg[0], s)
+        # the registry may change the case of the names
+        asked = dict((n.lower(), n) for n in names)
+        avail = {}
+        for n in self.query(s, "//domain:cd/domain:name|//contact:cd/contact:id"
+                            "|//host:cd/host:name"):
+            name = asked.get(n.text.lower(), n.text)
+            avail[name] = n.get('avail') in ('true', '1')
+        return avail
+
+    def _check_many(self, objtype, names, chunk=None, window=4):
+        chunks = self._chunks(names, chunk or self.max_check)
+        avail = {}
+        while 1:
+            batch = list(itertools.islice(chunks, window))
+            if not batch:
+                break
+            replies = self.pipeline(
+                [self._build_check(objtype, c) for c in batch], window)
+            for names, s in zip(batch, replies):
+                avail.update(self._parse_check(s, names))
+        return avail
+
+    def domain_check_many(self, domains, chunk=None):
+        """ check any number of domains, `chunk` (default: max_check) per
+        command. Returns a dict mapping each name to its availability.
+        """
+        return self._check_many('domain', domains, chunk)
+
+    def contact_check_many(self, contacts, chunk=None):
+        return self._check_many('contact', contacts, chunk)
+
+    def host_check_many(self, hosts, chunk=None):
+        return self._check_many('host', hosts, chunk)
 
 # 6.5 DOMAIN
 
     def domain_check(self, domain):
-        e = self.e_epp
-        d = self.e_domain
-        return self.write(
-            e.epp(e.command(e.check(d.check(d.name(domain)))))
-        )
+        return self.write(self._build_check('domain', [domain]))
 
     def domain_info(self, domain):
-        e = self.e_epp
-        d = self.e_domain
-        return self.write(
-            e.epp(
-                e.command(
-                    e.info(
-                        d.info(
-                            d.name(domain, hosts='all')
-                        )
-                    )
-                )
-            )
-        )
+        return self.write(TEMPLATES['domain_info'].fill(name=domain))
 
     def domain_create(self, domain, data):
         e = self.e_epp
@@ -248,67 +471,35 @@ class SIDNEppClient(SIDNEppProtocol):
         return self.write(x)
 
     def _build_domain_update(self, key, value):
-        d = self.e_domain
         u = []
         if key in ['add', 'rem']:
             if 'ns' in value:
-                l = [d.hostObj(t) for t in value['ns']]
-                l = tuple(l)
-                u.append(d.ns(*l))
+                l = [fragment('domain:hostObj', t) for t in value['ns']]
+                u.append('<domain:ns>%s</domain:ns>' % ''.join(l))
             if 'tech' in value:
                 if type(value['tech']) != type([1, ]):
                     value['tech'] = [value['tech'], ]
-                [u.append(d.contact(t, type='tech')) for t in value['tech']]
+                [u.append(fragment('domain:contact', t, type='tech'))
+                 for t in value['tech']]
             if 'admin' in value:
-                u.append(d.contact(value['admin'], type='admin'))
+                u.append(fragment('domain:contact', value['admin'],
+                                  type='admin'))
         if key in ['chg']:
-            u.append(d.registrant(value['owner']))
-        return tuple(u)
+            u.append(fragment('domain:registrant', value['owner']))
+        return Raw(''.join(u))
 
     def domain_update(self, domain, data):
         keys = data.keys()
         for k in keys:
             assert(k in ['add', 'chg', 'rem'])
-        e = self.e_epp
-        d = self.e_domain
-        add = ()
-        chg = ()
-        rem = ()
+        parts = {}
         for k, v in data.items():
-            if k == 'add':
-                add = self._build_domain_update(k, v)
-            elif k == 'rem':
-                rem = self._build_domain_update(k, v)
-            elif k == 'chg':
-                chg = self._build_domain_update(k, v)
-
-        x = e.epp(
-            e.command(
-                e.update(
-                    d.update(
-                        d.name(domain),
-                        d.add(*add),
-                        d.rem(*rem),
-                        d.chg(*chg),
-                    )
-                )
-            )
-        )
-        return self.write(x)
+            parts[k] = self._build_domain_update(k, v)
+        return self.write(TEMPLATES['domain_update'].fill(name=domain,
+                                                          **parts))
 
     def domain_delete(self, domain):
-        e = self.e_epp
-        d = self.e_domain
-        x = e.epp(
-            e.command(
-                e.delete(
-                    d.delete(
-                        d.name(domain)
-                    )
-                )
-            )
-        )
-        return self.write(x)
+        return self.write(TEMPLATES['domain_delete'].fill(name=domain))
 
     def domain_cancel_delete(self, domain):
         e = self.e_xsi
@@ -343,15 +534,10 @@ class SIDNEppClient(SIDNEppProtocol):
 # 6.6 CONTACT
 
     def contact_check(self, contact):
-        e = self.e_epp
-        c = self.e_contact
-        x = e.epp(e.command(e.check(c.check(c.id(contact)))))
-        return self.write(x)
+        return self.write(self._build_check('contact', [contact]))
 
     def contact_info(self, contact):
-        e = self.e_epp
-        c = self.e_contact
-        return self.write(e.epp(e.command(e.info(c.info(c.id(contact))))))
+        return self.write(TEMPLATES['contact_info'].fill(id=contact))
 
     def _build_contact_info(self, data):
         c = self.e_contact
@@ -463,21 +649,15 @@ class SIDNEppClient(SIDNEppProtocol):
         return self.write(x)
 
     def contact_delete(self, contact):
-        e = self.e_epp
-        c = self.e_contact
-        return self.write(e.epp(e.command(e.delete(c.delete(c.id(contact))))))
+        return self.write(TEMPLATES['contact_delete'].fill(id=contact))
 
 # 6.7 NAMESERVERS
 
     def host_check(self, host):
-        e = self.e_epp
-        h = self.e_host
-        return self.write(e.epp(e.command(e.check(h.check(h.name(host))))))
+        return self.write(self._build_check('host', [host]))
 
     def host_info(self, host):
-        e = self.e_epp
-        h = self.e_host
-        return self.write(e.epp(e.command(e.info(h.info(h.name(host))))))
+        return self.write(TEMPLATES['host_info'].fill(name=host))
 
     def host_create(self, host, addr=None, ip="v4"):
         assert(ip in ['v4', 'v6'])
@@ -494,22 +674,106 @@ class SIDNEppClient(SIDNEppProtocol):
 
     def host_update(self, host, data):
         assert(type(data) == type({'a': 'b'}))
-        e = self.e_epp
-        h = self.e_host
-        t = [h.name(host), ]
+        t = []
         for k, v in data.items():
             if k == 'add':
-                [t.append(h.add(h.addr(a))) for a in v]
+                [t.append('<host:add>%s</host:add>' %
+                          fragment('host:addr', a)) for a in v]
             elif k == 'rem':
-                [t.append(h.rem(h.addr(a))) for a in v]
-
-        t = tuple(t)
-        return self.write(e.epp(e.command(e.update(h.update(*t)))))
+                [t.append('<host:rem>%s</host:rem>' %
+                          fragment('host:addr', a)) for a in v]
+        return self.write(TEMPLATES['host_update'].fill(
+            name=host, changes=Raw(''.join(t))))
 
     def host_delete(self, host):
-        e = self.e_epp
-        h = self.e_host
-        return self.write(e.epp(e.command(e.delete(h.delete(h.name(host))))))
+        return self.write(TEMPLATES['host_delete'].fill(name=host))
+
+
+class SIDNEppPipeline(object):
+    """
+    share one logged-in session between threads
+
+    write() may be called from many threads at once. Every command is
+    sent right away, with a unique clTRID, and its caller waits for the
+    reply carrying that clTRID, which a reader thread picks off the
+    session. At most `window` commands are in flight at once.
+    """
+
+    def __init__(self, client, window=8):
+        assert(client.getState() == STATE_LOGGEDIN)
+        self.client = client
+        self._window = threading.BoundedSemaphore(window)
+        self._lock = threading.Lock()
+        self._inflight = OrderedDict()
+        self._error = None
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read(self):
+        while 1:
+            try:
+                reply = self.client.read()
+            except Exception, why:
+                break
+            cltrid = self.client.get_cltrid(reply)
+            with self._lock:
+                if cltrid in self._inflight:
+                    waiter = self._inflight.pop(cltrid)
+                elif self._inflight:
+                    waiter = self._inflight.popitem(last=False)[1]
+                else:
+                    log.debug("unexpected reply: %s" % cltrid)
+                    continue
+            waiter.append(reply)
+            waiter[0].set()
+
+        with self._lock:
+            self._error = why
+            inflight, self._inflight = self._inflight, OrderedDict()
+        for waiter in inflight.values():
+            waiter[0].set()
+
+    def write(self, message, timeout=None):
+        message, cltrid = self.client.prepare(message)
+        key = cltrid or object()
+        waiter = [threading.Event()]
+        self._window.acquire()
+        try:
+            with self._lock:
+                if self._error:
+                    raise IOError("session lost: %s" % self._error)
+                self._inflight[key] = waiter
+                # send under the lock, so replies without a clTRID can
+                # still be matched by their order on the wire
+                try:
+                    self.client.send(message)
+                except:
+                    del self._inflight[key]
+                    raise
+            waiter[0].wait(timeout)
+        finally:
+            self._window.release()
+        if len(waiter) < 2:
+            with self._lock:
+                self._inflight.pop(key, None)
+            raise IOError("no reply for %s: %s" % (cltrid, self._error))
+        return waiter[1]
+
+    def logout(self):
+        e = self.client.e_epp
+        r = self.write(e.epp(e.command(e.logout())))
+        self.close()
+        return r
+
+    def close(self):
+        try:
+            self.client._fd.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.client.close()
+        self._reader.join()
+
 
 if __name__ == '__main__':
     import doctest
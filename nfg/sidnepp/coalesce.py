@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import re
+import time
+import threading
+
+# commands whose answer only depends on the command: identical ones may
+# share a single round trip
+READS = frozenset(['check', 'info'])
+
+_CLTRID = re.compile(r"<((?:[\w.-]+:)?clTRID)>([^<]*)</\1>")
+
+
+def flight_key(message, command):
+    """ what identical reads have in common: the raw message without its
+    clTRID; None for commands that are not coalesced
+
+    >>> a = '<epp><command><info>x</info><clTRID>A-1</clTRID></command></epp>'
+    >>> b = '<epp><command><info>x</info><clTRID>B-7</clTRID></command></epp>'
+    >>> flight_key(a, 'info') == flight_key(b, 'info')
+    True
+    >>> flight_key(a, 'create') is None
+    True
+    """
+    if command not in READS:
+        return None
+    return _CLTRID.sub('', message)
+
+
+def find_cltrid(message):
+    """ the clTRID of a raw command or response, or None
+
+    >>> find_cltrid('<command><epp:clTRID>A-1</epp:clTRID></command>')
+    'A-1'
+    """
+    m = _CLTRID.search(message)
+    return m and m.group(2) or None
+
+
+def substitute_cltrid(reply, cltrid):
+    """ a raw response with its clTRID replaced, or dropped for a command
+    that had none
+
+    >>> r = '<trID><clTRID>A-1</clTRID><svTRID>S-1</svTRID></trID>'
+    >>> substitute_cltrid(r, 'B-7')
+    '<trID><clTRID>B-7</clTRID><svTRID>S-1</svTRID></trID>'
+    >>> substitute_cltrid(r, None)
+    '<trID><svTRID>S-1</svTRID></trID>'
+    """
+    if cltrid is None:
+        return _CLTRID.sub('', reply, 1)
+    return _CLTRID.sub(lambda m: '<%s>%s</%s>' % (m.group(1), cltrid,
+                                                  m.group(1)), reply, 1)
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.started = time.time()
+        self.result = None
+        self.error = None
+
+
+class SIDNEppSingleFlight(object):
+    """
+    one call at a time per key, shared by everyone who asks meanwhile
+
+    >>> f = SIDNEppSingleFlight()
+    >>> f.run('k', lambda: 42)
+    (42, True, ...)
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def run(self, key, fn):
+        """ fn() for the first caller with `key`; callers with the same
+        key that come while it runs wait for its result, or exception,
+        instead. Returns the result, whether this caller ran fn, and
+        when fn was started. """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, False, flight.started
+        try:
+            flight.result = fn()
+        except Exception, why:
+            flight.error = why
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.result, True, flight.started
+
+    def forget(self):
+        """ let callers that come from now on start calls of their own,
+        instead of sharing the ones that are running; for when those may
+        no longer give the right answer """
+        with self._lock:
+            self._flights.clear()
+
+    def __len__(self):
+        return len(self._flights)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import ssl
+import asyncore
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.framing import SIDNEppFrameBuffer, frame, nodelay, BUFSIZE
+
+# ssl conditions that only mean: try again when the socket is ready
+_SSL_RETRY = frozenset((ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE))
+
+
+class SIDNEppDispatcher(asyncore.dispatcher):
+    """
+    non-blocking channel speaking the 4-byte length-prefixed EPP framing
+
+    Subclasses implement handle_frame(), which is called once for every
+    complete frame received, and use write_frame() to queue a frame for
+    sending. Works on plain and (already handshaken) ssl sockets.
+    """
+
+    def __init__(self, sock=None, map=None):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self._rbuf = SIDNEppFrameBuffer()
+        self._wbuf = bytearray()
+        self._closing = False
+        if sock is not None:
+            nodelay(sock)
+
+    def handle_connect_event(self):
+        nodelay(self.socket)
+        asyncore.dispatcher.handle_connect_event(self)
+
+    def recv(self, buffer_size):
+        try:
+            return asyncore.dispatcher.recv(self, buffer_size)
+        except ssl.SSLError, why:
+            if why.args[0] in _SSL_RETRY:
+                return None
+            raise
+
+    def send(self, data):
+        try:
+            return asyncore.dispatcher.send(self, data)
+        except ssl.SSLError, why:
+            if why.args[0] in _SSL_RETRY:
+                return 0
+            raise
+
+    def handle_read(self):
+        data = self.recv(BUFSIZE)
+        # drain what the ssl layer already decrypted, select() won't
+        # report it as readable
+        pending = getattr(self.socket, 'pending', None)
+        while data and pending and pending():
+            more = self.recv(pending())
+            if not more:
+                break
+            data += more
+        if not data:
+            return
+        for message in self._rbuf.feed(data):
+            self.handle_frame(message)
+            if not self.connected:
+                break
+
+    def handle_frame(self, frame):
+        raise NotImplementedError
+
+    def write_frame(self, message):
+        self._wbuf += frame(message)
+        if self.connected:
+            self.handle_write()
+
+    def close_when_done(self):
+        """ close the channel once all queued frames are sent """
+        self._closing = True
+        if not self._wbuf:
+            self.close()
+
+    def writable(self):
+        return bool(self._wbuf) or not self.connected
+
+    def readable(self):
+        return not self._closing
+
+    def handle_write(self):
+        if self._wbuf:
+            sent = self.send(self._wbuf)
+            del self._wbuf[:sent]
+        if self._closing and not self._wbuf:
+            self.close()
+
+    def handle_close(self):
+        self.close()
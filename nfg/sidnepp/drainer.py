@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import os
+import json
+import socket
+import tempfile
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from nfg.sidnepp.client import SIDNEppClient, SIDNEppError
+from nfg.sidnepp.templates import TEMPLATES
+from nfg.sidnepp.state import STATE_LOGGEDIN
+
+import logging
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+log.addHandler(ch)
+
+
+class SIDNEppCheckpoint(object):
+    """
+    where draining the poll queue got to, kept in a file
+
+    `processed` is the msgID last handed out and processed, `acked` the
+    msgID last acknowledged. The file is replaced atomically on every
+    save, so a crash leaves either the old or the new checkpoint. Without
+    a path the checkpoint only lives in memory.
+
+    >>> tmp = tempfile.mkdtemp()
+    >>> path = os.path.join(tmp, 'poll.json')
+    >>> c = SIDNEppCheckpoint(path)
+    >>> c.processed is None
+    True
+    >>> c.save(processed='100001')
+    >>> c.save(acked='100001')
+    >>> c = SIDNEppCheckpoint(path)
+    >>> c.processed, c.acked
+    (u'100001', u'100001')
+    >>> os.remove(path); os.rmdir(tmp)
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.processed = None
+        self.acked = None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.processed = state.get('processed')
+            self.acked = state.get('acked')
+
+    def save(self, processed=None, acked=None):
+        if processed is not None:
+            self.processed = processed
+        if acked is not None:
+            self.acked = acked
+        if not self.path:
+            return
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(processed=self.processed, acked=self.acked), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+class SIDNEppPollMessage(object):
+    """ one message from the poll queue """
+
+    def __init__(self, client, response):
+        q = client.query(response, '//epp:msgQ')[0]
+        self.id = q.get('id')
+        self.count = int(q.get('count'))
+        date = client.query(q, 'epp:qDate/text()')
+        self.date = date and date[0] or None
+        msg = client.query(q, 'epp:msg/text()')
+        self.msg = msg and msg[0] or None
+        self.response = response
+
+    def __repr__(self):
+        return '<SIDNEppPollMessage %s: %s>' % (self.id, self.msg)
+
+
+class SIDNEppPollDrainer(object):
+    """
+    stream the poll queue, acknowledging each message as the next one
+    is asked for
+
+    Iterating yields every message in the queue, oldest first, and ends
+    when the queue is empty. A message counts as processed once the
+    caller asks for the next one: then it is checkpointed, and its ack
+    goes out pipelined with the request for the next message, so that
+    draining takes one round trip per message instead of two.
+
+    After a crash the message last handed out may still be at the head
+    of the queue. If the checkpoint has it as processed it is acked
+    without handing it out again; a message the caller never finished is
+    handed out again. A session that breaks while draining is set up
+    again, see SIDNEppClient.write().
+
+    The client may be logged in to the registry or to one of the
+    proxies, which answer the commands of a connection in order.
+    """
+
+    def __init__(self, client, checkpoint=None):
+        self.client = client
+        if not isinstance(checkpoint, SIDNEppCheckpoint):
+            checkpoint = SIDNEppCheckpoint(checkpoint)
+        self.checkpoint = checkpoint
+        self.drained = 0
+
+    def __iter__(self):
+        return self.drain()
+
+    def drain(self):
+        client = self.client
+        reply = client.write(TEMPLATES['poll_req'].fill())
+        while 1:
+            code = client._code(reply)
+            if code == '1300':
+                return
+            if code != '1301':
+                msg = client.query(reply, '//epp:result/epp:msg/text()')
+                raise SIDNEppError(code, msg and msg[0], reply)
+            message = SIDNEppPollMessage(client, reply)
+            if message.id == self.checkpoint.processed:
+                log.debug("ack processed message %s" % message.id)
+            else:
+                yield message
+                self.checkpoint.save(processed=message.id)
+                self.drained += 1
+            reply = self._next(message.id)
+
+    def _next(self, msgid):
+        """ ack `msgid` and ask for the next message, in one go """
+        client = self.client
+        if client.getState() != STATE_LOGGEDIN:
+            # the head of the queue tells whether the ack is still due
+            return client.write(TEMPLATES['poll_req'].fill())
+        try:
+            ack, reply = client.pipeline([
+                TEMPLATES['poll_ack'].fill(msgid=msgid),
+                TEMPLATES['poll_req'].fill()])
+        except (socket.error, IOError), why:
+            log.debug("session lost while draining: %r" % why)
+            client.close()
+            return client.write(TEMPLATES['poll_req'].fill())
+        code = client._code(ack)
+        if code == '1000':
+            self.checkpoint.save(acked=msgid)
+        elif code == '2303':
+            # not in the queue (anymore)
+            log.debug("ack %s: %s" % (msgid, code))
+        else:
+            msg = client.query(ack, '//epp:result/epp:msg/text()')
+            raise SIDNEppError(code, msg and msg[0], ack)
+        return reply
+
+
+def usage():
+    print """
+
+Drain the poll queue of a SIDN EPP account
+
+usage:
+
+drainer.py <options>
+
+options:
+
+  -s <addr> --server=<epp server>           default: testdrs.domain-registry.nl
+  -p <port> --port=<epp server>             default: 700
+  -u <username> --username=<epp username>
+  -w <password> --password=<epp password>
+  -P --plain                                no TLS, to drain through a
+                                            local proxy
+  -c --checkpoint=<file>                    where draining got to,
+                                            default: none
+
+  Messages are printed one per line: msgID, date and text.
+
+  """
+
+
+if __name__ == '__main__':
+    import getopt
+
+    server = 'testdrs.domain-registry.nl'
+    port = 700
+    username = password = None
+    ssl = True
+    checkpoint = None
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], "s:p:u:w:Pc:", [
+            'server=',
+            'port=',
+            'username=',
+            'password=',
+            'plain',
+            'checkpoint='])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in optlist:
+        if o in ('-s', '--server'):
+            server = a
+        elif o in ('-p', '--port'):
+            port = int(a)
+        elif o in ('-u', '--username'):
+            username = a
+        elif o in ('-w', '--password'):
+            password = a
+        elif o in ('-P', '--plain'):
+            ssl = False
+        elif o in ('-c', '--checkpoint'):
+            checkpoint = a
+
+    if not (username and password):
+        usage()
+        sys.exit(2)
+
+    logging.disable(logging.INFO)
+    client = SIDNEppClient(server, port, username, password, ssl=ssl)
+    try:
+        for message in SIDNEppPollDrainer(client, checkpoint):
+            print "%s\t%s\t%s" % (message.id, message.date,
+                                  (message.msg or '').encode('utf-8'))
+    finally:
+        client.logout()
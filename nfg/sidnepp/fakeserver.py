@@ -0,0 +1,531 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import ssl
+import time
+import random
+import threading
+import itertools
+from SocketServer import TCPServer, ThreadingMixIn, BaseRequestHandler
+import lxml.etree as ET
+from lxml.builder import ElementMaker
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.protocol import SIDNEppProtocol, GREETING
+from nfg.sidnepp.framing import SIDNEppFrameReader, frame, nodelay
+
+import logging
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+log.addHandler(ch)
+
+# messages of the result codes the fake server answers with
+RESULTS = {
+    '1000': 'The transaction was completed successfully.',
+    '1300': 'Command completed successfully; no messages.',
+    '1301': 'The message has been picked up. Please confirm receipt to '
+            'remove the message from the queue.',
+    '1500': 'You are now logged off.',
+    '2001': 'Command syntax error',
+    '2002': 'Command use error',
+    '2200': 'Authentication error',
+    '2302': 'The object already exists.',
+    '2303': 'The object does not exist.',
+    '2400': 'Command failed',
+    '2500': 'Command failed; server closing connection',
+    '2502': 'Session limit exceeded; server closing connection',
+}
+
+# fault() answer for a command that is not answered at all
+DISCONNECT = 'disconnect'
+
+
+def _now():
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+
+
+class SIDNEppFakeHandler(BaseRequestHandler, SIDNEppProtocol):
+    """
+    answers like the SIDN EPP service would, without doing anything
+
+    Responses follow the examples in docs/. The registry is an in-memory
+    set of names: check and create consult it, create and delete change
+    it, and info describes any object it is asked about.
+    """
+
+    # command name -> method answering it; everything else gets a plain
+    # 1000 from _handle_command()
+    commands = {
+        'hello': '_handle_hello',
+        'login': '_handle_login',
+        'logout': '_handle_logout',
+        'check': '_handle_check',
+        'info': '_handle_info',
+        'create': '_handle_create',
+        'delete': '_handle_delete',
+        'poll': '_handle_poll',
+    }
+
+    # set once the session is over
+    done = False
+    loggedin = False
+
+    def handle(self):
+        SIDNEppProtocol.__init__(self)
+        nodelay(self.request)
+        if self.server.ssl_context:
+            try:
+                self.request = self.server.ssl_context.wrap_socket(
+                    self.request, server_side=True)
+            except (ssl.SSLError, IOError), why:
+                log.debug("handshake failed: %r" % why)
+                return
+        self._reader = SIDNEppFrameReader(self.request)
+        try:
+            # like the real thing, greet as soon as the client connects
+            self.write(GREETING)
+            while not self.done:
+                try:
+                    buf = self._reader.read()
+                except IOError:  # client hung up
+                    break
+                if not self._answer(buf):
+                    break
+        finally:
+            if self.loggedin:
+                self.server.logout()
+
+    def _answer(self, buf):
+        """ answer one message, False to drop the connection """
+        req = self.parse(buf)
+        if req is None:
+            self.write(self.response(None, '2001'))
+            return True
+        description = self.describe(req)
+        self.server.commands.append(description)
+        delay = self.server.delay()
+        if delay:
+            time.sleep(delay)
+        fault = self.server.fault(description[0])
+        if fault == DISCONNECT:
+            return False
+        if fault:
+            self.write(self.response(req, fault))
+            return not fault.startswith('25')
+        name = self.commands.get(description[0], '_handle_command')
+        getattr(self, name)(req, description)
+        return True
+
+    def _handle_command(self, req, description):
+        self.write(self.response(req))
+
+    def _handle_hello(self, req, description):
+        self.write(GREETING)
+
+    def _handle_login(self, req, description):
+        if self.loggedin:
+            self.write(self.response(req, '2002'))
+        elif not self.server.login():
+            self.write(self.response(req, '2502'))
+            self.done = True
+        else:
+            self.loggedin = True
+            self.write(self.response(req))
+
+    def _handle_logout(self, req, description):
+        self.write(self.response(req, '1500'))
+        self.done = True
+
+    def _maker(self, req):
+        """ element maker for the object namespace of a command """
+        obj = self.query(req, '/epp:epp/epp:command/*/*')[0]
+        ns = ET.QName(obj).namespace
+        return ElementMaker(namespace=ns, nsmap={obj.prefix: ns})
+
+    def _handle_check(self, req, description):
+        """ everything is available, except what the server registered """
+        e = self._maker(req)
+        command, objtype, ids = description
+        key = objtype == 'contact' and 'id' or 'name'
+        cds = []
+        for objid in ids:
+            avail = not self.server.exists(objid)
+            if objtype != 'contact':
+                objid = objid.lower()
+            cds.append(e.cd(e(key, objid, avail=avail and 'true' or 'false')))
+        self.write(self.response(req, resdata=e.chkData(*cds)))
+
+    def _handle_info(self, req, description):
+        command, objtype, ids = description
+        e = self._maker(req)
+        s = self.e_sidn
+        objid = ids and ids[0] or ''
+        if objtype == 'domain':
+            data = e.infData(
+                e.name(objid.lower()),
+                e.roid('DNM_700-SIDN'),
+                e.status(s='ok'),
+                e.registrant('TES000079-SL1SL'),
+                e.contact('TES000079-SO1SO', type='admin'),
+                e.contact('TES000079-SL1SL', type='tech'),
+                e.ns(e.hostObj('ns1.%s' % objid.lower())),
+                e.clID('SIDN0'),
+                e.crID('SIDN0'),
+                e.crDate('2009-08-10T00:00:00.000Z'),
+                e.upID('SIDN0'),
+                e.upDate('2009-08-10T00:00:00.000Z'))
+            ext = s.domain(s.optOut('false'), s.limited('false'))
+        elif objtype == 'contact':
+            data = e.infData(
+                e.id(objid),
+                e.roid('CPN_100134-SIDN'),
+                e.status(s='ok'),
+                e.postalInfo(
+                    e.name('Jan Otten'),
+                    e.addr(e.street('Hoofdstraat 126'), e.city('Eindhoven'),
+                           e.pc('4444EE'), e.cc('NL')),
+                    type='loc'),
+                e.voice('+31.0612345678'),
+                e.email('otten@sidn.nl'),
+                e.clID('DEMEE'),
+                e.crID('DEMEE'),
+                e.crDate('2009-01-02T00:00:00.000Z'))
+            ext = s.contact(s.legalForm('EENMANSZAAK'), s.limited('false'))
+        else:
+            data = e.infData(
+                e.name(objid.lower()),
+                e.roid('NSR_100-SIDN'),
+                e.status(s='ok'),
+                e.addr('192.0.2.1', ip='v4'),
+                e.clID('REGIS'),
+                e.crID('REGIS'),
+                e.crDate('2009-06-10T00:00:00.000Z'))
+            ext = s.host(s.limited('false'))
+        self.write(self.response(req, resdata=data,
+                                 extension=s.ext(s.infData(ext))))
+
+    def _handle_create(self, req, description):
+        command, objtype, ids = description
+        objid = ids[0]
+        if not self.server.register(objid):
+            self.write(self.response(req, '2302'))
+            return
+        e = self._maker(req)
+        key = objtype == 'contact' and 'id' or 'name'
+        if objtype != 'contact':
+            objid = objid.lower()
+        self.write(self.response(req, resdata=e.creData(e(key, objid),
+                                                        e.crDate(_now()))))
+
+    def _handle_delete(self, req, description):
+        command, objtype, ids = description
+        if not self.server.unregister(ids[0]):
+            self.write(self.response(req, '2303'))
+            return
+        self.write(self.response(req))
+
+    def _handle_poll(self, req, description):
+        e = self.e_epp
+        poll = self.query(req, '/epp:epp/epp:command/epp:poll')[0]
+        if poll.get('op') == 'ack':
+            count = self.server.ack(poll.get('msgID'))
+            if count is None:
+                self.write(self.response(req, '2303'))
+                return
+            self.write(self.response(req, msgq=e.msgQ(
+                count=str(count), id=poll.get('msgID'))))
+            return
+        message = self.server.peek()
+        if message is None:
+            self.write(self.response(req, '1300'))
+            return
+        msgid, qdate, msg, resdata, count = message
+        self.write(self.response(
+            req, '1301', resdata=resdata,
+            msgq=e.msgQ(e.qDate(qdate), e.msg(msg), count=str(count),
+                        id=msgid)))
+
+    def response(self, req, code='1000', msg=None, resdata=None,
+                 extension=None, msgq=None):
+        e = self.e_epp
+        trid = [e.svTRID(self.server.svtrid())]
+        cltrid = req is not None and self.query(req, '//epp:clTRID/text()')
+        if cltrid:
+            trid.insert(0, e.clTRID(cltrid[0]))
+        response = [e.result(e.msg(msg or RESULTS.get(code, '')), code=code)]
+        if msgq is not None:
+            response.append(msgq)
+        if resdata is not None:
+            response.append(e.resData(resdata))
+        if extension is not None:
+            response.append(e.extension(extension))
+        response.append(e.trID(*trid))
+        return e.epp(e.response(*response))
+
+    def read(self):
+        return self.parse(self._reader.read())
+
+    def write(self, message):
+        if not isinstance(message, basestring):
+            message = self.render(message)
+        self.request.sendall(frame(message))
+
+
+class SIDNEppFakeServer(ThreadingMixIn, TCPServer):
+    """
+    local stand-in for the SIDN EPP service, for tests and load tests
+
+    Faults are injected per command: every command waits `latency` plus
+    up to `jitter` seconds, is answered with the result code in
+    `errors` for its command name, fails with `error_code` at
+    `error_rate`, or is not answered at all and has its connection
+    dropped at `disconnect_rate`. Codes from 2500 up close the
+    connection after answering, as the real service does. At most
+    `max_sessions` sessions can be logged in at once.
+
+    >>> s = SIDNEppFakeServer(('127.0.0.1', 0)).start()
+    >>> s.server_address
+    ('127.0.0.1', ...)
+    >>> s.queue('1202 Change to name server ns1.bol.nl processed')
+    '100000'
+    >>> s.peek()
+    ('100000', '...', '1202 Change to name server ns1.bol.nl processed', None, 1)
+    >>> s.ack('100000')
+    0
+    >>> s.shutdown()
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    # seconds to sleep before answering each command
+    latency = 0
+    jitter = 0
+    # command name -> result code to answer it with
+    errors = None
+    error_rate = 0
+    error_code = '2400'
+    disconnect_rate = 0
+    max_sessions = None
+
+    def __init__(self, (host, port), handler=None, latency=None,
+                 certfile=None, keyfile=None, seed=None):
+        if not handler:
+            handler = SIDNEppFakeHandler
+        if latency is not None:
+            self.latency = latency
+        self.errors = {}
+        self.random = random.Random(seed)
+        self.ssl_context = None
+        if certfile:
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
+        self._lock = threading.Lock()
+        self._svtrid = itertools.count(1)
+        self._msgid = itertools.count(100000)
+        # names (lower case) and contact ids that exist
+        self.registered = set()
+        # the poll queue, oldest first: (id, date, text, resData)
+        self.messages = []
+        # sessions logged in
+        self.sessions = 0
+        # description of each message received, see describe()
+        self.commands = []
+        TCPServer.__init__(self, (host, port), handler)
+
+    def svtrid(self):
+        return 'FAKE-%08d' % self._svtrid.next()
+
+    def delay(self):
+        """ seconds to wait before answering a command """
+        if self.jitter:
+            return self.latency + self.random.uniform(0, self.jitter)
+        return self.latency
+
+    def fault(self, command):
+        """ None to answer `command` normally, DISCONNECT to drop the
+        connection, or the result code to fail it with """
+        if self.disconnect_rate and self.random.random() < \
+                self.disconnect_rate:
+            return DISCONNECT
+        if command == 'hello':
+            # a greeting has no result
+            return None
+        code = self.errors.get(command)
+        if code:
+            return code
+        if self.error_rate and self.random.random() < self.error_rate:
+            return self.error_code
+        return None
+
+    def login(self):
+        """ take a session, False when there are too many """
+        with self._lock:
+            if self.max_sessions is not None and \
+                    self.sessions >= self.max_sessions:
+                return False
+            self.sessions += 1
+            return True
+
+    def logout(self):
+        with self._lock:
+            self.sessions -= 1
+
+    def _key(self, objid):
+        # contact ids are case sensitive, names are not
+        if '.' in objid:
+            return objid.lower()
+        return objid
+
+    def exists(self, objid):
+        return self._key(objid) in self.registered
+
+    def register(self, objid):
+        """ False if the object exists already """
+        with self._lock:
+            if self._key(objid) in self.registered:
+                return False
+            self.registered.add(self._key(objid))
+            return True
+
+    def unregister(self, objid):
+        """ False if the object did not exist """
+        with self._lock:
+            if self._key(objid) not in self.registered:
+                return False
+            self.registered.discard(self._key(objid))
+            return True
+
+    def queue(self, msg, resdata=None):
+        """ add a message to the poll queue, returns its id """
+        with self._lock:
+            msgid = str(self._msgid.next())
+            self.messages.append((msgid, _now(), msg, resdata))
+            return msgid
+
+    def peek(self):
+        """ the oldest message and the queue length, or None """
+        with self._lock:
+            if not self.messages:
+                return None
+            return self.messages[0] + (len(self.messages),)
+
+    def ack(self, msgid):
+        """ remove a message, returns the messages left or None if there
+        was no such message """
+        with self._lock:
+            for i, m in enumerate(self.messages):
+                if m[0] == msgid:
+                    del self.messages[i]
+                    return len(self.messages)
+            return None
+
+    def start(self):
+        """ serve from a background thread """
+        t = threading.Thread(target=self.serve_forever,
+                             kwargs=dict(poll_interval=0.05))
+        t.daemon = True
+        t.start()
+        return self
+
+
+def usage():
+    print """
+
+local stand-in for the SIDN EPP service
+
+usage:
+
+fakeserver.py <options>
+
+options:
+
+  -a --address=<listen address>             default: localhost
+  -l --port=<listen port>                   default: 7001
+  -C --cert=<file>                          speak TLS, with this
+                                            certificate
+  -K --key=<file>                           private key, if not in the
+                                            certificate file
+  -L --latency=<seconds>                    delay of every answer
+  -J --jitter=<seconds>                     random extra delay, at most
+  -E --error-rate=<fraction>                commands failed with 2400
+  -D --disconnect-rate=<fraction>           commands answered by
+                                            dropping the connection
+  -S --max-sessions=<sessions>              sessions logged in at once
+  -R --registered=<name,name..>             names that already exist
+
+  """
+
+if __name__ == '__main__':
+    import getopt
+
+    address = '127.0.0.1'
+    port = 7001
+    certfile = keyfile = None
+    options = {}
+    registered = []
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], "a:l:C:K:L:J:E:D:S:R:", [
+            'address=',
+            'port=',
+            'cert=',
+            'key=',
+            'latency=',
+            'jitter=',
+            'error-rate=',
+            'disconnect-rate=',
+            'max-sessions=',
+            'registered='])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in optlist:
+        if o in ('-a', '--address'):
+            address = a
+        elif o in ('-l', '--port'):
+            port = int(a)
+        elif o in ('-C', '--cert'):
+            certfile = a
+        elif o in ('-K', '--key'):
+            keyfile = a
+        elif o in ('-L', '--latency'):
+            options['latency'] = float(a)
+        elif o in ('-J', '--jitter'):
+            options['jitter'] = float(a)
+        elif o in ('-E', '--error-rate'):
+            options['error_rate'] = float(a)
+        elif o in ('-D', '--disconnect-rate'):
+            options['disconnect_rate'] = float(a)
+        elif o in ('-S', '--max-sessions'):
+            options['max_sessions'] = int(a)
+        elif o in ('-R', '--registered'):
+            registered = a.split(',')
+
+    server = SIDNEppFakeServer((address, port), certfile=certfile,
+                               keyfile=keyfile)
+    for k, v in options.items():
+        setattr(server, k, v)
+    for name in registered:
+        server.register(name)
+    log.info("fake EPP service on %s:%d" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
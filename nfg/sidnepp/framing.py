@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import socket
+import struct
+
+# every EPP frame starts with its total length, header included
+HEADER = struct.Struct(">L")
+
+BUFSIZE = 65536
+
+
+def frame(message):
+    """ message with its length header, ready to go out in one write
+
+    >>> frame('<epp/>')
+    '\\x00\\x00\\x00\\n<epp/>'
+    """
+    return HEADER.pack(len(message) + 4) + message
+
+
+def nodelay(sock):
+    """ disable Nagle: EPP is request/reply, and a small command held back
+    until the previous segment is acknowledged costs a delayed ACK """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (socket.error, AttributeError):
+        # not a TCP socket
+        pass
+
+
+def recv_exactly(sock, view):
+    """ fill a writable buffer (memoryview) from a blocking socket """
+    got = 0
+    size = len(view)
+    while got < size:
+        n = sock.recv_into(view[got:], size - got)
+        if not n:
+            raise IOError("connection closed by peer")
+        got += n
+
+
+class SIDNEppFrameReader(object):
+    """
+    reads frames from a blocking socket
+
+    Frames are received straight into one buffer that is kept between
+    reads and only grows when a larger frame comes along.
+
+    >>> a, b = socket.socketpair()
+    >>> a.sendall(frame('<epp/>') + frame('<epp>2</epp>'))
+    >>> r = SIDNEppFrameReader(b, size=8)
+    >>> r.read()
+    '<epp/>'
+    >>> r.read()
+    '<epp>2</epp>'
+    >>> a.close()
+    >>> r.read()
+    Traceback (most recent call last):
+    ...
+    IOError: connection closed by peer
+    """
+
+    def __init__(self, sock, size=BUFSIZE):
+        self.sock = sock
+        self._buf = bytearray(max(size, HEADER.size))
+
+    def read(self):
+        recv_exactly(self.sock, memoryview(self._buf)[:HEADER.size])
+        size = HEADER.unpack_from(self._buf)[0] - HEADER.size
+        if size < 0:
+            raise IOError("bad frame length %d" % (size + HEADER.size))
+        if size > len(self._buf):
+            self._buf = bytearray(size)
+        view = memoryview(self._buf)[:size]
+        recv_exactly(self.sock, view)
+        return view.tobytes()
+
+
+class SIDNEppFrameBuffer(object):
+    """
+    splits the bytes read from a non-blocking socket into frames
+
+    >>> b = SIDNEppFrameBuffer()
+    >>> data = frame('<epp/>') + frame('<epp>2</epp>')
+    >>> b.feed(data[:7])
+    []
+    >>> b.feed(data[7:])
+    ['<epp/>', '<epp>2</epp>']
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """ add received data, return the frames it completed """
+        self._buf += data
+        frames = []
+        pos = 0
+        end = len(self._buf)
+        view = memoryview(self._buf)
+        while end - pos >= HEADER.size:
+            size = HEADER.unpack_from(self._buf, pos)[0]
+            if size < HEADER.size:
+                raise IOError("bad frame length %d" % size)
+            if end - pos < size:
+                break
+            frames.append(view[pos + HEADER.size:pos + size].tobytes())
+            pos += size
+        # the buffer can't be resized while a view on it exists
+        del view
+        if pos:
+            del self._buf[:pos]
+        return frames
+
+    def __len__(self):
+        return len(self._buf)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
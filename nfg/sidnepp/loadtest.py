@@ -0,0 +1,349 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import time
+import socket
+import threading
+import itertools
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.client import SIDNEppClient
+
+import logging
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+log.addHandler(ch)
+
+
+def percentile(values, p):
+    """
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile(range(1, 101), 99)
+    99
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+# commands a session can be made of, see LoadTest.mix
+DOMAIN = dict(
+    ns=['ns1.nfg.nl', 'ns2.nfg.nl'],
+    owner='STE002126-NFGNT',
+    admin='STE002126-NFGNT',
+    tech='STE002126-NFGNT',
+)
+
+COMMANDS = {
+    'check': lambda c, name: c.domain_check(name),
+    'info': lambda c, name: c.domain_info(name),
+    'create': lambda c, name: c.domain_create(name, DOMAIN),
+    'poll': lambda c, name: c.poll(),
+}
+
+
+class LoadTest(object):
+    """
+    drive EPP sessions at a proxy or straight at an EPP service: each
+    session connects, logs in, issues `commands` commands, taking turns
+    through `mix`, and logs out again. `idle` extra connections are held
+    open, doing nothing, for the whole run.
+
+    Latencies are kept per command, and replies counted per result code.
+    A session that is refused or drops is counted in `errors`; the
+    commands it completed still count.
+    """
+
+    def __init__(self, host, port, username='loadtest', password='loadtest',
+                 connections=100, concurrency=10, commands=10, idle=0,
+                 mix=('check',), ssl=False):
+        for command in mix:
+            assert(command in COMMANDS)
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.connections = connections
+        self.concurrency = concurrency
+        self.commands = commands
+        self.idle = idle
+        self.mix = mix
+        self.ssl = ssl
+        self.latencies = {}
+        self.codes = {}
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._todo = connections
+        self._names = itertools.count()
+
+    def _take(self):
+        with self._lock:
+            if self._todo <= 0:
+                return False
+            self._todo -= 1
+            return True
+
+    def _record(self, command, elapsed, code):
+        with self._lock:
+            self.latencies.setdefault(command, []).append(elapsed)
+            self.codes[code] = self.codes.get(code, 0) + 1
+
+    def _session(self):
+        client = SIDNEppClient(self.host, self.port, self.username,
+                               self.password, ssl=self.ssl)
+        for i in range(self.commands):
+            command = self.mix[i % len(self.mix)]
+            # fresh names, so that creates succeed
+            name = 'loadtest-%d.nl' % self._names.next()
+            start = time.time()
+            reply = COMMANDS[command](client, name)
+            elapsed = time.time() - start
+            code = client.query(reply, '//epp:result/@code')
+            self._record(command, elapsed, code and code[0] or None)
+        client.logout()
+
+    def _worker(self):
+        while self._take():
+            try:
+                self._session()
+            except Exception, why:
+                log.debug("session failed: %r" % why)
+                with self._lock:
+                    self.errors += 1
+
+    def run(self):
+        idle = []
+        for i in range(self.idle):
+            idle.append(socket.create_connection((self.host, self.port)))
+        start = time.time()
+        workers = [threading.Thread(target=self._worker)
+                   for i in range(self.concurrency)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - start
+        for s in idle:
+            s.close()
+        latencies = sum(self.latencies.values(), [])
+        result = dict(
+            connections=self.connections,
+            errors=self.errors,
+            idle=self.idle,
+            seconds=elapsed,
+            cps=self.connections / elapsed,
+            commands=len(latencies),
+            throughput=len(latencies) / elapsed,
+            codes=self.codes,
+            latency=self._percentiles(latencies),
+            per_command=dict((c, self._percentiles(l))
+                             for c, l in self.latencies.items()),
+        )
+        # kept for callers of the earlier result layout
+        result['p50'] = result['latency']['p50']
+        result['p99'] = result['latency']['p99']
+        return result
+
+    def _percentiles(self, values):
+        return dict(
+            count=len(values),
+            p50=percentile(values, 50),
+            p90=percentile(values, 90),
+            p99=percentile(values, 99),
+            max=values and max(values) or None,
+        )
+
+
+def _ms(value):
+    return value is None and '-' or '%.2f' % (value * 1000)
+
+
+def report(result):
+    print "connections:     %(connections)d (%(errors)d failed, " \
+        "%(idle)d idle)" % result
+    print "elapsed:         %(seconds).2fs" % result
+    print "connections/s:   %(cps).1f" % result
+    print "commands:        %(commands)d" % result
+    print "commands/s:      %(throughput).1f" % result
+    if not result['commands']:
+        return
+    print "result codes:    %s" % ', '.join(
+        '%s: %d' % (c, n) for c, n in sorted(result['codes'].items()))
+    print
+    print "%-10s %8s %10s %10s %10s %10s" % ('latency', 'count', 'p50 ms',
+                                             'p90 ms', 'p99 ms', 'max ms')
+    rows = sorted(result['per_command'].items())
+    rows.append(('all', result['latency']))
+    for name, l in rows:
+        print "%-10s %8d %10s %10s %10s %10s" % (
+            name, l['count'], _ms(l['p50']), _ms(l['p90']), _ms(l['p99']),
+            _ms(l['max']))
+
+
+def usage():
+    print """
+
+load test for the SIDN EPP proxy, or for an EPP service itself
+
+usage:
+
+loadtest.py <options>
+
+options:
+
+  -a --address=<proxy address>              default: localhost
+  -l --port=<proxy port>                    default: 7000
+  -n --connections=<sessions to run>        default: 100
+  -c --concurrency=<concurrent sessions>    default: 10
+  -k --commands=<commands per session>      default: 10
+  -i --idle=<idle connections>              default: 0
+  -m --mix=<command,command..>              commands to take turns
+                                            through, out of check, info,
+                                            create and poll
+                                            default: check
+  -s --ssl                                  speak TLS to the EPP service
+  -f --fake                                 run against an in-process
+                                            proxy and fake EPP service
+  -t --threaded                             with --fake, use the threaded
+                                            proxy instead of the
+                                            asynchronous one
+  -d --direct                               with --fake, skip the proxy
+                                            and go straight at the fake
+                                            EPP service
+
+fake EPP service options, see fakeserver.py:
+
+  --cert=<file>                             certificate, for --ssl
+  --latency=<seconds>
+  --jitter=<seconds>
+  --error-rate=<fraction>
+  --disconnect-rate=<fraction>
+  --max-sessions=<sessions>
+
+  """
+
+if __name__ == '__main__':
+    import getopt
+
+    address = '127.0.0.1'
+    port = 7000
+    options = {}
+    faults = {}
+    fake = False
+    threaded = False
+    direct = False
+    certfile = None
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], "a:l:n:c:k:i:m:sftd", [
+            'address=',
+            'port=',
+            'connections=',
+            'concurrency=',
+            'commands=',
+            'idle=',
+            'mix=',
+            'ssl',
+            'fake',
+            'threaded',
+            'direct',
+            'cert=',
+            'latency=',
+            'jitter=',
+            'error-rate=',
+            'disconnect-rate=',
+            'max-sessions='])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+
+    for o, a in optlist:
+        if o in ('-a', '--address'):
+            address = a
+        elif o in ('-l', '--port'):
+            port = int(a)
+        elif o in ('-n', '--connections'):
+            options['connections'] = int(a)
+        elif o in ('-c', '--concurrency'):
+            options['concurrency'] = int(a)
+        elif o in ('-k', '--commands'):
+            options['commands'] = int(a)
+        elif o in ('-i', '--idle'):
+            options['idle'] = int(a)
+        elif o in ('-m', '--mix'):
+            options['mix'] = tuple(a.split(','))
+        elif o in ('-s', '--ssl'):
+            options['ssl'] = True
+        elif o in ('-f', '--fake'):
+            fake = True
+        elif o in ('-t', '--threaded'):
+            threaded = True
+        elif o in ('-d', '--direct'):
+            direct = True
+        elif o == '--cert':
+            certfile = a
+        elif o == '--latency':
+            faults['latency'] = float(a)
+        elif o == '--jitter':
+            faults['jitter'] = float(a)
+        elif o == '--error-rate':
+            faults['error_rate'] = float(a)
+        elif o == '--disconnect-rate':
+            faults['disconnect_rate'] = float(a)
+        elif o == '--max-sessions':
+            faults['max_sessions'] = int(a)
+
+    if fake:
+        # the handlers log every message
+        logging.disable(logging.INFO)
+        from nfg.sidnepp.fakeserver import SIDNEppFakeServer
+        upstream = SIDNEppFakeServer(('127.0.0.1', 0),
+                                     certfile=certfile).start()
+        for k, v in faults.items():
+            setattr(upstream, k, v)
+        address, port = upstream.server_address
+        proxy = None
+        if not direct:
+            if threaded:
+                from nfg.sidnepp.proxy import SIDNEppThreadingProxy
+                proxy = SIDNEppThreadingProxy(('127.0.0.1', 0))
+            else:
+                from nfg.sidnepp.asyncproxy import SIDNEppAsyncProxy
+                proxy = SIDNEppAsyncProxy(('127.0.0.1', 0),
+                                          max_connections=4096)
+            proxy.login(address, port, 'loadtest', 'loadtest',
+                        ssl=options.pop('ssl', False))
+            t = threading.Thread(target=proxy.serve_forever, args=(0.05,))
+            t.daemon = True
+            t.start()
+            address, port = proxy.server_address
+
+    report(LoadTest(address, port, **options).run())
+
+    if fake:
+        if proxy:
+            proxy.shutdown()
+            t.join()
+            proxy.logout()
+            proxy.server_close()
+        upstream.shutdown()
+        upstream.server_close()
+        # let the fake service see its clients go
+        time.sleep(0.1)
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import bisect
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.state import (
+    STATE_INIT,
+    STATE_CONNECTED,
+    STATE_SESSION,
+    STATE_LOGGEDIN
+)
+
+import logging
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+log.addHandler(ch)
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+
+STATES = (
+    (STATE_INIT, 'init'),
+    (STATE_CONNECTED, 'connected'),
+    (STATE_SESSION, 'session'),
+    (STATE_LOGGEDIN, 'loggedin'),
+)
+
+
+class Histogram(object):
+    """
+    >>> h = Histogram((0.1, 1.0))
+    >>> h.observe(0.05)
+    >>> h.observe(0.5)
+    >>> h.observe(5)
+    >>> h.cumulative()
+    [(0.1, 1), (1.0, 2), ('+Inf', 3)]
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        result = []
+        for le, n in zip(self.buckets, self.counts):
+            total += n
+            result.append((le, total))
+        result.append(('+Inf', self.count))
+        return result
+
+
+def _labels(**labels):
+    return '{%s}' % ','.join('%s="%s"' % (k, labels[k])
+                             for k in sorted(labels))
+
+
+class SIDNEppMetrics(object):
+    """
+    what a proxy did, in the Prometheus text format
+
+    Every command is recorded with its total time in the proxy, the parts
+    of that spent waiting for the rate limiter and on the remote EPP
+    service, and the result code of its reply. The state of the proxy
+    itself (sessions, queue, caches) is passed to render() as taken from
+    the proxy's status().
+
+    >>> m = SIDNEppMetrics()
+    >>> m.command('info', 0.012, 0.010, '1000')
+    >>> print m.render(dict(sessions={STATE_LOGGEDIN: 1}))
+    # HELP sidnepp_proxy_local_seconds ...
+    # TYPE sidnepp_proxy_local_seconds histogram
+    sidnepp_proxy_local_seconds_bucket{command="info",le="0.0005"} 0
+    ...
+    sidnepp_proxy_upstream_sessions{state="loggedin"} 1
+    ...
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._local = {}
+        self._upstream = {}
+        self._throttled = {}
+        self._codes = {}
+
+    def _observe(self, histograms, command, value):
+        h = histograms.get(command)
+        if h is None:
+            h = histograms[command] = Histogram(self.buckets)
+        h.observe(value)
+
+    def command(self, command, elapsed, upstream=0.0, code=None,
+                throttled=0.0):
+        """ record a command that took `elapsed` seconds, `upstream` of
+        which were spent on the remote EPP service and `throttled` waiting
+        for the rate limiter """
+        command = command or 'unknown'
+        with self._lock:
+            self._observe(self._local, command,
+                          max(elapsed - upstream - throttled, 0))
+            if upstream:
+                self._observe(self._upstream, command, upstream)
+            if throttled:
+                self._observe(self._throttled, command, throttled)
+            if code:
+                self._codes[code] = self._codes.get(code, 0) + 1
+
+    def _histograms(self, name, help, histograms):
+        lines = ["# HELP %s %s" % (name, help),
+                 "# TYPE %s histogram" % name]
+        for command in sorted(histograms):
+            h = histograms[command]
+            for le, n in h.cumulative():
+                lines.append("%s_bucket%s %d" % (
+                    name, _labels(command=command, le=le), n))
+            lines.append("%s_sum%s %f" % (name, _labels(command=command),
+                                          h.sum))
+            lines.append("%s_count%s %d" % (name, _labels(command=command),
+                                            h.count))
+        return lines
+
+    def _metric(self, name, kind, help, values):
+        lines = ["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, kind)]
+        for labels, value in values:
+            lines.append("%s%s %s" % (name, labels and _labels(**labels) or '',
+                                      value))
+        return lines
+
+    def render(self, status=None):
+        status = status or {}
+        with self._lock:
+            lines = self._histograms(
+                'sidnepp_proxy_local_seconds',
+                'Time spent in the proxy per command, upstream excluded.',
+                self._local)
+            lines += self._histograms(
+                'sidnepp_proxy_upstream_seconds',
+                'Round trip to the remote EPP service per command.',
+                self._upstream)
+            lines += self._histograms(
+                'sidnepp_proxy_throttled_seconds',
+                'Wait for a rate limit token per command.',
+                self._throttled)
+            lines += self._metric(
+                'sidnepp_proxy_results_total', 'counter',
+                'Replies sent, by EPP result code.',
+                [(dict(code=c), self._codes[c]) for c in sorted(self._codes)])
+
+        sessions = status.get('sessions', {})
+        lines += self._metric(
+            'sidnepp_proxy_upstream_sessions', 'gauge',
+            'Sessions to the remote EPP service, by state.',
+            [(dict(state=name), sessions.get(state, 0))
+             for state, name in STATES])
+        lines += self._metric(
+            'sidnepp_proxy_upstream_reconnects_total', 'counter',
+            'Sessions to the remote EPP service that were lost.',
+            [(None, status.get('reconnects', 0))])
+        lines += self._metric(
+            'sidnepp_proxy_queue_depth', 'gauge',
+            'Commands waiting for a free upstream session.',
+            [(None, status.get('queue', 0))])
+        lines += self._metric(
+            'sidnepp_proxy_connections', 'gauge',
+            'Open downstream connections.',
+            [(None, status.get('connections', 0))])
+        lines += self._metric(
+            'sidnepp_proxy_coalesced_total', 'counter',
+            'Reads answered with the reply to an identical read in flight.',
+            [(None, status.get('coalesced', 0))])
+
+        caches = status.get('caches', {})
+        for stat, kind, help in (
+                ('hits', 'counter', 'Commands answered from a cache.'),
+                ('misses', 'counter', 'Cache lookups that found nothing.'),
+                ('size', 'gauge', 'Entries in a cache.')):
+            name = 'sidnepp_proxy_cache_%s' % stat
+            if kind == 'counter':
+                name += '_total'
+            lines += self._metric(
+                name, kind, help,
+                [(dict(cache=c), caches[c][stat]) for c in sorted(caches)])
+        return '\n'.join(lines) + '\n'
+
+
+class SIDNEppMetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        proxy = self.server.proxy
+        if self.path == '/metrics':
+            self.respond(200, proxy.metrics.render(proxy.status()),
+                         'text/plain; version=0.0.4')
+        elif self.path == '/ready':
+            if proxy.ready():
+                self.respond(200, 'ready\n')
+            else:
+                self.respond(503, 'no upstream session logged in\n')
+        else:
+            self.respond(404, 'not found\n')
+
+    def respond(self, code, body, ctype='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class SIDNEppMetricsServer(ThreadingMixIn, HTTPServer):
+    """
+    local HTTP endpoint of a proxy: /metrics in the Prometheus text
+    format, and /ready, which only answers 200 while the proxy has at
+    least one upstream session logged in
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, (host, port), proxy):
+        self.proxy = proxy
+        HTTPServer.__init__(self, (host, port), SIDNEppMetricsHandler)
+
+    def start(self):
+        """ serve from a background thread """
+        t = threading.Thread(target=self.serve_forever,
+                             kwargs=dict(poll_interval=0.5))
+        t.daemon = True
+        t.start()
+        return self
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,324 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import time
+import socket
+import threading
+from contextlib import contextmanager
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from nfg.sidnepp.client import SIDNEppClient
+from nfg.sidnepp.state import STATE_LOGGEDIN
+
+import logging
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+log.addHandler(ch)
+
+# upper bound for the number of concurrent sessions we open upstream
+MAX_SESSIONS = 4
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class SIDNEppClientPool(object):
+    """
+    pool of logged-in sessions to the remote EPP service
+
+    Sessions are checked out exclusively, so a command and its reply
+    never interleave with another caller on the same session. When a
+    caller has to wait longer than `growwait` seconds for a free session
+    the pool opens a new one, up to `maxsize`. Sessions that have been
+    idle for more than `idletime` seconds are logged out again, down to
+    `minsize`.
+
+    The first `minsize` sessions are opened and logged in up front, in
+    parallel. With `keepalive` set, a background thread sends hello on
+    every idle session that has been quiet for that many seconds, so
+    that the server does not drop it, and opens new sessions when lost
+    ones leave fewer than `minsize`.
+    """
+
+    # factory for upstream sessions
+    client = SIDNEppClient
+
+    def __init__(self, host, port, username, password, ssl=True,
+                 minsize=1, maxsize=MAX_SESSIONS, growwait=0.1,
+                 idletime=60, keepalive=None):
+        assert(0 < minsize <= maxsize)
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.ssl = ssl
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.growwait = growwait
+        self.idletime = idletime
+        self.keepalive = keepalive
+
+        self._cond = threading.Condition()
+        self._idle = []     # stack of (idle since, session)
+        self._size = 0      # open sessions, including checked out ones
+        self._waited = 0.0  # moving average of the checkout wait time
+        self._waiting = 0   # callers waiting for a session
+        self._broken = 0    # sessions lost since the start
+
+        self._stopped = threading.Event()
+
+        self._size = minsize
+        self._warm(minsize)
+        if keepalive:
+            t = threading.Thread(target=self._maintain)
+            t.daemon = True
+            t.start()
+
+    def _warm(self, count):
+        """ open `count` sessions, whose slots were reserved, in parallel """
+        opened = []
+        failed = []
+
+        def connect():
+            try:
+                opened.append(self._open())
+            except Exception, why:
+                failed.append(why)
+
+        workers = [threading.Thread(target=connect) for i in range(count)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self._cond.acquire()
+        try:
+            self._size -= len(failed)
+            for client in opened:
+                self._push(client)
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if failed and not opened:
+            raise failed[0]
+        for why in failed:
+            log.debug("open session failed: %r" % why)
+
+    def _open(self):
+        log.debug("open session %d to %s:%s" % (
+            self._size, self.host, self.port))
+        return self.client(self.host, self.port, self.username,
+                           self.password, self.ssl)
+
+    def _close(self, client):
+        try:
+            if client.getState() == STATE_LOGGEDIN:
+                client.logout()
+            else:
+                client.close()
+        except (socket.error, IOError):
+            pass
+
+    def _push(self, client):
+        self._idle.append((time.time(), client))
+
+    def _reap(self):
+        """ pop sessions that have been idle for too long """
+        reaped = []
+        now = time.time()
+        while self._idle and self._size > self.minsize and \
+                now - self._idle[0][0] > self.idletime:
+            reaped.append(self._idle.pop(0)[1])
+            self._size -= 1
+        return reaped
+
+    def _record(self, waited):
+        self._waited = 0.9 * self._waited + 0.1 * waited
+
+    def acquire(self, timeout=None):
+        """ check out a logged-in session """
+        start = time.time()
+        self._cond.acquire()
+        try:
+            while not self._idle:
+                waited = time.time() - start
+                if waited >= self.growwait and self._size < self.maxsize:
+                    # reserve a slot, the session is opened below
+                    self._size += 1
+                    break
+                if timeout is not None and waited >= timeout:
+                    raise PoolTimeout("no free session after %.2fs" % waited)
+                wait = None
+                if self._size < self.maxsize:
+                    wait = self.growwait - waited
+                if timeout is not None:
+                    wait = min(wait or timeout, timeout - waited)
+                self._waiting += 1
+                try:
+                    self._cond.wait(wait)
+                finally:
+                    self._waiting -= 1
+            else:
+                client = self._idle.pop()[1]
+                self._record(time.time() - start)
+                return client
+        finally:
+            self._cond.release()
+
+        try:
+            client = self._open()
+        except:
+            self._cond.acquire()
+            self._size -= 1
+            self._cond.notify()
+            self._cond.release()
+            raise
+        self._record(time.time() - start)
+        return client
+
+    def release(self, client, broken=False):
+        """ return a session to the pool """
+        if broken or client.getState() != STATE_LOGGEDIN:
+            self._close(client)
+            client = None
+        self._cond.acquire()
+        try:
+            if client:
+                self._push(client)
+            else:
+                self._size -= 1
+                self._broken += 1
+            reaped = self._reap()
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        for c in reaped:
+            log.debug("close idle session to %s:%s" % (self.host, self.port))
+            self._close(c)
+
+    @contextmanager
+    def session(self, timeout=None):
+        client = self.acquire(timeout)
+        try:
+            yield client
+        except (socket.error, IOError):
+            self.release(client, broken=True)
+            raise
+        except:
+            self.release(client)
+            raise
+        self.release(client)
+
+    def write(self, message):
+        """ send a message on a free session and return the reply """
+        with self.session() as client:
+            return client.write(message)
+
+    def forward(self, message):
+        """ send a raw message on a free session and return the raw reply """
+        with self.session() as client:
+            return client.forward(message)
+
+    def maintain(self):
+        """ hello on idle sessions that have been quiet for `keepalive`
+        seconds, log out sessions idle for `idletime`, and top up to
+        `minsize` sessions """
+        self._cond.acquire()
+        try:
+            quiet = [(t, c) for t, c in self._idle
+                     if c.idle() >= self.keepalive]
+            # checked out for the hello, nobody else can take them
+            for entry in quiet:
+                self._idle.remove(entry)
+            reaped = self._reap()
+            missing = max(0, self.minsize - self._size)
+            self._size += missing
+        finally:
+            self._cond.release()
+        for c in reaped:
+            self._close(c)
+        alive = []
+        for t, client in quiet:
+            try:
+                client.keepalive()
+            except (socket.error, IOError), why:
+                log.debug("keepalive to %s:%s failed: %r" % (
+                    self.host, self.port, why))
+                self._close(client)
+            else:
+                # still idle since t, as far as reaping goes
+                alive.append((t, client))
+        self._cond.acquire()
+        try:
+            self._idle.extend(alive)
+            self._idle.sort(key=lambda entry: entry[0])
+            lost = len(quiet) - len(alive)
+            self._size -= lost
+            self._broken += lost
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+        if missing:
+            try:
+                self._warm(missing)
+            except Exception, why:
+                log.debug("top up failed: %r" % why)
+
+    def _maintain(self):
+        interval = max(self.keepalive / 4.0, 0.01)
+        while not self._stopped.wait(interval):
+            self.maintain()
+
+    def logout(self):
+        self._stopped.set()
+        self._cond.acquire()
+        try:
+            idle = [c for t, c in self._idle]
+            self._size -= len(idle)
+            self._idle = []
+        finally:
+            self._cond.release()
+        for c in idle:
+            self._close(c)
+
+    def stats(self):
+        self._cond.acquire()
+        try:
+            return dict(
+                size=self._size,
+                idle=len(self._idle),
+                busy=self._size - len(self._idle),
+                waited=self._waited,
+                waiting=self._waiting,
+                broken=self._broken,
+            )
+        finally:
+            self._cond.release()
+
+    def states(self):
+        """ number of sessions in each STATE_*; checked out sessions were
+        logged in when they were handed out """
+        self._cond.acquire()
+        try:
+            states = {STATE_LOGGEDIN: self._size - len(self._idle)}
+            for t, client in self._idle:
+                state = client.getState()
+                states[state] = states.get(state, 0) + 1
+            return states
+        finally:
+            self._cond.release()
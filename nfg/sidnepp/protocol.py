@@ -8,9 +8,18 @@
 #
 # Paul Stevens, paul@nfg.nl
 
+import os
+import re
+import time
+import itertools
 import lxml.etree as ET
 from lxml.builder import ElementMaker
 
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.framing import recv_exactly
+
 EPP_NS = 'urn:ietf:params:xml:ns:epp-1.0'
 HOST_NS = 'urn:ietf:params:xml:ns:host-1.0'
 DOMAIN_NS = 'urn:ietf:params:xml:ns:domain-1.0'
@@ -18,6 +27,126 @@ CONTACT_NS = 'urn:ietf:params:xml:ns:contact-1.0'
 SIDN_EXT_NS = 'http://rxsd.domain-registry.nl/sidn-ext-epp-1.0'
 XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
 
+# object type of the objects in each namespace
+OBJECTS = {
+    DOMAIN_NS: 'domain',
+    CONTACT_NS: 'contact',
+    HOST_NS: 'host',
+}
+
+HELLO = '<?xml version="1.0" encoding="UTF-8" standalone="no"?>' \
+    '<epp xmlns="urn:ietf:params:xml:ns:epp-1.0"><hello/></epp>'
+
+GREETING = """<?xml version="1.0" encoding="UTF-8"?>
+<epp xmlns="urn:ietf:params:xml:ns:epp-1.0">
+  <greeting>
+    <svID>drs.domain-registry.nl</svID>
+    <svDate>2008-12-03T14:00:17.372Z</svDate>
+    <svcMenu>
+      <version>1.0</version>
+      <lang>en</lang>
+      <lang>nl</lang>
+      <objURI>urn:ietf:params:xml:ns:contact-1.0</objURI>
+      <objURI>urn:ietf:params:xml:ns:domain-1.0</objURI>
+      <objURI>urn:ietf:params:xml:ns:host-1.0</objURI>
+      <svcExtension>
+        <extURI>http://rxsd.domain-registry.nl/sidn-ext-epp-1.0</extURI>
+      </svcExtension>
+    </svcMenu>
+    <dcp>
+      <access><all/></access>
+      <statement>
+        <purpose><admin/><prov/></purpose>
+        <recipient><ours/><public/></recipient>
+        <retention><stated/></retention>
+      </statement>
+    </dcp>
+  </greeting>
+</epp>
+"""
+
+_trid = {}
+
+# compiled XPath expressions, by expression
+_xpath = {}
+
+# start tags; skips the xml declaration, comments and end tags
+_TAG = re.compile(r"<(?:[\w.-]+:)?([\w.-]+)[\s/>]")
+_RESULT = re.compile(r"<(?:[\w.-]+:)?result\s+code=[\"'](\d+)")
+
+
+def _split(tag):
+    """ namespace and local name of a tag
+
+    >>> _split('{urn:ietf:params:xml:ns:epp-1.0}command')
+    ('urn:ietf:params:xml:ns:epp-1.0', 'command')
+    """
+    if not isinstance(tag, basestring):
+        # comments and processing instructions
+        return None, None
+    if tag[:1] == '{':
+        return tuple(tag[1:].split('}', 1))
+    return None, tag
+
+
+def new_trid(prefix='NFG'):
+    """ transaction id, unique across processes and restarts
+
+    >>> new_trid() != new_trid()
+    True
+    >>> new_trid('PROXY')
+    'PROXY-...-...'
+    """
+    pid = os.getpid()
+    if _trid.get('pid') != pid:
+        _trid.update(pid=pid, count=itertools.count(1),
+                     prefix='%x%x' % (int(time.time()), pid))
+    return '%s-%s-%d' % (prefix, _trid['prefix'], _trid['count'].next())
+
+
+def classify(message):
+    """ command name of a raw message, as describe() would give it, by
+    scanning its first start tags rather than parsing it. None if the
+    message doesn't look like EPP.
+
+    >>> classify('<?xml version="1.0"?><epp xmlns="urn:ietf:params:xml:'
+    ...          'ns:epp-1.0"><command><info><domain:info>...')
+    'info'
+    >>> classify('<epp><hello/></epp>')
+    'hello'
+    >>> classify('<epp><extension><sidn-ext-epp:command>'
+    ...          '<sidn-ext-epp:domainCancelDelete>...')
+    'domainCancelDelete'
+    >>> classify('garbage') is None
+    True
+    """
+    names = []
+    for m in _TAG.finditer(message):
+        names.append(m.group(1))
+        if len(names) == 4:
+            break
+    if len(names) < 2 or names[0] != 'epp':
+        return None
+    if names[1] in ('hello', 'greeting', 'response'):
+        return names[1]
+    if names[1] == 'command' and len(names) > 2:
+        return names[2]
+    if names[1:3] == ['extension', 'command'] and len(names) > 3:
+        return names[3]
+    return None
+
+
+def result_code(message):
+    """ result code of a raw response, or None
+
+    >>> result_code('<epp><response><result code="1000">...')
+    '1000'
+    >>> result_code('<epp><greeting>...') is None
+    True
+    """
+    m = _RESULT.search(message)
+    return m and m.group(1) or None
+
 
 class SIDNEppProtocol(object):
 
@@ -36,36 +165,39 @@ class SIDNEppProtocol(object):
         'xsi': XSI_NS,
     }
 
+    # element makers are stateless, so every instance shares them
+    e_epp = ElementMaker(
+        namespace=EPP_NS, nsmap={
+            None: EPP_NS,
+            'sidn-ext-epp': SIDN_EXT_NS,
+        }
+    )
+    e_xsi = ElementMaker(
+        namespace=EPP_NS, nsmap={
+            None: EPP_NS,
+            'xsi': XSI_NS,
+            'domain': DOMAIN_NS,
+        }
+    )
+
+    e_host = ElementMaker(namespace=HOST_NS, nsmap={'host': HOST_NS})
+    e_domain = ElementMaker(namespace=DOMAIN_NS, nsmap={'domain': DOMAIN_NS})
+    e_contact = ElementMaker(namespace=CONTACT_NS, nsmap={'contact':
+                                                          CONTACT_NS})
+    e_sidn = ElementMaker(
+        namespace=SIDN_EXT_NS,
+        nsmap={
+            'sidn-ext-epp': SIDN_EXT_NS
+        }
+    )
+
     def __init__(self):
-        self.e_epp = ElementMaker(
-            namespace=EPP_NS, nsmap={
-                None: EPP_NS,
-                'sidn-ext-epp': SIDN_EXT_NS,
-            }
-        )
-        self.e_xsi = ElementMaker(
-            namespace=EPP_NS, nsmap={
-                None: EPP_NS,
-                'xsi': XSI_NS,
-                'domain': DOMAIN_NS,
-            }
-        )
-
-        self.e_host = ElementMaker(namespace=HOST_NS, nsmap={'host': HOST_NS})
-        self.e_domain = ElementMaker(namespace=DOMAIN_NS, nsmap={'domain':
-                                                                 DOMAIN_NS})
-        self.e_contact = ElementMaker(namespace=CONTACT_NS, nsmap={'contact':
-                                                                   CONTACT_NS})
-        self.e_sidn = ElementMaker(
-            namespace=SIDN_EXT_NS,
-            nsmap={
-                'sidn-ext-epp': SIDN_EXT_NS
-            }
-        )
-
-    def render(self, element):
+        pass
+
+    def render(self, element, pretty=True):
+        """ serialize, indented for people or compact for the wire """
         return ET.tostring(element, encoding="UTF-8",
-                           pretty_print=True, standalone=False)
+                           pretty_print=pretty, standalone=False)
 
     def parse(self, message):
         try:
@@ -79,14 +211,113 @@ class SIDNEppProtocol(object):
             print "------------------------------------------------------"
 
     def query(self, element, query):
-        return element.xpath(query, namespaces=self.NSMAP)
+        xpath = _xpath.get(query)
+        if xpath is None:
+            xpath = _xpath[query] = ET.XPath(query, namespaces=self.NSMAP)
+        return xpath(element)
+
+    def get_cltrid(self, element):
+        """ clTRID of a command, or of the command a response answers """
+        r = self.query(element, "/epp:epp/epp:command/epp:clTRID/text()|"
+                       "/epp:epp/epp:response/epp:trID/epp:clTRID/text()|"
+                       "/epp:epp/epp:extension/sidn-ext-epp:command/"
+                       "sidn-ext-epp:clTRID/text()")
+        if r:
+            return r[0]
+
+    def set_cltrid(self, element, cltrid=None):
+        """ give a command, or a response, a clTRID
+
+        Without `cltrid` a fresh one is generated, unless the command has
+        one already. Returns the clTRID of the command, or None for
+        messages that are not commands (hello).
+        """
+        r = self.query(element, "/epp:epp/epp:response/epp:trID")
+        if r:
+            trid = r[0]
+            r = self.query(trid, "epp:clTRID")
+            if r:
+                r[0].text = cltrid
+            else:
+                ET.SubElement(trid, self.EPP + "clTRID").text = cltrid
+                trid.insert(0, trid[-1])
+            return cltrid
+
+        r = self.query(element, "/epp:epp/epp:command|"
+                       "/epp:epp/epp:extension/sidn-ext-epp:command")
+        if not r:
+            return None
+        command = r[0]
+        r = self.query(command, "epp:clTRID|sidn-ext-epp:clTRID")
+        if r:
+            if cltrid is None:
+                return r[0].text
+            r[0].text = cltrid
+            return cltrid
+        if cltrid is None:
+            cltrid = new_trid()
+        ET.SubElement(command, "{%s}clTRID" %
+                      ET.QName(command).namespace).text = cltrid
+        return cltrid
+
+    def describe(self, element):
+        """ command name, object type and object identifiers of a message
+
+        >>> p = SIDNEppProtocol()
+        >>> d = p.e_domain
+        >>> e = p.e_epp
+        >>> p.describe(e.epp(e.command(e.info(d.info(d.name('nfg.nl'))))))
+        ('info', 'domain', ['nfg.nl'])
+        >>> p.describe(e.epp(e.command(e.poll(op='req'))))
+        ('poll', None, [])
+        >>> p.describe(e.epp(e.hello()))
+        ('hello', None, [])
+        """
+        command = None
+        for child in element:
+            ns, tag = _split(child.tag)
+            if tag == 'command':
+                command = child
+            elif tag == 'extension' and command is None:
+                for c in child:
+                    if c.tag == self.SIDN_EXT + 'command':
+                        command = c
+                        break
+            elif tag in ('hello', 'greeting', 'response'):
+                return tag, None, []
+            if command is not None:
+                break
+        else:
+            return None, None, []
+
+        for child in command:
+            ns, name = _split(child.tag)
+            if name not in ('clTRID', 'extension'):
+                break
+        else:
+            return None, None, []
+        if ns == SIDN_EXT_NS:
+            # sidn extension commands work on domains
+            return name, 'domain', [n.text for n in child
+                                    if _split(n.tag)[1] == 'name']
+        if len(child) == 0:
+            return name, None, []
+        obj = child[0]
+        objtype = OBJECTS.get(_split(obj.tag)[0])
+        ids = [n.text for n in obj if _split(n.tag)[1] in ('name', 'id')]
+        return name, objtype, ids
+
+    # receive buffer of readall(), grown to the largest read so far
+    _readbuf = bytearray()
 
     def readall(self, sock, size):
-        got = ""
-        while size > 0:
-            buf = sock.recv(size)
-            got += buf
-            size -= len(buf)
-        ##print "readall:", len(got),":", repr(got)
-        return got
+        """ `size` bytes from a blocking socket
+
+        For whole frames, a SIDNEppFrameReader kept with the connection
+        does the same with the header in one go. """
+        if size > len(self._readbuf):
+            self._readbuf = bytearray(size)
+        view = memoryview(self._readbuf)[:size]
+        recv_exactly(sock, view)
+        return view.tobytes()
 
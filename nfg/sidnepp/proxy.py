@@ -8,16 +8,44 @@
 #
 # Paul Stevens, paul@nfg.nl
 
-import struct
+import time
+import socket
+import threading
+from copy import deepcopy
 from lxml import etree
-from SocketServer import TCPServer, BaseRequestHandler
+from SocketServer import TCPServer, ThreadingMixIn, BaseRequestHandler
 
 import sys
 import signal
 import os.path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
-from nfg.sidnepp.protocol import SIDNEppProtocol
-from nfg.sidnepp.client import SIDNEppClient
+from nfg.sidnepp.protocol import (
+    SIDNEppProtocol,
+    GREETING,
+    new_trid,
+    classify,
+    result_code
+)
+from nfg.sidnepp.client import SIDNEppError
+from nfg.sidnepp.pool import SIDNEppClientPool, MAX_SESSIONS
+from nfg.sidnepp.cache import SIDNEppInfoCache, SIDNEppCheckCache, TRANSFORM
+from nfg.sidnepp.framing import SIDNEppFrameReader, frame, nodelay
+from nfg.sidnepp import tls
+from nfg.sidnepp.metrics import SIDNEppMetrics, SIDNEppMetricsServer
+from nfg.sidnepp.ratelimit import SIDNEppRateLimiter, parse_rates
+from nfg.sidnepp.coalesce import (
+    SIDNEppSingleFlight,
+    READS,
+    flight_key,
+    find_cltrid,
+    substitute_cltrid,
+)
+from nfg.sidnepp.scheduler import (
+    SIDNEppFairScheduler,
+    parse_weights,
+    parse_priorities,
+)
+from nfg.sidnepp.state import STATE_LOGGEDIN
 
 import logging
 log = logging.getLogger(__name__)
@@ -35,38 +63,59 @@ def handle_pdb(sig, frame):
     pdb.Pdb().set_trace(frame)
 
 
-class SIDNEppProxyHandler(BaseRequestHandler, SIDNEppProtocol):
-
-    def _handle_hello(self, req):
-        xml = """<?xml version="1.0" encoding="UTF-8"?>
-        <epp xmlns="urn:ietf:params:xml:ns:epp-1.0">
-        <greeting>
-        <svID>drs.domain-registry.nl</svID>
-        <svDate>2008-12-03T14:00:17.372Z</svDate>
-        <svcMenu>
-        <version>1.0</version>
-        <lang>en</lang>
-        <lang>nl</lang>
-        <objURI>urn:ietf:params:xml:ns:contact-1.0</objURI>
-        <objURI>urn:ietf:params:xml:ns:domain-1.0</objURI>
-        <objURI>urn:ietf:params:xml:ns:host-1.0</objURI>
-        <svcExtension>
-        <extURI>http://rxsd.domain-registry.nl/sidn-ext-epp-1.0</extURI>
-        </svcExtension>
-        </svcMenu>
-        <dcp>
-        <access><all/></access>
-        <statement><purpose><admin/><prov/></purpose>
-        <recipient><ours/><public/></recipient>
-        <retention><stated/></retention>
-        </statement>
-        </dcp>
-        </greeting>
-        </epp>
-        """
-        self.write(xml)
+class SIDNEppLocalHandler(SIDNEppProtocol):
+    """
+    session commands the proxy answers locally, without bothering the
+    remote EPP service. Subclasses provide write() and
+    _handle_command(), which gets every command not in `commands`.
+    """
+
+    # command name -> method answering it, see dispatch()
+    commands = {
+        'hello': '_handle_hello',
+        'login': '_handle_login',
+        'logout': '_handle_logout',
+    }
+
+    # set once the client logged out
+    done = False
+
+    # clID the client logged in with
+    clid = None
 
-    def _handle_login(self, r):
+    def dispatch(self, req, description=None):
+        """ hand a parsed message to the method registered for its
+        command. The command is found from the children of the root,
+        without searching the tree. """
+        if description is None:
+            description = self.describe(req)
+        name = self.commands.get(description[0], '_handle_command')
+        return getattr(self, name)(req, description)
+
+    def _handle_command(self, req, description):
+        raise NotImplementedError
+
+    def _handle_hello(self, req, description=None):
+        self.write(GREETING)
+
+    def _build_trid(self, r):
+        """ echo the client's clTRID, along with a fresh svTRID """
+        e = self.e_epp
+        trid = [e.svTRID(new_trid('PROXY'))]
+        cltrid = r is not None and self.get_cltrid(r)
+        if cltrid:
+            trid.insert(0, e.clTRID(cltrid))
+        return e.trID(*trid)
+
+    def identity(self):
+        """ who the client is, for scheduling: the clID it logged in
+        with, or else its address """
+        return self.clid or self.client_address[0]
+
+    def _handle_login(self, r, description=None):
+        clid = r is not None and self.query(r, "//epp:login/epp:clID/text()")
+        if clid:
+            self.clid = clid[0]
         e = self.e_epp
         x = e.epp(
             e.response(
@@ -74,51 +123,169 @@ class SIDNEppProxyHandler(BaseRequestHandler, SIDNEppProtocol):
                     e.msg('The transaction was completed successfully.'),
                     code='1000'
                 ),
-                e.trID(
-                    e.clTRID('1234'),
-                    e.svTRID('1234')
-                )
+                self._build_trid(r)
             )
         )
         self.write(x)
 
-    def _handle_logout(self, r):
+    def _handle_logout(self, r, description=None):
         e = self.e_epp
         x = e.epp(
             e.response(
                 e.result(e.msg('You are now logged off.'), code='1500'),
-                e.trID(
-                    e.svTRID('1234')
-                )
+                self._build_trid(r)
+            )
+        )
+        self.write(x)
+        self.done = True
+
+    def _handle_error(self, r, code='2400', msg='Command failed'):
+        e = self.e_epp
+        x = e.epp(
+            e.response(
+                e.result(e.msg(msg), code=code),
+                self._build_trid(r)
             )
         )
         self.write(x)
 
+
+class SIDNEppProxyHandler(BaseRequestHandler, SIDNEppLocalHandler):
+
+    # seconds the current command waited for the rate limiter
+    _throttled = 0.0
+
     def handle(self):
         SIDNEppProtocol.__init__(self)
+        nodelay(self.request)
+        self._reader = SIDNEppFrameReader(self.request)
         # first read the incoming message from the client
         log.debug("handle %s" % self.client_address[0])
         while 1:
             try:
-                req = self.read()
+                buf = self._reader.read()
             except:  # client hung up
                 break
-            if self.query(req, '//epp:hello'):
-                self._handle_hello(req)
-            elif self.query(req, '//epp:login'):
-                self._handle_login(req)
-            elif self.query(req, '//epp:logout'):
-                self._handle_logout(req)
+            started = time.time()
+            self._upstream = self._throttled = 0.0
+            self._code = None
+            command = classify(buf)
+            more = self._handle(buf, command)
+            self.server.metrics.command(command, time.time() - started,
+                                        self._upstream, self._code,
+                                        self._throttled)
+            if not more:
                 break
-            else:
-                # write this message to the server
-                # and post back the reply to the client
-                self.write(self.server.client.write(req))
+
+    def _handle(self, buf, command):
+        """ answer one message, False once the session is over """
+        self._command = command
+        if command and command not in self.commands and \
+                self.server.passthrough and not self.server.caches():
+            self.passthrough(buf)
+            return True
+        req = self.parse(buf)
+        log.debug("read %s" % buf)
+        if req is None:
+            self._handle_error(req, '2001', 'Command syntax error')
+        else:
+            self.dispatch(req)
+        return not self.done
+
+    def _handle_command(self, req, description):
+        # write this message to the server
+        # and post back the reply to the client
+        try:
+            reply = self.forward(req, description)
+        except (socket.error, IOError, SIDNEppError), why:
+            log.debug("forward failed: %r" % why)
+            self._handle_error(req)
+            return
+        self.write(reply)
+
+    def _call(self, method, message):
+        """ run a client method on a pooled session, once the rate
+        limiter lets it through, timing the part spent on the remote EPP
+        service """
+        limiter = self.server.limiter
+        if limiter:
+            self._throttled += limiter.wait(self._command)
+        scheduler = self.server.scheduler
+        if scheduler is None:
+            return self._session(method, message)
+        with scheduler.turn(self.identity(), self._command):
+            return self._session(method, message)
+
+    def _shared(self, method, message):
+        """ _call(), unless an identical read from another connection is
+        in flight: then wait for its reply, and answer with a copy that
+        carries our own clTRID. `_sent` is set to when the reply was
+        asked for, by whichever connection asked. """
+        server = self.server
+        self._sent = time.time()
+        if self._command in TRANSFORM:
+            # reads in flight may have started before the change: later
+            # reads must not share their replies
+            try:
+                return self._call(method, message)
+            finally:
+                server.flights.forget()
+        if not server.coalesce or self._command not in READS:
+            return self._call(method, message)
+        raw = message
+        if method != 'forward':
+            raw = etree.tostring(message)
+        # raw and parsed replies do not mix: the method is part of the key
+        reply, leader, self._sent = server.flights.run(
+            (method, flight_key(raw, self._command)),
+            lambda: self._call(method, message))
+        if leader:
+            return reply
+        if method == 'forward':
+            return substitute_cltrid(reply, find_cltrid(message))
+        reply = deepcopy(reply)
+        cltrid = self.get_cltrid(message)
+        if cltrid:
+            self.set_cltrid(reply, cltrid)
+        return reply
+
+    def _session(self, method, message):
+        with self.server.pool.session() as client:
+            started = time.time()
+            try:
+                return getattr(client, method)(message)
+            finally:
+                self._upstream += time.time() - started
+
+    def passthrough(self, buf):
+        """ forward the original bytes, and send back the reply as is """
+        try:
+            reply = self._shared('forward', buf)
+        except (socket.error, IOError, SIDNEppError), why:
+            log.debug("forward failed: %r" % why)
+            self._handle_error(self.parse(buf))
+            return
+        self._code = result_code(reply)
+        self.request.sendall(frame(reply))
+
+    def forward(self, req, description=None):
+        caches = self.server.caches()
+        if not caches:
+            return self._shared('write', req)
+        if description is None:
+            description = self.describe(req)
+        for cache in caches:
+            reply = cache.lookup(req, description)
+            if reply is not None:
+                return reply
+        reply = self._shared('write', req)
+        for cache in caches:
+            cache.update(req, reply, description, self._sent)
+        return reply
 
     def read(self):
         log.debug("reading...")
-        buf = self.readall(self.request, 4)
-        buf = self.readall(self.request, struct.unpack(">L", buf)[0] - 4)
+        buf = self._reader.read()
         log.debug("reading done.")
         msg = self.parse(buf)
         log.debug("read %s" % self.render(msg))
@@ -130,8 +297,8 @@ class SIDNEppProxyHandler(BaseRequestHandler, SIDNEppProtocol):
         else:
             self.parse(message)
         log.debug("write %s" % message)
-        self.request.sendall(struct.pack(">L", len(message) + 4))
-        self.request.sendall(message)
+        self._code = result_code(message)
+        self.request.sendall(frame(message))
 
 
 class SIDNEppProxy(TCPServer):
@@ -152,27 +319,133 @@ class SIDNEppProxy(TCPServer):
     """
     allow_reuse_address = True
 
-    # the remote EPP server connection
-    client = None
+    # the pool of remote EPP server sessions
+    pool = None
+
+    # SIDNEppInfoCache for info responses, if any
+    cache = None
+
+    # SIDNEppCheckCache for check results, if any
+    checks = None
+
+    # forward commands without parsing them, unless a cache needs to
+    # look inside
+    passthrough = True
+
+    # SIDNEppRateLimiter for commands to the remote EPP service, if any
+    limiter = None
+
+    # weight per downstream client (clID or address), default 1, and
+    # priority per command class, see SIDNEppFairQueue
+    weights = None
+    priorities = None
+
+    # SIDNEppFairScheduler taking turns on the upstream sessions, set up
+    # at login
+    scheduler = None
+
+    # let identical reads in flight at the same time share one round
+    # trip, see SIDNEppSingleFlight
+    coalesce = True
+
+    # downstream connections being served
+    _connections = 0
 
     def __init__(self, (host, port), handler=None):
         signal.signal(signal.SIGUSR1, handle_pdb)
         if not handler:
             handler = SIDNEppProxyHandler
+        self.metrics = SIDNEppMetrics()
+        self.flights = SIDNEppSingleFlight()
         TCPServer.__init__(self, (host, port), handler)
 
-    def login(self, remote_host, remote_port, username, password):
-        """setup connection to remote EPP service
+    def login(self, remote_host, remote_port, username, password,
+              sessions=1, maxsessions=MAX_SESSIONS, ssl=True,
+              keepalive=None):
+        """setup connections to remote EPP service: `sessions` are
+        logged in up front, and kept alive with a hello every
+        `keepalive` seconds
+        """
+        self.pool = SIDNEppClientPool(remote_host, remote_port,
+                                      username, password, ssl=ssl,
+                                      minsize=sessions,
+                                      maxsize=max(sessions, maxsessions),
+                                      keepalive=keepalive)
+        self.scheduler = SIDNEppFairScheduler(self.pool.maxsize, self.weights,
+                                              self.priorities)
+        with self.pool.session() as client:
+            return client._login
+
+    def logout(self):
+        """close all connections to remote EPP service
         """
-        self.client = SIDNEppClient(remote_host, remote_port,
-                                    username, password)
-        return self.client._login
+        if self.pool:
+            self.pool.logout()
+
+    def caches(self):
+        return [c for c in (self.cache, self.checks) if c is not None]
+
+    def status(self):
+        """ upstream sessions, queue and caches, for the metrics """
+        pool = self.pool and self.pool.stats() or {}
+        return dict(
+            sessions=self.pool and self.pool.states() or {},
+            queue=pool.get('waiting', 0) + (
+                self.scheduler and self.scheduler.waiting() or 0),
+            reconnects=pool.get('broken', 0),
+            connections=self._connections,
+            coalesced=self.flights.coalesced,
+            caches=dict((name, c.stats()) for name, c in (
+                ('info', self.cache), ('check', self.checks)) if c),
+        )
+
+    def ready(self):
+        """ whether at least one upstream session is logged in """
+        return self.status()['sessions'].get(STATE_LOGGEDIN, 0) > 0
 
     def handle_timeout(self):
         print "proxy timeout"
         #raise IOError("request timeout")
 
 
+class SIDNEppThreadingProxy(ThreadingMixIn, SIDNEppProxy):
+    """
+    serve each downstream connection in its own thread
+
+    Commands from all connections share the upstream session pool. At
+    most `max_connections` downstream connections are served at once,
+    further connections wait in the listen backlog until a slot frees up.
+    """
+    daemon_threads = True
+    max_connections = 64
+
+    def __init__(self, (host, port), handler=None, max_connections=None):
+        if max_connections:
+            self.max_connections = max_connections
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self._lock = threading.Lock()
+        SIDNEppProxy.__init__(self, (host, port), handler)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            ThreadingMixIn.process_request(self, request, client_address)
+        except:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        with self._lock:
+            self._connections += 1
+        try:
+            ThreadingMixIn.process_request_thread(self, request,
+                                                  client_address)
+        finally:
+            with self._lock:
+                self._connections -= 1
+            self._slots.release()
+
+
 def usage():
     print """
 
@@ -190,13 +463,48 @@ options:
   -p <port> --port=<epp server>             default: 700
   -u <username> --username=<epp username>
   -w <password> --password=<epp password>
+  -n <sessions> --sessions=<sessions>       default: 1
+  -m <sessions> --max-sessions=<sessions>   default: %d
+  -A --keepalive=<seconds>                  hello on sessions that have
+                                            been idle this long, default:
+                                            0 (off)
+  --cafile=<file>                           verify the EPP server against
+                                            these CA certificates
+  --certfile=<file>                         client certificate
+  --keyfile=<file>                          key of the client certificate,
+                                            if not in --certfile
 
     parameters for setting up local proxy service:
 
   -a --address=<listen to address>          default: localhost
   -l --listen=<listen to port>              default: 7000
-
-  """
+  -c --connections=<connections>            default: %d
+  -t --info-ttl=<seconds>                   cache info responses,
+                                            default: 0 (off)
+  -k --check-ttl=<seconds>                  cache "available" check
+                                            results, default: 0 (off)
+  -K --taken-ttl=<seconds>                  cache "taken" check results,
+                                            default: 0 (off)
+  -x --parse                                parse every forwarded command,
+                                            instead of passing it through
+  -r --rate=<class>:<per second>[,...]      commands per second upstream,
+                                            per class: check, info,
+                                            transform or poll. default:
+                                            no limit
+  -W --weight=<client>:<weight>[,...]       share of the upstream per
+                                            downstream clID or address,
+                                            default: 1 each
+  -P --priority=<class>:<level>[,...]       priority per command class,
+                                            lower goes first. default:
+                                            transform:0,info:1,check:1,
+                                            poll:1
+  --no-coalesce                             send every check and info
+                                            upstream, also while an
+                                            identical one is in flight
+  -M --metrics=<port>                       serve /metrics and /ready over
+                                            HTTP on this port, default: off
+
+  """ % (MAX_SESSIONS, SIDNEppThreadingProxy.max_connections)
 
 if __name__ == '__main__':
     import getopt
@@ -206,45 +514,137 @@ if __name__ == '__main__':
     port = 700
     username = False
     password = False
+    sessions = 1
+    maxsessions = MAX_SESSIONS
+    keepalive = None
+    cafile = certfile = keyfile = None
 
     address = '127.0.0.1'
     listen = 7000
+    connections = None
+    infottl = 0
+    checkttl = takenttl = 0
+    passthrough = True
+    metrics = None
+    rates = None
+    weights = priorities = None
+    coalesce = True
 
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], "s:p:u:w:a:l", [
+        optlist, args = getopt.getopt(sys.argv[1:], "s:p:u:w:n:m:A:a:l:c:t:k:K:xr:W:P:M:", [
             'server=',
             'port=',
             'username=',
             'password=',
+            'sessions=',
+            'max-sessions=',
+            'keepalive=',
+            'cafile=',
+            'certfile=',
+            'keyfile=',
             'address=',
-            'listen='])
+            'listen=',
+            'connections=',
+            'info-ttl=',
+            'check-ttl=',
+            'taken-ttl=',
+            'parse',
+            'rate=',
+            'weight=',
+            'priority=',
+            'no-coalesce',
+            'metrics='])
     except getopt.GetoptError, err:
         print str(err)
         usage()
         sys.exit(2)
 
     for o, a in optlist:
-        if o == '--server':
+        if o in ('-s', '--server'):
             server = a
-        if o == '--port':
+        elif o in ('-p', '--port'):
             port = int(a)
-        elif o == '--username':
+        elif o in ('-u', '--username'):
             username = a
-        elif o == '--password':
+        elif o in ('-w', '--password'):
             password = a
-        elif o == '--address':
+        elif o in ('-n', '--sessions'):
+            sessions = int(a)
+        elif o in ('-m', '--max-sessions'):
+            maxsessions = int(a)
+        elif o in ('-A', '--keepalive'):
+            keepalive = float(a) or None
+        elif o == '--cafile':
+            cafile = a
+        elif o == '--certfile':
+            certfile = a
+        elif o == '--keyfile':
+            keyfile = a
+        elif o in ('-a', '--address'):
             address = a
-        elif o == '--listen':
+        elif o in ('-l', '--listen'):
             listen = int(a)
+        elif o in ('-c', '--connections'):
+            connections = int(a)
+        elif o in ('-t', '--info-ttl'):
+            infottl = int(a)
+        elif o in ('-k', '--check-ttl'):
+            checkttl = int(a)
+        elif o in ('-K', '--taken-ttl'):
+            takenttl = int(a)
+        elif o in ('-x', '--parse'):
+            passthrough = False
+        elif o in ('-r', '--rate'):
+            try:
+                rates = parse_rates(a)
+            except ValueError, err:
+                print str(err)
+                usage()
+                sys.exit(2)
+        elif o in ('-W', '--weight'):
+            try:
+                weights = parse_weights(a)
+            except ValueError, err:
+                print str(err)
+                usage()
+                sys.exit(2)
+        elif o in ('-P', '--priority'):
+            try:
+                priorities = parse_priorities(a)
+            except ValueError, err:
+                print str(err)
+                usage()
+                sys.exit(2)
+        elif o == '--no-coalesce':
+            coalesce = False
+        elif o in ('-M', '--metrics'):
+            metrics = int(a)
 
     if not (username and password):
         usage()
         sys.exit(2)
 
     print "Starting SIDNEppProxy"
-    proxy = SIDNEppProxy((address, listen))
+    proxy = SIDNEppThreadingProxy((address, listen),
+                                  max_connections=connections)
+    if infottl:
+        proxy.cache = SIDNEppInfoCache(ttl=infottl)
+    if checkttl or takenttl:
+        proxy.checks = SIDNEppCheckCache(avail_ttl=checkttl,
+                                         taken_ttl=takenttl)
+    proxy.passthrough = passthrough
+    if rates:
+        proxy.limiter = SIDNEppRateLimiter(rates)
+    proxy.weights = weights
+    proxy.priorities = priorities
+    proxy.coalesce = coalesce
+    if metrics:
+        SIDNEppMetricsServer((address, metrics), proxy).start()
+        print "Metrics on: %s:%d" % (address, metrics)
     proxy.timeout = 4
-    proxy.login(server, port, username, password)
+    proxy.login(server, port, username, password, sessions, maxsessions,
+                ssl=tls.context(cafile, certfile, keyfile),
+                keepalive=keepalive)
     print "Connected to: %s:%d" % (server, port)
     print "Listen on: %s:%d" % (address, listen)
     proxy.serve_forever()
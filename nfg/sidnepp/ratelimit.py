@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import time
+import threading
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.cache import TRANSFORM
+
+# the classes commands are limited by
+CLASSES = ('check', 'info', 'transform', 'poll')
+
+
+def command_class(command):
+    """ class of a command as classify() names it, None for commands
+    that are not limited
+
+    >>> command_class('check'), command_class('domainCancelDelete')
+    ('check', 'transform')
+    >>> command_class('hello') is None
+    True
+    """
+    if command in TRANSFORM:
+        return 'transform'
+    if command in CLASSES:
+        return command
+    return None
+
+
+def parse_rates(text):
+    """ rates per class from the command line
+
+    >>> sorted(parse_rates('check:10,transform:0.5').items())
+    [('check', 10.0), ('transform', 0.5)]
+    >>> parse_rates('whois:1')
+    Traceback (most recent call last):
+    ...
+    ValueError: unknown command class: whois
+    >>> parse_rates('check:0')
+    Traceback (most recent call last):
+    ...
+    ValueError: rate of check must be more than 0: 0
+    """
+    rates = {}
+    for item in text.split(','):
+        name, rate = item.split(':')
+        name = name.strip()
+        if name not in CLASSES:
+            raise ValueError("unknown command class: %s" % name)
+        rates[name] = float(rate)
+        if rates[name] <= 0:
+            raise ValueError("rate of %s must be more than 0: %s" % (
+                name, rate.strip()))
+    return rates
+
+
+class TokenBucket(object):
+    """
+    `rate` tokens per second, of which at most `burst` can be saved up
+
+    reserve() takes a token right away, also when there is none yet, and
+    says how long to wait before using it. Callers are served in the
+    order they reserved, at the rate, however many arrive at once.
+
+    >>> b = TokenBucket(rate=10, burst=1)
+    >>> b.reserve()
+    0.0
+    >>> 0.09 < b.reserve() <= 0.1
+    True
+    >>> 0.19 < b.reserve() <= 0.2
+    True
+    """
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0 or burst <= 0:
+            raise ValueError("rate and burst must be more than 0")
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class SIDNEppRateLimiter(object):
+    """
+    commands per second to the remote EPP service, per command class
+
+    `rates` maps the classes in CLASSES to commands per second; classes
+    that are not in it, and commands without a class, are not limited.
+
+    >>> l = SIDNEppRateLimiter(dict(check=100))
+    >>> l.delay('check'), l.delay('info')
+    (0.0, 0.0)
+    >>> 0 < l.delay('check') <= 0.01
+    True
+    """
+
+    def __init__(self, rates, burst=1):
+        self.rates = rates
+        self._buckets = dict((name, TokenBucket(rate, burst))
+                             for name, rate in rates.items())
+
+    def delay(self, command):
+        """ take a token for `command`, return the seconds to wait before
+        sending it """
+        bucket = self._buckets.get(command_class(command))
+        if bucket is None:
+            return 0.0
+        return bucket.reserve()
+
+    def wait(self, command):
+        """ take a token for `command` and wait for it, return the seconds
+        waited """
+        delay = self.delay(command)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import re
+import time
+import random
+import threading
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.protocol import classify
+
+# result codes that say the server is in trouble rather than anything
+# about the command: it is sent again on a new session, and they count
+# towards opening the circuit
+UNAVAILABLE = (
+    '2500',     # command failed; server closing connection
+    '2502',     # session limit exceeded; server closing connection
+)
+
+# result codes worth sending the command again for. 2400 may come after
+# the command was carried out, so it is only sent again if that is
+# harmless, see idempotent(). Any other 2xxx code is an answer about
+# the command itself, and sending it again gets the same answer.
+RETRYABLE = ('2400',) + UNAVAILABLE
+
+# commands that may be sent twice without doing more than once
+IDEMPOTENT = frozenset(['hello', 'login', 'check', 'info', 'poll'])
+
+_POLL_ACK = re.compile(r"""<(?:[\w.-]+:)?poll\b[^>]*\bop=["']ack""")
+
+# result codes after which the server closes the connection
+CLOSING = ('2500', '2501', '2502')
+
+_breakers = {}
+_lock = threading.Lock()
+
+
+def idempotent(message):
+    """ whether a raw command may be sent again after it got no answer,
+    or a 2400
+
+    >>> idempotent('<epp><command><info><domain:info>...')
+    True
+    >>> idempotent('<epp><command><renew><domain:renew>...')
+    False
+    >>> idempotent('<epp><command><poll op="ack" msgID="1"/>...')
+    False
+    """
+    command = classify(message)
+    if command == 'poll':
+        return not _POLL_ACK.search(message)
+    return command in IDEMPOTENT
+
+
+def retryable(code, safe=False):
+    """ whether a command answered with `code` is worth sending again;
+    `safe` if sending it twice is harmless
+
+    >>> retryable('2400', safe=True), retryable('2400'), retryable('2502')
+    (True, False, True)
+    >>> retryable('2303', safe=True), retryable('1000')
+    (False, False)
+    """
+    if code in UNAVAILABLE:
+        return True
+    return safe and code in RETRYABLE
+
+
+def backoff(attempt, base=0.1, cap=5.0):
+    """ seconds to wait before retry number `attempt` (from 0): random
+    between 0 and base * 2 ** attempt, capped, so that clients that
+    failed together don't come back together
+
+    >>> 0 <= backoff(3, base=0.1) <= 0.8
+    True
+    >>> backoff(30, cap=5.0) <= 5.0
+    True
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitOpen(IOError):
+    """ the server failed too often lately to try it now """
+
+
+class SIDNEppCircuitBreaker(object):
+    """
+    stops talking to a server that keeps failing
+
+    After `threshold` failures in a row the circuit opens, and every
+    call fails at once with CircuitOpen for `reset` seconds. Then a
+    single call is let through: if it succeeds the circuit closes,
+    otherwise it stays open for another `reset` seconds.
+
+    >>> b = SIDNEppCircuitBreaker(threshold=2, reset=0.05)
+    >>> b.failure(); b.failure()
+    >>> b.allow()
+    Traceback (most recent call last):
+    ...
+    CircuitOpen: circuit open after 2 failures
+    >>> time.sleep(0.05)
+    >>> b.allow()
+    >>> b.allow()
+    Traceback (most recent call last):
+    ...
+    CircuitOpen: circuit open after 2 failures
+    >>> b.success()
+    >>> b.allow()
+    """
+
+    def __init__(self, threshold=5, reset=30.0):
+        self.threshold = threshold
+        self.reset = reset
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._until = 0
+        self._trial = False
+
+    def allow(self):
+        """ raise CircuitOpen unless a call may go ahead """
+        with self._lock:
+            if self._failures < self.threshold:
+                return
+            if self._trial or time.time() < self._until:
+                raise CircuitOpen("circuit open after %d failures" %
+                                  self._failures)
+            # half open: let one call find out whether the server is back
+            self._trial = True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._failures >= self.threshold:
+                self._until = time.time() + self.reset
+
+    def closed(self):
+        with self._lock:
+            return self._failures < self.threshold
+
+
+def breaker(host, port, threshold=5, reset=30.0):
+    """ the circuit breaker shared by all sessions to a server """
+    with _lock:
+        b = _breakers.get((host, port))
+        if b is None:
+            b = _breakers[(host, port)] = SIDNEppCircuitBreaker(threshold,
+                                                                reset)
+        return b
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.ratelimit import command_class, CLASSES
+
+# priority per command class, lower goes first: changes made on behalf
+# of a customer go ahead of lookups
+PRIORITIES = {
+    'transform': 0,
+    'poll': 1,
+    'info': 1,
+    'check': 1,
+}
+# priority of commands without a class
+DEFAULT_PRIORITY = 1
+
+
+def parse_weights(text):
+    """ weights per downstream client from the command line
+
+    >>> sorted(parse_weights('bulk:1,portal:4').items())
+    [('bulk', 1.0), ('portal', 4.0)]
+    >>> parse_weights('bulk:0')
+    Traceback (most recent call last):
+    ...
+    ValueError: weight of bulk must be more than 0: 0
+    """
+    weights = {}
+    for item in text.split(','):
+        name, weight = item.rsplit(':', 1)
+        name = name.strip()
+        weights[name] = float(weight)
+        if weights[name] <= 0:
+            raise ValueError("weight of %s must be more than 0: %s" % (
+                name, weight.strip()))
+    return weights
+
+
+def parse_priorities(text):
+    """ priorities per command class from the command line
+
+    >>> sorted(parse_priorities('transform:0,info:2').items())
+    [('info', 2), ('transform', 0)]
+    """
+    priorities = {}
+    for item in text.split(','):
+        name, level = item.split(':')
+        name = name.strip()
+        if name not in CLASSES:
+            raise ValueError("unknown command class: %s" % name)
+        priorities[name] = int(level)
+    return priorities
+
+
+class SIDNEppFairQueue(object):
+    """
+    commands waiting for an upstream session, from many downstream
+    clients
+
+    Commands of a higher priority (a lower number, see PRIORITIES) always
+    go first. Within a priority, clients take turns by weighted fair
+    queuing: every command is stamped with a virtual finish time, its
+    client's previous stamp (or the current virtual time, if later) plus
+    1 / weight, and the lowest stamp goes first. A client with weight 2
+    gets twice the turns of a client with weight 1, and a client that
+    queues thousands of commands does not hold up one that queues a few.
+    Clients are not limited while nobody else is waiting.
+
+    >>> q = SIDNEppFairQueue()
+    >>> for i in range(3):
+    ...     q.push('bulk', 'bulk check %d' % i, 'check')
+    >>> q.push('portal', 'portal info', 'info')
+    >>> q.push('portal', 'portal create', 'create')
+    >>> [q.pop() for i in range(len(q))]
+    ['portal create', 'bulk check 0', 'portal info', 'bulk check 1', 'bulk check 2']
+    >>> q.pop() is None
+    True
+    """
+
+    def __init__(self, weights=None, priorities=None):
+        self.weights = weights or {}
+        self.priorities = dict(PRIORITIES, **(priorities or {}))
+        self._levels = {}    # priority -> heap of (stamp, seq, client, item)
+        self._last = {}      # (priority, client) -> last stamp queued
+        self._vtime = {}     # priority -> stamp of the last one out
+        self._seq = itertools.count()
+        self._len = 0
+
+    def priority(self, command):
+        return self.priorities.get(command_class(command), DEFAULT_PRIORITY)
+
+    def push(self, client, item, command=None):
+        level = self.priority(command)
+        stamp = max(self._vtime.get(level, 0.0),
+                    self._last.get((level, client), 0.0)) + \
+            1.0 / self.weights.get(client, 1.0)
+        self._last[(level, client)] = stamp
+        heapq.heappush(self._levels.setdefault(level, []),
+                       (stamp, next(self._seq), client, item))
+        self._len += 1
+
+    def pop(self):
+        """ the next item, or None """
+        if not self._len:
+            return None
+        level = min(l for l in self._levels if self._levels[l])
+        stamp, seq, client, item = heapq.heappop(self._levels[level])
+        self._vtime[level] = stamp
+        if self._last.get((level, client)) == stamp:
+            # nothing else queued for the client: forget it
+            del self._last[(level, client)]
+        self._len -= 1
+        return item
+
+    def __len__(self):
+        return self._len
+
+
+class SIDNEppFairScheduler(object):
+    """
+    at most `slots` commands upstream at once, the others wait their
+    turn in a SIDNEppFairQueue; for proxies that serve each downstream
+    connection in its own thread
+    """
+
+    def __init__(self, slots, weights=None, priorities=None):
+        self.slots = slots
+        self._busy = 0
+        self._queue = SIDNEppFairQueue(weights, priorities)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def turn(self, client, command=None):
+        """ wait until it is `client`'s turn to send `command` upstream """
+        event = None
+        with self._lock:
+            if self._busy < self.slots and not len(self._queue):
+                self._busy += 1
+            else:
+                event = threading.Event()
+                self._queue.push(client, event, command)
+        if event:
+            # the slot is handed over by whoever releases it
+            event.wait()
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            event = self._queue.pop()
+            if event is None:
+                self._busy -= 1
+        if event:
+            event.set()
+
+    def waiting(self):
+        with self._lock:
+            return len(self._queue)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
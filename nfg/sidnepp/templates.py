@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import re
+from xml.sax.saxutils import escape
+import lxml.etree as ET
+
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.protocol import SIDNEppProtocol, new_trid
+
+# placeholders in a template
+FIELD = re.compile("@@(\w+)@@")
+
+_ENTITIES = {'"': '&quot;', "'": '&apos;'}
+
+
+class SIDNEppCommand(str):
+    """ a command as it goes on the wire, along with its clTRID """
+
+    def __new__(cls, message, cltrid):
+        self = str.__new__(cls, message)
+        self.cltrid = cltrid
+        return self
+
+
+class Raw(str):
+    """ xml that is filled in as is, without escaping """
+
+
+def quote(value):
+    """ text or attribute value, escaped
+
+    >>> quote(u'caf\\xe9 & <co>')
+    'caf\\xc3\\xa9 &amp; &lt;co&gt;'
+    """
+    if isinstance(value, Raw):
+        return value
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return escape(str(value), _ENTITIES)
+
+
+def fragment(tag, text, **attrs):
+    """ serialized element, for templates that take a variable number of
+    children
+
+    >>> fragment('domain:contact', 'NFG001', type='tech')
+    '<domain:contact type="tech">NFG001</domain:contact>'
+    """
+    attrs = ''.join([' %s="%s"' % (k, quote(attrs[k])) for k in sorted(attrs)])
+    return Raw('<%s%s>%s</%s>' % (tag, attrs, quote(text), tag))
+
+
+class SIDNEppTemplate(object):
+    """
+    command serialized once, and filled in per call
+
+    Placeholders written as @@field@@ in the element the template is
+    made from are replaced by the escaped values passed to fill().
+    Every template has a @@cltrid@@, for which fill() generates a
+    fresh clTRID.
+
+    >>> e = SIDNEppProtocol().e_epp
+    >>> t = SIDNEppTemplate(e.epp(e.command(e.poll(op='ack', msgID='@@id@@'),
+    ...                                     e.clTRID('@@cltrid@@'))))
+    >>> t.fields
+    ['id', 'cltrid']
+    >>> c = t.fill(id='1&2')
+    >>> 'msgID="1&amp;2"' in c
+    True
+    >>> c.cltrid in c
+    True
+    """
+
+    def __init__(self, element):
+        text = ET.tostring(element, encoding="UTF-8", standalone=False)
+        parts = FIELD.split(text)
+        self._literals = parts[0::2]
+        self.fields = parts[1::2]
+
+    def fill(self, **values):
+        cltrid = values.get('cltrid') or new_trid()
+        values['cltrid'] = cltrid
+        out = [self._literals[0]]
+        for field, literal in zip(self.fields, self._literals[1:]):
+            out.append(quote(values.get(field, '')))
+            out.append(literal)
+        return SIDNEppCommand(''.join(out), cltrid)
+
+
+def _build():
+    p = SIDNEppProtocol()
+    e = p.e_epp
+    d = p.e_domain
+    c = p.e_contact
+    h = p.e_host
+
+    def command(x):
+        return e.epp(e.command(x, e.clTRID('@@cltrid@@')))
+
+    templates = {
+        'poll_req': command(e.poll(op='req')),
+        'poll_ack': command(e.poll(op='ack', msgID='@@msgid@@')),
+        'domain_info': command(e.info(d.info(d.name('@@name@@',
+                                                    hosts='all')))),
+        'domain_update': command(e.update(d.update(
+            d.name('@@name@@'),
+            d.add('@@add@@'),
+            d.rem('@@rem@@'),
+            d.chg('@@chg@@')))),
+        'contact_info': command(e.info(c.info(c.id('@@id@@')))),
+        'host_info': command(e.info(h.info(h.name('@@name@@')))),
+        'host_update': command(e.update(h.update(h.name('@@name@@'),
+                                                 '@@changes@@'))),
+    }
+    for objtype, m in (('domain', d), ('contact', c), ('host', h)):
+        # checks take any number of names, see fragment()
+        templates[objtype + '_check'] = command(e.check(m.check('@@ids@@')))
+        key = objtype == 'contact' and 'id' or 'name'
+        templates[objtype + '_delete'] = command(e.delete(m.delete(
+            getattr(m, key)('@@%s@@' % key))))
+    return dict((k, SIDNEppTemplate(v)) for k, v in templates.items())
+
+# built once per process, shared by all clients
+TEMPLATES = _build()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -4,6 +4,16 @@
 import unittest
 
 import time
+import struct
+import socket
+import shutil
+import urllib2
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import tempfile
+import subprocess
+import ssl
+import threading
 import sys
 import os.path
 sys.path.append(
@@ -11,7 +21,28 @@ sys.path.append(
         os.path.dirname(__file__), '..', '..'))
 
 from nfg.sidnepp.protocol import SIDNEppProtocol
-from nfg.sidnepp.client import SIDNEppClient
+from nfg.sidnepp import tls
+from nfg.sidnepp.client import SIDNEppClient, SIDNEppPipeline, SIDNEppError
+from nfg.sidnepp.retry import SIDNEppCircuitBreaker, CircuitOpen
+from nfg.sidnepp.pool import SIDNEppClientPool, PoolTimeout
+from nfg.sidnepp.proxy import SIDNEppThreadingProxy, SIDNEppLocalHandler
+from nfg.sidnepp.asyncproxy import SIDNEppAsyncProxy
+from nfg.sidnepp.fakeserver import SIDNEppFakeServer, SIDNEppFakeHandler
+from nfg.sidnepp.asyncclient import AsyncSIDNEppClient, CommandTimeout
+from nfg.sidnepp.framing import SIDNEppFrameReader
+from nfg.sidnepp.templates import TEMPLATES
+from nfg.sidnepp.whois import (
+    lookup_many,
+    SIDNWhois,
+    SIDNWhoisCache,
+    SIDNWhoisResult,
+)
+from nfg.sidnepp.ratelimit import SIDNEppRateLimiter
+from nfg.sidnepp.scheduler import SIDNEppFairQueue, SIDNEppFairScheduler
+from nfg.sidnepp.drainer import SIDNEppPollDrainer, SIDNEppCheckpoint
+from nfg.sidnepp.metrics import SIDNEppMetricsServer
+from nfg.sidnepp.cache import SIDNEppInfoCache, SIDNEppCheckCache
+from nfg.sidnepp.state import STATE_INIT, STATE_LOGGEDIN
 
 testserver = 'localhost'
 testport = 7000
@@ -143,6 +174,40 @@ class testSIDNEppProtocol(unittest.TestCase):
 """
         self.failUnless(expect == self.o.render(x))
 
+    def testClTRID(self):
+        e = self.o.e_epp
+        d = self.o.e_domain
+        x = e.epp(e.command(e.check(d.check(d.name('nfg.nl')))))
+        self.failUnless(self.o.get_cltrid(x) is None)
+        cltrid = self.o.set_cltrid(x)
+        self.failUnless(self.o.get_cltrid(x) == cltrid)
+        self.failUnless(self.o.set_cltrid(x) == cltrid)
+        self.failUnless(self.o.set_cltrid(x, 'ABC-12345') == 'ABC-12345')
+        self.failUnless(len(self.o.query(x, '//epp:clTRID')) == 1)
+
+        y = e.epp(e.command(e.check(d.check(d.name('nfg.nl')))))
+        self.failIf(self.o.set_cltrid(y) == cltrid)
+
+        self.failUnless(self.o.set_cltrid(e.epp(e.hello())) is None)
+
+        s = self.o.e_sidn
+        x = self.o.e_xsi.epp(self.o.e_xsi.extension(
+            s.command(s.domainCancelDelete(s.name('nfg.nl')))))
+        cltrid = self.o.set_cltrid(x)
+        self.failUnless(self.o.query(x, '//sidn-ext-epp:clTRID'))
+        self.failUnless(self.o.get_cltrid(x) == cltrid)
+
+    def testReadall(self):
+        a, b = socket.socketpair()
+        a.sendall('<epp/><epp>2</epp>')
+        self.failUnless(self.o.readall(b, 6) == '<epp/>')
+        buf = self.o._readbuf
+        self.failUnless(self.o.readall(b, 3) == '<ep')
+        self.failUnless(self.o._readbuf is buf)
+        a.close()
+        self.assertRaises(IOError, self.o.readall, b, 10)
+        b.close()
+
 
 class testSIDNEppClient(unittest.TestCase):
     dummy = None
@@ -448,6 +513,1646 @@ class testSIDNEppClient(unittest.TestCase):
         self.failUnless(int(r.get("code")) == 1000)
 
 
+class DummyClient(object):
+    """ stand-in for a logged-in upstream session """
+
+    def __init__(self, host, port, username, password, ssl):
+        self._state = STATE_LOGGEDIN
+
+    def getState(self):
+        return self._state
+
+    def write(self, message):
+        return message
+
+    def forward(self, message):
+        return message
+
+    def logout(self):
+        self._state = STATE_INIT
+
+    def close(self):
+        self._state = STATE_INIT
+
+
+class testSIDNEppClientPool(unittest.TestCase):
+
+    def setUp(self):
+        SIDNEppClientPool.client = DummyClient
+        self.o = SIDNEppClientPool(testserver, testport, testuser, testpass,
+                                   minsize=1, maxsize=2, growwait=0,
+                                   idletime=60)
+
+    def tearDown(self):
+        SIDNEppClientPool.client = SIDNEppClient
+        self.o.logout()
+
+    def testReuse(self):
+        c1 = self.o.acquire()
+        self.o.release(c1)
+        c2 = self.o.acquire()
+        self.failUnless(c1 is c2)
+        self.o.release(c2)
+        self.failUnless(self.o.stats()['size'] == 1)
+
+    def testGrow(self):
+        c1 = self.o.acquire()
+        c2 = self.o.acquire()
+        self.failIf(c1 is c2)
+        self.failUnless(self.o.stats()['busy'] == 2)
+        self.assertRaises(PoolTimeout, self.o.acquire, 0.01)
+        self.o.release(c1)
+        self.o.release(c2)
+        self.failUnless(self.o.stats()['idle'] == 2)
+
+    def testShrink(self):
+        c1 = self.o.acquire()
+        c2 = self.o.acquire()
+        self.o.release(c1)
+        self.o.idletime = 0
+        time.sleep(0.01)
+        self.o.release(c2)
+        self.failUnless(self.o.stats()['size'] == 1)
+        self.failUnless(c1.getState() == STATE_INIT)
+
+    def testBroken(self):
+        c1 = self.o.acquire()
+        c1.close()
+        self.o.release(c1)
+        self.failUnless(self.o.stats()['size'] == 0)
+        c2 = self.o.acquire()
+        self.failIf(c1 is c2)
+        self.o.release(c2)
+
+    def testWrite(self):
+        self.failUnless(self.o.write('x') == 'x')
+
+
+def frame_write(sock, message):
+    sock.sendall(struct.pack(">L", len(message) + 4) + message)
+
+
+def frame_read(sock):
+    return SIDNEppProtocol().parse(SIDNEppFrameReader(sock, size=0).read())
+
+
+class testSIDNEppThreadingProxy(unittest.TestCase):
+
+    command = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+    <epp xmlns="urn:ietf:params:xml:ns:epp-1.0">
+    <command><poll op="req"/></command>
+    </epp>"""
+
+    def setUp(self):
+        SIDNEppClientPool.client = DummyClient
+        self.o = SIDNEppThreadingProxy(('127.0.0.1', 0), max_connections=2)
+        self.o.pool = SIDNEppClientPool(testserver, testport,
+                                        testuser, testpass, maxsize=2)
+        self.t = threading.Thread(target=self.o.serve_forever,
+                                  kwargs=dict(poll_interval=0.01))
+        self.t.daemon = True
+        self.t.start()
+
+    def tearDown(self):
+        SIDNEppClientPool.client = SIDNEppClient
+        self.o.shutdown()
+        self.o.server_close()
+        # let the handler threads see their clients hang up
+        for t in threading.enumerate():
+            if t.daemon:
+                t.join(1)
+
+    def connect(self):
+        s = socket.create_connection(self.o.server_address)
+        s.settimeout(2)
+        return s
+
+    def testConcurrent(self):
+        idle = self.connect()
+        frame_write(idle, self.command)
+        frame_read(idle)
+        # the first connection stays open and idle
+        busy = self.connect()
+        frame_write(busy, self.command)
+        r = frame_read(busy)
+        self.failUnless(SIDNEppProtocol().query(r, '//epp:poll'))
+        idle.close()
+        busy.close()
+
+    def testMaxConnections(self):
+        conns = [self.connect() for i in range(2)]
+        for c in conns:
+            frame_write(c, self.command)
+            frame_read(c)
+        waiting = self.connect()
+        waiting.settimeout(0.2)
+        frame_write(waiting, self.command)
+        self.assertRaises(socket.timeout, frame_read, waiting)
+        conns[0].close()
+        waiting.settimeout(2)
+        frame_read(waiting)
+        waiting.close()
+        conns[1].close()
+
+    def testMetrics(self):
+        s = self.connect()
+        frame_write(s, self.command)
+        frame_read(s)
+        s.close()
+        status = self.o.status()
+        self.failUnless(status['sessions'] == {STATE_LOGGEDIN: 1})
+        self.failUnless(self.o.ready())
+        line = 'sidnepp_proxy_upstream_seconds_count{command="poll"} 1'
+        # the handler records the command after answering it
+        for i in range(100):
+            if line in self.o.metrics.render(status):
+                break
+            time.sleep(0.01)
+        self.failUnless(line in self.o.metrics.render(status))
+
+    def testRateLimit(self):
+        self.o.limiter = SIDNEppRateLimiter(dict(poll=20))
+        s = self.connect()
+        start = time.time()
+        for i in range(5):
+            frame_write(s, self.command)
+            frame_read(s)
+        # the first goes at once, the others 1/20s apart
+        self.failUnless(time.time() - start >= 0.19)
+        s.close()
+        line = 'sidnepp_proxy_throttled_seconds_count{command="poll"} 4'
+        for i in range(100):
+            if line in self.o.metrics.render():
+                break
+            time.sleep(0.01)
+        self.failUnless(line in self.o.metrics.render())
+
+    def testPassthrough(self):
+        s = self.connect()
+        frame_write(s, self.command)
+        self.failUnless(SIDNEppFrameReader(s).read() == self.command)
+        self.o.passthrough = False
+        frame_write(s, self.command)
+        r = SIDNEppFrameReader(s).read()
+        self.failIf(r == self.command)
+        self.failUnless(SIDNEppProtocol().query(SIDNEppProtocol().parse(r),
+                                                '//epp:poll'))
+        s.close()
+
+
+class LocalHandler(SIDNEppLocalHandler):
+
+    commands = dict(SIDNEppLocalHandler.commands, poll='_handle_poll')
+
+    def __init__(self):
+        SIDNEppLocalHandler.__init__(self)
+        self.routed = []
+
+    def write(self, message):
+        pass
+
+    def _handle_poll(self, req, description):
+        self.routed.append(('poll', description))
+
+    def _handle_command(self, req, description):
+        self.routed.append(('forward', description))
+
+
+class testSIDNEppLocalHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.o = LocalHandler()
+
+    def testDispatch(self):
+        e = self.o.e_epp
+        d = self.o.e_domain
+        self.o.dispatch(e.epp(e.command(e.poll(op='req'))))
+        self.o.dispatch(e.epp(e.command(e.info(d.info(d.name('nfg.nl'))))))
+        self.failUnless(self.o.routed == [
+            ('poll', ('poll', None, [])),
+            ('forward', ('info', 'domain', ['nfg.nl']))])
+        self.failIf(self.o.done)
+        self.o.dispatch(e.epp(e.command(e.logout())))
+        self.failUnless(self.o.done)
+
+
+class testSIDNEppAsyncProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = SIDNEppFakeServer(('127.0.0.1', 0)).start()
+        self.o = SIDNEppAsyncProxy(('127.0.0.1', 0), max_connections=8)
+        host, port = self.upstream.server_address
+        self.o.login(host, port, testuser, testpass, ssl=False)
+        self.t = threading.Thread(target=self.o.serve_forever, args=(0.01,))
+        self.t.daemon = True
+        self.t.start()
+
+    def tearDown(self):
+        self.o.shutdown()
+        self.t.join()
+        self.o.server_close()
+        self.upstream.shutdown()
+        self.upstream.server_close()
+
+    def client(self):
+        host, port = self.o.server_address
+        return SIDNEppClient(host, port, testuser, testpass, ssl=False)
+
+    def testForward(self):
+        c = self.client()
+        s = c.domain_check('nfg.nl')
+        r = c.query(s, '//epp:result')[0]
+        self.failUnless(int(r.get("code")) == 1000)
+        s = c.logout()
+        r = c.query(s, '//epp:result')[0]
+        self.failUnless(int(r.get("code")) == 1500)
+
+    def testRateLimit(self):
+        self.o.limiter = SIDNEppRateLimiter(dict(check=20))
+        c = self.client()
+        start = time.time()
+        replies = c.pipeline([c._build_check('domain', ['nfg-%d.nl' % i])
+                              for i in range(5)])
+        self.failUnless(time.time() - start >= 0.19)
+        self.failUnless([c._code(r) for r in replies] == ['1000'] * 5)
+        # other classes are not held back
+        start = time.time()
+        c.domain_info('nfg.nl')
+        self.failUnless(time.time() - start < 0.05)
+        c.logout()
+        self.failUnless('sidnepp_proxy_throttled_seconds_count'
+                        '{command="check"} 4' in self.o.metrics.render())
+
+    def testMetricsServer(self):
+        m = SIDNEppMetricsServer(('127.0.0.1', 0), self.o).start()
+        url = 'http://127.0.0.1:%d' % m.server_port
+        c = self.client()
+        c.domain_info('nfg.nl')
+        c.logout()
+        text = urllib2.urlopen(url + '/metrics').read()
+        for line in (
+                'sidnepp_proxy_upstream_sessions{state="loggedin"} 1',
+                'sidnepp_proxy_upstream_seconds_count{command="info"} 1',
+                'sidnepp_proxy_results_total{code="1500"} 1'):
+            self.failUnless(line in text, line)
+        self.failUnless(urllib2.urlopen(url + '/ready').code == 200)
+        self.o.logout()
+        try:
+            urllib2.urlopen(url + '/ready')
+        except urllib2.HTTPError, why:
+            self.failUnless(why.code == 503)
+        else:
+            self.fail("ready without upstream sessions")
+        m.shutdown()
+        m.server_close()
+
+    def testSyntaxError(self):
+        s = socket.create_connection(self.o.server_address)
+        s.settimeout(2)
+        frame_write(s, '<epp><command>')
+        r = frame_read(s)
+        self.failUnless(r.xpath('//@code') == ['2001'])
+        s.close()
+
+    def testIdleConnections(self):
+        idle = [socket.create_connection(self.o.server_address)
+                for i in range(5)]
+        c = self.client()
+        s = c.domain_info('nfg.nl')
+        r = c.query(s, '//epp:result')[0]
+        self.failUnless(int(r.get("code")) == 1000)
+        c.logout()
+        for i in idle:
+            i.close()
+
+    def testInfoCache(self):
+        self.o.cache = SIDNEppInfoCache()
+        c = self.client()
+        for i in range(3):
+            s = c.domain_info('nfg.nl')
+            r = c.query(s, '//epp:result')[0]
+            self.failUnless(int(r.get("code")) == 1000)
+        c.domain_update('nfg.nl', {'chg': {'owner': 'STE002126-NFGNT'}})
+        c.domain_info('nfg.nl')
+        c.logout()
+        infos = [d for d in self.upstream.commands if d[0] == 'info']
+        self.failUnless(len(infos) == 2)
+
+    def testCheckCache(self):
+        self.o.checks = SIDNEppCheckCache()
+        self.upstream.registered.add('nfg.nl')
+        c = self.client()
+        for i in range(3):
+            s = c.domain_check('nfg.nl')
+            avail = c.query(s, '//domain:name/@avail')
+            self.failUnless(avail == ['false'])
+        c.domain_check_many(['nfg.nl', 'free.nl'])
+        c.domain_check('free.nl')
+        c.logout()
+        checks = [d for d in self.upstream.commands if d[0] == 'check']
+        self.failUnless(len(checks) == 2)
+
+    def testConcurrentClients(self):
+        codes = []
+
+        def run():
+            c = self.client()
+            for i in range(5):
+                s = c.host_check('ns%d.nfg.nl' % i)
+                codes.append(c.query(s, '//epp:result')[0].get('code'))
+            c.logout()
+
+        workers = [threading.Thread(target=run) for i in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.failUnless(codes == ['1000'] * 20)
+
+
+class testAsyncSIDNEppClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SIDNEppFakeServer(('127.0.0.1', 0)).start()
+        self.map = {}
+        host, port = self.server.server_address
+        self.o = AsyncSIDNEppClient(host, port, testuser, testpass,
+                                    ssl=False, map=self.map)
+
+    def tearDown(self):
+        self.o.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def code(self, s):
+        return int(self.o.query(s, '//epp:result')[0].get('code'))
+
+    def testLogin(self):
+        s = self.o.ready.result(2)
+        self.failUnless(self.code(s) == 1000)
+        self.failUnless(self.o.getState() == STATE_LOGGEDIN)
+
+    def testCommands(self):
+        # issued before the login completed, held back until it did
+        futures = [self.o.domain_check('nfg-%d.nl' % i) for i in range(5)]
+        futures.append(self.o.contact_info('STE002126-NFGNT'))
+        futures.append(self.o.host_info('ns.nfg.nl'))
+        poll = self.o.poll()
+        for f in futures:
+            self.failUnless(self.code(f.result(2)) == 1000)
+        # nothing queued
+        self.failUnless(self.code(poll.result(2)) == 1300)
+
+    def testCallback(self):
+        replies = []
+        f = self.o.domain_info('nfg.nl')
+        f.add_callback(lambda f: replies.append(f.result()))
+        f.result(2)
+        self.failUnless(len(replies) == 1)
+        self.failUnless(self.code(replies[0]) == 1000)
+
+    def testLogout(self):
+        self.o.ready.result(2)
+        s = self.o.logout().result(2)
+        self.failUnless(self.code(s) == 1500)
+        self.failUnless(self.o.getState() == STATE_INIT)
+
+    def testTimeout(self):
+        self.server.latency = 0.5
+        self.o.ready.result(2)
+        f = self.o.domain_check('nfg.nl')
+        self.assertRaises(CommandTimeout, f.result, 0.05)
+        self.failUnless(self.code(f.result(2)) == 1000)
+
+    def testCheckMany(self):
+        self.server.registered.add('nfg.nl')
+        f = self.o.domain_check_many(['nfg.nl', 'nfg-%d.nl'] +
+                                     ['nfg-%d.nl' % i for i in range(20)])
+        avail = f.result(2)
+        self.failUnless(len(avail) == 22)
+        self.failIf(avail['nfg.nl'])
+        self.failUnless(avail['nfg-0.nl'])
+
+    def testCheckWindow(self):
+        self.o.ready.result(2)
+        names = ['nfg-%d.nl' % i for i in range(10)]
+        f = self.o._check_many('domain', names, chunk=1, window=3)
+        self.failUnless(len(self.o._pending) == 3)
+        self.failUnless(len(f.result(2)) == 10)
+        self.failUnless(len([d for d in self.server.commands
+                             if d[0] == 'check']) == 10)
+
+    def testLost(self):
+        self.o.ready.result(2)
+        f = self.o.domain_check('nfg.nl')
+        self.o.close()
+        self.failUnless(f.done())
+        self.assertRaises(IOError, f.result)
+
+    def testLoginFailed(self):
+        self.server.errors['login'] = '2200'
+        try:
+            self.o.ready.result(2)
+        except SIDNEppError, why:
+            self.failUnless(why.code == '2200')
+        else:
+            self.fail("login succeeded")
+
+    def testRead(self):
+        self.o.ready.result(2)
+        f = self.o.read()
+        self.failIf(f.done())
+        # answered with a greeting, which carries no clTRID
+        e = self.o.e_epp
+        self.o._channel.write_frame(self.o.render(e.epp(e.hello()),
+                                                  pretty=False))
+        self.failUnless(self.o.query(f.result(2), '//epp:greeting'))
+
+
+class testSIDNEppPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SIDNEppFakeServer(('127.0.0.1', 0)).start()
+        host, port = self.server.server_address
+        self.o = SIDNEppClient(host, port, testuser, testpass, ssl=False)
+
+    def tearDown(self):
+        if self.o.getState() != STATE_INIT:
+            self.o.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testPrepare(self):
+        e = self.o.e_epp
+        message, cltrid = self.o.prepare(e.epp(e.command(e.poll(op='req'))))
+        self.failUnless(cltrid in message)
+        message, cltrid = self.o.prepare(testSIDNEppThreadingProxy.command)
+        self.failUnless(cltrid in message)
+        message, cltrid = self.o.prepare(message)
+        self.failUnless(message.count(cltrid) == 1)
+
+    def testPipeline(self):
+        d = self.o.e_domain
+        e = self.o.e_epp
+        names = ['nfg-%d.nl' % i for i in range(20)]
+        messages = [e.epp(e.command(e.info(d.info(d.name(n)))))
+                    for n in names]
+        replies = self.o.pipeline(messages, window=4)
+        self.failUnless(len(replies) == 20)
+        for m, r in zip(messages, replies):
+            self.failUnless(self.o.get_cltrid(m) == self.o.get_cltrid(r))
+        self.o.logout()
+
+    def testThreads(self):
+        p = SIDNEppPipeline(self.o, window=4)
+        matched = []
+
+        def run(i):
+            d = self.o.e_domain
+            e = self.o.e_epp
+            for j in range(5):
+                x = e.epp(e.command(e.check(d.check(d.name('n%d.nl' % j)))))
+                cltrid = self.o.set_cltrid(x)
+                r = p.write(x, timeout=2)
+                matched.append(self.o.get_cltrid(r) == cltrid)
+
+        workers = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.failUnless(matched == [True] * 20)
+        r = p.logout()
+        self.failUnless(int(self.o.query(r, '//epp:result')[0].get('code'))
+                        == 1500)
+        self.assertRaises(IOError, p.write, testSIDNEppThreadingProxy.command)
+
+    def testCheckMany(self):
+        self.server.registered.update(['nfg-3.nl', 'nfg-17.nl'])
+        names = ['NFG-%d.nl' % i for i in range(25)]
+        avail = self.o.domain_check_many(iter(names), chunk=4)
+        self.failUnless(sorted(avail.keys()) == sorted(names))
+        taken = [n for n, a in avail.items() if not a]
+        self.failUnless(sorted(taken) == ['NFG-17.nl', 'NFG-3.nl'])
+
+        avail = self.o.host_check_many(['ns%d.nfg.nl' % i for i in range(3)])
+        self.failUnless(avail == {'ns0.nfg.nl': True, 'ns1.nfg.nl': True,
+                                  'ns2.nfg.nl': True})
+        self.failUnless(self.o.contact_check_many([]) == {})
+
+
+def make_cert(path):
+    """ self-signed certificate for localhost, with its key """
+    try:
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+             '-nodes', '-days', '1', '-subj', '/CN=localhost',
+             '-keyout', path, '-out', path],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return False
+    return True
+
+
+class testSIDNEppFakeServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SIDNEppFakeServer(('127.0.0.1', 0), seed=1).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, **kwargs):
+        host, port = self.server.server_address
+        return SIDNEppClient(host, port, testuser, testpass,
+                             **dict(dict(ssl=False), **kwargs))
+
+    def code(self, s):
+        return SIDNEppProtocol().query(s, '//epp:result/@code')[0]
+
+    def testCreate(self):
+        c = self.client()
+        s = c.domain_create('NFG.nl', dict(ns=['ns1.nfg.nl'], owner='NFG001',
+                                           admin='NFG001', tech='NFG001'))
+        self.failUnless(self.code(s) == '1000')
+        self.failUnless(c.query(s, '//domain:creData/domain:name/text()')
+                        == ['nfg.nl'])
+        self.failIf(c.domain_check_many(['nfg.nl'])['nfg.nl'])
+        s = c.domain_create('nfg.nl', dict(ns=[], owner='NFG001',
+                                           admin='NFG001', tech='NFG001'))
+        self.failUnless(self.code(s) == '2302')
+        self.failUnless(self.code(c.domain_delete('nfg.nl')) == '1000')
+        self.failUnless(self.code(c.domain_delete('nfg.nl')) == '2303')
+        s = c.contact_info('NFG001')
+        self.failUnless(c.query(s, '//contact:id/text()') == ['NFG001'])
+        c.logout()
+
+    def testPoll(self):
+        msgid = self.server.queue('1202 Change to name server ns1.bol.nl')
+        c = self.client()
+        s = c.poll()
+        self.failUnless(self.code(s) == '1301')
+        self.failUnless(c.query(s, '//epp:msgQ/@id') == [msgid])
+        s = c.poll(ack=msgid)
+        self.failUnless(self.code(s) == '1000')
+        self.failUnless(c.query(s, '//epp:msgQ/@count') == ['0'])
+        self.failUnless(self.code(c.poll()) == '1300')
+        self.failUnless(self.code(c.poll(ack=msgid)) == '2303')
+        c.logout()
+
+    def testErrors(self):
+        c = self.client()
+        c.retries = 0
+        self.server.errors['info'] = '2303'
+        self.failUnless(self.code(c.domain_info('nfg.nl')) == '2303')
+        self.failUnless(self.code(c.domain_check('nfg.nl')) == '1000')
+        self.server.error_rate = 1
+        self.failUnless(self.code(c.domain_check('nfg.nl')) == '2400')
+        c.logout()
+
+    def testSessionLimit(self):
+        self.server.max_sessions = 1
+        c = self.client()
+        self.assertRaises(Exception, self.client)
+        c.logout()
+        # the session is given back at logout
+        time.sleep(0.05)
+        self.client().logout()
+
+    def testDisconnect(self):
+        s = socket.create_connection(self.server.server_address)
+        frame_read(s)
+        self.server.disconnect_rate = 1
+        frame_write(s, testSIDNEppThreadingProxy.command)
+        self.assertRaises(IOError, frame_read, s)
+        s.close()
+
+    def testTLS(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            cert = os.path.join(tmp, 'cert.pem')
+            if not make_cert(cert):
+                self.skipTest('no openssl')
+            server = SIDNEppFakeServer(('127.0.0.1', 0), certfile=cert)
+            server.start()
+            host, port = server.server_address
+            c = SIDNEppClient(host, port, testuser, testpass, ssl=True)
+            self.failUnless(c.getState() == STATE_LOGGEDIN)
+            self.failUnless(self.code(c.domain_check('nfg.nl')) == '1000')
+            c.logout()
+            server.shutdown()
+            server.server_close()
+        finally:
+            shutil.rmtree(tmp)
+
+
+class testSIDNEppReconnect(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SIDNEppFakeServer(('127.0.0.1', 0)).start()
+        host, port = self.server.server_address
+        self.o = SIDNEppClient(host, port, testuser, testpass, ssl=False)
+        self.o.backoff_base = 0.001
+        self.o.breaker = SIDNEppCircuitBreaker(threshold=100)
+
+    def tearDown(self):
+        self.o.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def code(self, s):
+        return self.o.query(s, '//epp:result/@code')[0]
+
+    def sent(self, command):
+        return len([d for d in self.server.commands if d[0] == command])
+
+    def testResume(self):
+        # the session breaks under the client
+        self.o._fd.shutdown(socket.SHUT_RDWR)
+        self.failUnless(self.code(self.o.domain_check('nfg.nl')) == '1000')
+        self.failUnless(self.sent('login') == 2)
+        self.failUnless(self.o.getState() == STATE_LOGGEDIN)
+
+    def testClosing(self):
+        self.server.errors['check'] = '2500'
+        self.o.retries = 2
+        self.failUnless(self.code(self.o.domain_check('nfg.nl')) == '2500')
+        self.failUnless(self.sent('check') == 3)
+        # each 2500 closed the session, the retries logged in again
+        self.failUnless(self.sent('login') == 3)
+
+    def testRetryable(self):
+        self.server.errors['info'] = '2400'
+        self.o.retries = 2
+        self.failUnless(self.code(self.o.domain_info('nfg.nl')) == '2400')
+        self.failUnless(self.sent('info') == 3)
+
+    def testFatal(self):
+        self.server.errors['info'] = '2303'
+        self.failUnless(self.code(self.o.domain_info('nfg.nl')) == '2303')
+        self.failUnless(self.sent('info') == 1)
+
+    def testLogin(self):
+        self.server.errors['login'] = '2200'
+        host, port = self.server.server_address
+        try:
+            SIDNEppClient(host, port, testuser, testpass, ssl=False)
+        except SIDNEppError, why:
+            self.failUnless(why.code == '2200')
+        else:
+            self.fail('logged in')
+        self.failUnless(self.sent('login') == 2)
+
+    def testForward(self):
+        message = TEMPLATES['domain_check'].fill(names=['nfg.nl'])
+        self.o._fd.shutdown(socket.SHUT_RDWR)
+        reply = self.o.forward(message)
+        self.failUnless(self.code(self.o.parse(reply)) == '1000')
+        self.failUnless(self.sent('login') == 2)
+
+    def testForwardClosing(self):
+        self.server.errors['check'] = '2500'
+        self.o.retries = 1
+        message = TEMPLATES['domain_check'].fill(names=['nfg.nl'])
+        reply = self.o.forward(message)
+        self.failUnless(self.code(self.o.parse(reply)) == '2500')
+        self.failUnless(self.sent('check') == 2)
+
+    def testCircuit(self):
+        self.o.breaker = SIDNEppCircuitBreaker(threshold=2, reset=60)
+        self.server.error_rate = 1
+        self.server.error_code = '2500'
+        # the check and the login after it fail
+        self.assertRaises(CircuitOpen, self.o.domain_check, 'nfg.nl')
+        self.failUnless(self.sent('check') == 1)
+        # fails at once, without bothering the server
+        self.assertRaises(CircuitOpen, self.o.domain_check, 'nfg.nl')
+        self.failUnless(self.sent('check') == 1)
+
+    def testCommandFailed(self):
+        # the breaker every session to the server shares
+        host, port = self.server.server_address
+        a = SIDNEppClient(host, port, testuser, testpass, ssl=False)
+        b = SIDNEppClient(host, port, testuser, testpass, ssl=False)
+        a.backoff_base = 0.001
+        self.server.errors['info'] = '2400'
+        self.server.errors['delete'] = '2400'
+        self.failUnless(self.code(a.domain_info('nfg.nl')) == '2400')
+        self.failUnless(self.sent('info') == a.retries + 1)
+        # not sent again: it may have been carried out
+        self.failUnless(self.code(a.domain_delete('nfg.nl')) == '2400')
+        self.failUnless(self.sent('delete') == 1)
+        # the server answers, so the circuit stays closed for others
+        self.failUnless(self.code(b.domain_check('nfg.nl')) == '1000')
+        a.logout()
+        b.logout()
+
+
+class testSIDNEppProxyResume(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = SIDNEppFakeServer(('127.0.0.1', 0)).start()
+
+    def tearDown(self):
+        self.client.close()
+        self.proxy.shutdown()
+        self.proxy.server_close()
+        if isinstance(self.proxy, SIDNEppThreadingProxy):
+            self.proxy.logout()
+        self.upstream.shutdown()
+        self.upstream.server_close()
+
+    def sent(self, command):
+        return len([d for d in self.upstream.commands if d[0] == command])
+
+    def serve(self, proxy):
+        self.proxy = proxy
+        host, port = self.upstream.server_address
+        proxy.login(host, port, testuser, testpass, ssl=False)
+        t = threading.Thread(target=proxy.serve_forever, args=(0.01,))
+        t.daemon = True
+        t.start()
+        host, port = proxy.server_address
+        c = self.client = SIDNEppClient(host, port, testuser, testpass,
+                                        ssl=False)
+        c.retries = 0
+        return t, c
+
+    def code(self, c):
+        return c.query(c.domain_check('nfg.nl'), '//epp:result/@code')[0]
+
+    def drop(self, sessions):
+        """ break the upstream sessions under the proxy """
+        for client in sessions:
+            client._fd.shutdown(socket.SHUT_RDWR)
+
+    def testThreadingProxy(self):
+        t, c = self.serve(SIDNEppThreadingProxy(('127.0.0.1', 0)))
+        self.drop([client for idle, client in self.proxy.pool._idle])
+        self.failUnless(self.code(c) == '1000')
+        self.failUnless(self.sent('login') == 2)
+
+    def testThreadingLoginFailed(self):
+        t, c = self.serve(SIDNEppThreadingProxy(('127.0.0.1', 0)))
+        self.upstream.errors['login'] = '2200'
+        self.drop([client for idle, client in self.proxy.pool._idle])
+        self.failUnless(self.code(c) == '2400')
+        del self.upstream.errors['login']
+        self.failUnless(self.code(c) == '1000')
+
+    def testAsyncProxy(self):
+        self.upstream.latency = 0.2
+        t, c = self.serve(SIDNEppAsyncProxy(('127.0.0.1', 0)))
+        # broken while the check is in flight
+        timer = threading.Timer(0.1, self.drop, args=(
+            [u.client for u in self.proxy._upstream],))
+        timer.start()
+        self.failUnless(self.code(c) == '1000')
+        self.failUnless(self.sent('check') == 2)
+
+    def testAsyncLoginFailed(self):
+        t, c = self.serve(SIDNEppAsyncProxy(('127.0.0.1', 0)))
+        self.upstream.errors['login'] = '2200'
+        self.drop([u.client for u in self.proxy._upstream])
+        while self.proxy._upstream:
+            time.sleep(0.01)
+        self.failUnless(self.code(c) == '2400')
+        self.failUnless(t.is_alive())
+
+
+class testSIDNEppTLS(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cert = os.path.join(self.tmp, 'cert.pem')
+        if not make_cert(self.cert):
+            shutil.rmtree(self.tmp)
+            self.skipTest('no openssl')
+        self.server = SIDNEppFakeServer(('127.0.0.1', 0), certfile=self.cert)
+        self.server.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def testShared(self):
+        self.failUnless(tls.context() is tls.context())
+        self.failUnless(tls.context(self.cert) is tls.context(self.cert))
+        self.failIf(tls.context() is tls.context(self.cert))
+
+    def testVerify(self):
+        c = SIDNEppClient('localhost', self.port, testuser, testpass,
+                          ssl=tls.context(cafile=self.cert))
+        self.failUnless(c.getState() == STATE_LOGGEDIN)
+        c.logout()
+        # the certificate is for localhost
+        self.assertRaises(Exception, SIDNEppClient, '127.0.0.1', self.port,
+                          testuser, testpass,
+                          ssl=tls.context(cafile=self.cert))
+
+    def testClientCertificate(self):
+        self.server.ssl_context.verify_mode = ssl.CERT_REQUIRED
+        self.server.ssl_context.load_verify_locations(self.cert)
+        c = SIDNEppClient('127.0.0.1', self.port, testuser, testpass,
+                          ssl=tls.context(certfile=self.cert))
+        self.failUnless(c.getState() == STATE_LOGGEDIN)
+        c.logout()
+        self.assertRaises(IOError, SIDNEppClient, '127.0.0.1', self.port,
+                          testuser, testpass, ssl=True)
+
+    def testAsync(self):
+        map = {}
+        c = AsyncSIDNEppClient('localhost', self.port, testuser, testpass,
+                               ssl=tls.context(cafile=self.cert), map=map)
+        s = c.ready.result(2)
+        self.failUnless(c.query(s, '//epp:result/@code') == ['1000'])
+        c.close()
+
+    def testResume(self):
+        if not tls.RESUMPTION:
+            self.skipTest('no TLS session resumption in this python')
+        c = SIDNEppClient('127.0.0.1', self.port, testuser, testpass)
+        c.close()
+        c.connect()
+        self.failUnless(tls.resumed(c._fd))
+        c.logout()
+
+
+class testSIDNEppPollDrainer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SIDNEppFakeServer(('127.0.0.1', 0)).start()
+        self.ids = [self.server.queue('message %d' % i) for i in range(5)]
+        host, port = self.server.server_address
+        self.o = SIDNEppClient(host, port, testuser, testpass, ssl=False)
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'poll.json')
+
+    def tearDown(self):
+        self.o.logout()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def testDrain(self):
+        drainer = SIDNEppPollDrainer(self.o, self.path)
+        messages = list(drainer)
+        self.failUnless([m.id for m in messages] == self.ids)
+        self.failUnless(messages[0].msg == 'message 0')
+        self.failUnless(messages[0].count == 5)
+        self.failUnless(self.server.peek() is None)
+        self.failUnless(SIDNEppCheckpoint(self.path).acked == self.ids[-1])
+
+    def testCrash(self):
+        for m in SIDNEppPollDrainer(self.o, self.path):
+            if m.id == self.ids[2]:
+                # processing this one failed
+                break
+        checkpoint = SIDNEppCheckpoint(self.path)
+        self.failUnless(checkpoint.processed == self.ids[1])
+        # processed, but the ack never went out
+        checkpoint.save(processed=self.ids[2])
+        messages = list(SIDNEppPollDrainer(self.o, self.path))
+        self.failUnless([m.id for m in messages] == self.ids[3:])
+        self.failUnless(self.server.peek() is None)
+
+    def testProxy(self):
+        proxy = SIDNEppAsyncProxy(('127.0.0.1', 0))
+        host, port = self.server.server_address
+        proxy.login(host, port, testuser, testpass, ssl=False)
+        t = threading.Thread(target=proxy.serve_forever, args=(0.01,))
+        t.daemon = True
+        t.start()
+        try:
+            host, port = proxy.server_address
+            c = SIDNEppClient(host, port, testuser, testpass, ssl=False)
+            messages = list(SIDNEppPollDrainer(c))
+            self.failUnless([m.id for m in messages] == self.ids)
+            c.logout()
+        finally:
+            proxy.shutdown()
+            t.join()
+            proxy.server_close()
+
+
+class testSIDNEppFairQueue(unittest.TestCase):
+
+    def testWeights(self):
+        q = SIDNEppFairQueue(weights=dict(portal=2))
+        for i in range(4):
+            q.push('bulk', 'bulk', 'check')
+            q.push('portal', 'portal', 'check')
+        self.failUnless([q.pop() for i in range(6)] ==
+                        ['portal', 'bulk', 'portal', 'portal', 'bulk',
+                         'portal'])
+
+    def testLateComer(self):
+        q = SIDNEppFairQueue()
+        for i in range(100):
+            q.push('bulk', 'bulk', 'info')
+        for i in range(50):
+            q.pop()
+        # no catching up on the turns it did not take
+        q.push('portal', 'portal', 'info')
+        self.failUnless([q.pop() for i in range(2)] == ['bulk', 'portal'])
+
+    def testPriorities(self):
+        q = SIDNEppFairQueue(priorities=dict(check=0))
+        q.push('bulk', 'create', 'create')
+        q.push('bulk', 'check', 'check')
+        q.push('bulk', 'info', 'info')
+        self.failUnless([q.pop() for i in range(3)] ==
+                        ['create', 'check', 'info'])
+
+    def testScheduler(self):
+        s = SIDNEppFairScheduler(slots=1)
+        order = []
+
+        def command(client, name):
+            with s.turn(client, name):
+                order.append(name)
+
+        with s.turn('bulk', 'check'):
+            threads = []
+            for client, name in (('bulk', 'check'), ('bulk', 'info'),
+                                 ('portal', 'transfer')):
+                t = threading.Thread(target=command, args=(client, name))
+                t.start()
+                threads.append(t)
+                while s.waiting() < len(threads):
+                    time.sleep(0.001)
+        for t in threads:
+            t.join()
+        self.failUnless(order == ['transfer', 'check', 'info'])
+
+    def testAsyncProxy(self):
+        upstream = SIDNEppFakeServer(('127.0.0.1', 0), latency=0.05).start()
+        proxy = SIDNEppAsyncProxy(('127.0.0.1', 0))
+        host, port = upstream.server_address
+        proxy.login(host, port, testuser, testpass, ssl=False)
+        t = threading.Thread(target=proxy.serve_forever, args=(0.01,))
+        t.daemon = True
+        t.start()
+        host, port = proxy.server_address
+        bulk = [SIDNEppClient(host, port, 'bulk', testpass, ssl=False)
+                for i in range(3)]
+        portal = SIDNEppClient(host, port, 'portal', testpass, ssl=False)
+        done = []
+
+        def check(c, name):
+            # different names: identical checks would share one round trip
+            c.domain_check(name)
+            done.append('check')
+        threads = [threading.Thread(target=check, args=(c, 'nfg%d.nl' % i))
+                   for i, c in enumerate(bulk)]
+        for t in threads:
+            t.start()
+        # one check upstream, two waiting
+        while proxy.status()['queue'] < 2:
+            time.sleep(0.001)
+        portal.domain_delete('nfg.nl')
+        done.append('delete')
+        for t in threads:
+            t.join()
+        self.failUnless(done.index('delete') <= 1)
+        for c in bulk + [portal]:
+            c.logout()
+        proxy.shutdown()
+        proxy.server_close()
+        upstream.shutdown()
+        upstream.server_close()
+
+
+class testSIDNEppCoalesce(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = SIDNEppFakeServer(('127.0.0.1', 0),
+                                          latency=0.1).start()
+
+    def tearDown(self):
+        self.upstream.shutdown()
+        self.upstream.server_close()
+
+    def sent(self, command):
+        return len([d for d in self.upstream.commands if d[0] == command])
+
+    def lookups(self, proxy, names):
+        """ an info per name, each from its own connection, all at once;
+        returns whether every reply carried its own clTRID """
+        host, port = proxy.server_address
+        clients = [SIDNEppClient(host, port, testuser, testpass, ssl=False)
+                   for name in names]
+        ok = []
+
+        def info(c, i, name):
+            command = TEMPLATES['domain_info'].fill(name=name,
+                                                    cltrid='C-%d' % i)
+            reply = c.write(command)
+            ok.append(c.get_cltrid(reply) == command.cltrid and
+                      c.query(reply, '//domain:name/text()') == [name])
+        threads = [threading.Thread(target=info, args=(c, i, name))
+                   for i, (c, name) in enumerate(zip(clients, names))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for c in clients:
+            c.logout()
+        return ok == [True] * len(names)
+
+    def serve(self, proxy):
+        host, port = self.upstream.server_address
+        proxy.login(host, port, testuser, testpass, ssl=False)
+        t = threading.Thread(target=proxy.serve_forever, args=(0.01,))
+        t.daemon = True
+        t.start()
+        return t
+
+    def testAsyncProxy(self):
+        proxy = SIDNEppAsyncProxy(('127.0.0.1', 0))
+        t = self.serve(proxy)
+        try:
+            self.failUnless(self.lookups(proxy, ['nfg.nl'] * 4))
+            self.failUnless(self.sent('info') == 1)
+            self.failUnless(proxy.status()['coalesced'] == 3)
+            self.failUnless(self.lookups(proxy, ['nfg.nl', 'nfgs.nl']))
+            self.failUnless(self.sent('info') == 3)
+        finally:
+            proxy.shutdown()
+            t.join()
+            proxy.server_close()
+
+    def testThreadingProxy(self):
+        proxy = SIDNEppThreadingProxy(('127.0.0.1', 0))
+        self.serve(proxy)
+        try:
+            self.failUnless(self.lookups(proxy, ['nfg.nl'] * 4))
+            self.failUnless(self.sent('info') == 1)
+            proxy.coalesce = False
+            self.failUnless(self.lookups(proxy, ['nfg.nl'] * 2))
+            self.failUnless(self.sent('info') == 3)
+        finally:
+            proxy.shutdown()
+            proxy.server_close()
+            proxy.logout()
+
+
+class VersionedHandler(SIDNEppFakeHandler):
+    """ info answers, in its result message, how many updates there had
+    been when it came in; it takes `info_latency` seconds """
+
+    commands = dict(SIDNEppFakeHandler.commands, update='_handle_update')
+
+    def _handle_info(self, req, description):
+        version = self.server.version
+        time.sleep(self.server.info_latency)
+        self.write(self.response(req, msg='V%d' % version))
+
+    def _handle_update(self, req, description):
+        self.server.version += 1
+        self.write(self.response(req))
+
+
+class testSIDNEppCoalesceUpdate(unittest.TestCase):
+    """ reads that come after an update do not share the reply to a read
+    sent before it, nor is that reply cached """
+
+    def setUp(self):
+        self.upstream = SIDNEppFakeServer(('127.0.0.1', 0),
+                                          handler=VersionedHandler).start()
+        self.upstream.version = 0
+        self.upstream.info_latency = 0.3
+
+    def tearDown(self):
+        self.upstream.shutdown()
+        self.upstream.server_close()
+
+    def version(self, c):
+        reply = c.domain_info('nfg.nl')
+        return c.query(reply, '//epp:result/epp:msg/text()')[0]
+
+    def infoUpdateInfo(self, proxy):
+        proxy.cache = SIDNEppInfoCache(ttl=60)
+        host, port = self.upstream.server_address
+        # the update must not wait for the session of the first info
+        proxy.login(host, port, testuser, testpass, sessions=2, ssl=False)
+        t = threading.Thread(target=proxy.serve_forever, args=(0.01,))
+        t.daemon = True
+        t.start()
+        host, port = proxy.server_address
+        clients = [SIDNEppClient(host, port, testuser, testpass, ssl=False)
+                   for i in range(3)]
+        early = []
+        reader = threading.Thread(target=lambda: early.append(
+            self.version(clients[0])))
+        reader.start()
+        while not [d for d in self.upstream.commands if d[0] == 'info']:
+            time.sleep(0.001)
+        clients[1].domain_update('nfg.nl', {'chg': {'owner': 'NFG001'}})
+        # while the first info is still in flight
+        late = self.version(clients[2])
+        reader.join()
+        again = self.version(clients[2])
+        for c in clients:
+            c.logout()
+        proxy.shutdown()
+        proxy.server_close()
+        return early[0], late, again
+
+    def testAsyncProxy(self):
+        proxy = SIDNEppAsyncProxy(('127.0.0.1', 0))
+        self.failUnless(self.infoUpdateInfo(proxy) == ('V0', 'V1', 'V1'))
+
+    def testThreadingProxy(self):
+        proxy = SIDNEppThreadingProxy(('127.0.0.1', 0))
+        try:
+            self.failUnless(self.infoUpdateInfo(proxy) ==
+                            ('V0', 'V1', 'V1'))
+        finally:
+            proxy.logout()
+
+
+class testSIDNEppKeepalive(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SIDNEppFakeServer(('127.0.0.1', 0)).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sent(self, command):
+        return len([d for d in self.server.commands if d[0] == command])
+
+    def pool(self, **kwargs):
+        host, port = self.server.server_address
+        return SIDNEppClientPool(host, port, testuser, testpass, ssl=False,
+                                 **kwargs)
+
+    def testPrewarm(self):
+        pool = self.pool(minsize=3, maxsize=3)
+        self.failUnless(pool.stats()['idle'] == 3)
+        self.failUnless(self.sent('login') == 3)
+        pool.logout()
+
+    def testHello(self):
+        pool = self.pool(minsize=2, keepalive=0.05)
+        time.sleep(0.2)
+        self.failUnless(self.sent('hello') >= 4)
+        self.failUnless(pool.states() == {STATE_LOGGEDIN: 2})
+        pool.logout()
+
+    def testTopUp(self):
+        pool = self.pool(minsize=2, keepalive=60)
+        client = pool.acquire()
+        client.close()
+        pool.release(client)
+        self.failUnless(pool.stats()['size'] == 1)
+        pool.maintain()
+        self.failUnless(pool.stats()['size'] == 2)
+        self.failUnless(pool.states() == {STATE_LOGGEDIN: 2})
+        pool.logout()
+
+    def testAsyncProxy(self):
+        host, port = self.server.server_address
+        proxy = SIDNEppAsyncProxy(('127.0.0.1', 0))
+        proxy.login(host, port, testuser, testpass, sessions=2, ssl=False,
+                    keepalive=0.05)
+        t = threading.Thread(target=proxy.serve_forever, args=(0.01,))
+        t.daemon = True
+        t.start()
+        time.sleep(0.3)
+        proxy.shutdown()
+        t.join()
+        proxy.server_close()
+        self.failUnless(self.sent('login') == 2)
+        self.failUnless(self.sent('hello') >= 4)
+
+    def testAsyncReconnect(self):
+        # without keepalive, lost sessions are re-opened all the same
+        host, port = self.server.server_address
+        proxy = SIDNEppAsyncProxy(('127.0.0.1', 0))
+        proxy.reconnect = 0.05
+        proxy.login(host, port, testuser, testpass, ssl=False)
+        t = threading.Thread(target=proxy.serve_forever, args=(0.01,))
+        t.daemon = True
+        t.start()
+        self.server.errors['login'] = '2200'
+        proxy._upstream[0].client._fd.shutdown(socket.SHUT_RDWR)
+        while proxy._upstream:
+            time.sleep(0.01)
+        del self.server.errors['login']
+        deadline = time.time() + 2
+        while not proxy.ready() and time.time() < deadline:
+            time.sleep(0.01)
+        self.failUnless(proxy.ready())
+        proxy.shutdown()
+        t.join()
+        proxy.server_close()
+
+
+class testSIDNEppTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.p = SIDNEppProtocol()
+
+    def testFill(self):
+        for name, t in sorted(TEMPLATES.items()):
+            c = t.fill(**dict((f, 'a&b') for f in t.fields))
+            x = self.p.parse(c)
+            self.failUnless(x is not None, name)
+            self.failUnless(self.p.get_cltrid(x) == c.cltrid, name)
+            self.failIf('\n' in c.split('?>', 1)[1].strip(), name)
+
+    def testDomainUpdate(self):
+        updates = []
+
+        class Client(SIDNEppClient):
+            def __init__(self):
+                pass
+
+            def write(self, message):
+                updates.append(message)
+
+        Client().domain_update('nfg.nl', {
+            'add': {'ns': ['ns1.nfg.nl'], 'tech': 'NFG001'},
+            'rem': {'admin': 'NFG002'},
+            'chg': {'owner': 'NFG<3>'}})
+        x = self.p.parse(updates[0])
+        self.failUnless(self.p.describe(x) == ('update', 'domain', ['nfg.nl']))
+        self.failUnless(self.p.query(
+            x, '//domain:add/domain:ns/domain:hostObj/text()') ==
+            ['ns1.nfg.nl'])
+        self.failUnless(self.p.query(
+            x, '//domain:add/domain:contact[@type="tech"]/text()') ==
+            ['NFG001'])
+        self.failUnless(self.p.query(
+            x, '//domain:rem/domain:contact[@type="admin"]/text()') ==
+            ['NFG002'])
+        self.failUnless(self.p.query(
+            x, '//domain:chg/domain:registrant/text()') == ['NFG<3>'])
+
+
+class testSIDNEppInfoCache(unittest.TestCase):
+
+    reply = """<?xml version="1.0" encoding="UTF-8"?>
+    <epp xmlns="urn:ietf:params:xml:ns:epp-1.0">
+    <response>
+    <result code="1000"><msg>ok</msg></result>
+    <trID><clTRID>%s</clTRID><svTRID>SV-1</svTRID></trID>
+    </response>
+    </epp>"""
+
+    poll = """<?xml version="1.0" encoding="UTF-8"?>
+    <epp xmlns="urn:ietf:params:xml:ns:epp-1.0">
+    <response>
+    <result code="1301"><msg>picked up</msg></result>
+    <msgQ count="9" id="100000">
+    <msg>1202 Change to name server %s processed</msg>
+    </msgQ>
+    <trID><clTRID>P-1</clTRID><svTRID>SV-2</svTRID></trID>
+    </response>
+    </epp>"""
+
+    def setUp(self):
+        self.o = SIDNEppInfoCache(size=10, ttl=60)
+
+    def command(self, verb, obj='host', name='ns1.nfg.nl', cltrid=None):
+        e = self.o.e_epp
+        m = getattr(self.o, 'e_' + obj)
+        key = obj == 'contact' and 'id' or 'name'
+        x = e.epp(e.command(getattr(e, verb)(getattr(m, verb)(
+            getattr(m, key)(name)))))
+        self.o.set_cltrid(x, cltrid)
+        return x
+
+    def learn(self, req):
+        reply = self.o.parse(self.reply % self.o.get_cltrid(req))
+        self.o.update(req, reply)
+
+    def testHit(self):
+        self.learn(self.command('info', cltrid='A-1'))
+        r = self.o.lookup(self.command('info', name='NS1.nfg.nl',
+                                       cltrid='B-2'))
+        self.failUnless(self.o.get_cltrid(r) == 'B-2')
+        self.failIf(self.o.query(r, '//epp:svTRID/text()') == ['SV-1'])
+        self.failUnless(self.o.lookup(self.command('info', 'domain')) is None)
+        self.failUnless(self.o.stats()['hits'] == 1)
+
+    def testTransform(self):
+        for obj in ('host', 'domain', 'contact'):
+            self.learn(self.command('info', obj))
+            self.failUnless(self.o.lookup(self.command('info', obj))
+                            is not None)
+            self.learn(self.command('update', obj))
+            self.failUnless(self.o.lookup(self.command('info', obj)) is None)
+
+    def testCancelDelete(self):
+        self.learn(self.command('info', 'domain', 'nfg.nl'))
+        s = self.o.e_sidn
+        x = self.o.e_xsi.epp(self.o.e_xsi.extension(
+            s.command(s.domainCancelDelete(s.name('nfg.nl')))))
+        self.learn(x)
+        self.failUnless(self.o.lookup(
+            self.command('info', 'domain', 'nfg.nl')) is None)
+
+    def testPoll(self):
+        self.learn(self.command('info', name='ns1.bol.nl'))
+        e = self.o.e_epp
+        self.o.update(e.epp(e.command(e.poll(op='req'))),
+                      self.o.parse(self.poll % 'ns1.bol.nl'))
+        self.failUnless(self.o.lookup(
+            self.command('info', name='ns1.bol.nl')) is None)
+
+    def testChangedInFlight(self):
+        started = time.time()
+        self.learn(self.command('delete'))
+        req = self.command('info')
+        self.o.update(req, self.o.parse(self.reply % 'X'), started=started)
+        self.failUnless(self.o.lookup(self.command('info')) is None)
+
+    def testExpire(self):
+        self.o = SIDNEppInfoCache(size=10, ttl=0)
+        self.learn(self.command('info'))
+        time.sleep(0.01)
+        self.failUnless(self.o.lookup(self.command('info')) is None)
+
+
+class testSIDNEppCheckCache(unittest.TestCase):
+
+    reply = """<?xml version="1.0" encoding="UTF-8"?>
+    <epp xmlns="urn:ietf:params:xml:ns:epp-1.0"
+    xmlns:domain="urn:ietf:params:xml:ns:domain-1.0">
+    <response>
+    <result code="1000"><msg>ok</msg></result>
+    <resData><domain:chkData>
+    <domain:cd><domain:name avail="true">free.nl</domain:name></domain:cd>
+    <domain:cd><domain:name avail="false">nfg.nl</domain:name>
+    <domain:reason>In use</domain:reason></domain:cd>
+    </domain:chkData></resData>
+    <trID><clTRID>A-1</clTRID><svTRID>SV-1</svTRID></trID>
+    </response>
+    </epp>"""
+
+    def setUp(self):
+        self.o = SIDNEppCheckCache(size=10, avail_ttl=60, taken_ttl=60)
+
+    def command(self, verb, *names, **kw):
+        e = self.o.e_epp
+        m = self.o.e_domain
+        x = e.epp(e.command(getattr(e, verb)(getattr(m, verb)(
+            *[m.name(n) for n in names]))))
+        self.o.set_cltrid(x, kw.get('cltrid'))
+        return x
+
+    def learn(self, started=None):
+        req = self.command('check', 'free.nl', 'nfg.nl', cltrid='A-1')
+        self.o.update(req, self.o.parse(self.reply), started=started)
+
+    def testHit(self):
+        self.learn()
+        r = self.o.lookup(self.command('check', 'NFG.nl', 'free.nl',
+                                       cltrid='B-2'))
+        self.failUnless(self.o.get_cltrid(r) == 'B-2')
+        self.failUnless(self.o.query(r, '//domain:name/@avail') ==
+                        ['false', 'true'])
+        self.failUnless(self.o.query(r, '//domain:reason/text()') ==
+                        ['In use'])
+
+    def testMiss(self):
+        self.learn()
+        self.failUnless(self.o.lookup(
+            self.command('check', 'nfg.nl', 'other.nl')) is None)
+        self.failUnless(self.o.lookup(self.command('info', 'nfg.nl')) is None)
+
+    def testTTL(self):
+        self.o = SIDNEppCheckCache(size=10, avail_ttl=0, taken_ttl=60)
+        self.learn()
+        time.sleep(0.01)
+        self.failUnless(self.o.lookup(self.command('check', 'free.nl'))
+                        is None)
+        self.failUnless(self.o.lookup(self.command('check', 'nfg.nl'))
+                        is not None)
+
+    def testCreate(self):
+        self.learn()
+        self.o.update(self.command('create', 'free.nl'),
+                      self.o.parse(self.reply))
+        self.failUnless(self.o.lookup(self.command('check', 'free.nl'))
+                        is None)
+        self.failUnless(self.o.lookup(self.command('check', 'nfg.nl'))
+                        is not None)
+
+    def testChangedInFlight(self):
+        started = time.time()
+        self.o.update(self.command('delete', 'nfg.nl'),
+                      self.o.parse(self.reply))
+        self.learn(started)
+        self.failUnless(self.o.lookup(self.command('check', 'nfg.nl'))
+                        is None)
+
+
+class WhoisHandler(BaseHTTPRequestHandler):
+    """ stand-in for the whois service, knows every domain but bad.nl """
+
+    protocol_version = 'HTTP/1.1'
+
+    response = """<?xml version="1.0" encoding="UTF-8"?>
+    <whois-response xmlns="http://rxsd.domain-registry.nl/sidn-whois-drs50">
+    <domain><name>%s</name><status><code>active</code></status></domain>
+    </whois-response>"""
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        domain = self.path.split('/')[-1]
+        if domain == 'bad.nl':
+            self.send_error(404)
+            return
+        body = self.response % domain
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class WhoisServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+    requests = 0
+    # seconds to sleep before answering
+    delay = 0
+
+
+class WhoisTestCase(unittest.TestCase):
+    """ runs a WhoisServer for every test """
+
+    def setUp(self):
+        self.server = WhoisServer(('127.0.0.1', 0), WhoisHandler)
+        self.t = threading.Thread(target=self.server.serve_forever,
+                                  kwargs=dict(poll_interval=0.01))
+        self.t.daemon = True
+        self.t.start()
+        self.baseurl = 'http://127.0.0.1:%d/whois/%%s' % \
+            self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class testSIDNWhois(WhoisTestCase):
+
+    def testMany(self):
+        domains = ['nfg-%d.nl' % i for i in range(20)]
+        found = {}
+        for domain, whois in lookup_many(domains, concurrency=4,
+                                         baseurl=self.baseurl):
+            self.failUnless(isinstance(whois, SIDNWhois))
+            found[domain] = whois.xpath('/whois-response/domain/name')[0].text
+        self.failUnless(found == dict((d, d) for d in domains))
+        # every thread kept its connection
+        self.failUnless(self.server.connections <= 4)
+
+    def testError(self):
+        results = dict(lookup_many(['nfg.nl', 'bad.nl'],
+                                   baseurl=self.baseurl))
+        self.failUnless(isinstance(results['nfg.nl'], SIDNWhois))
+        self.failUnless(isinstance(results['bad.nl'], IOError))
+
+    def testRate(self):
+        start = time.time()
+        results = list(lookup_many(['nfg-%d.nl' % i for i in range(6)],
+                                   concurrency=6, rate=50,
+                                   baseurl=self.baseurl))
+        self.failUnless(len(results) == 6)
+        self.failUnless(time.time() - start >= 0.1)
+
+    def testResult(self):
+        for domain, whois in lookup_many(['nfg.nl'], baseurl=self.baseurl):
+            r = whois.result()
+        self.failUnless(r.domain == 'nfg.nl' and r.status == 'active')
+        # plain strings, that don't hold on to the tree
+        self.failUnless(type(r.domain) is str)
+        self.failIf(hasattr(r, '__dict__'))
+
+    def testResultFields(self):
+        r = SIDNWhois('nfg.nl', response="""<?xml version="1.0"?>
+        <whois-response xmlns="http://rxsd.domain-registry.nl/sidn-whois-drs50">
+        <domain><name>nfg.nl</name>
+        <status><code>active</code></status>
+        <status><code>clientTransferProhibited</code></status></domain>
+        <registrar><name>NFG</name>
+        <address><street>Maagdenburgstraat 7</street><city>Deventer</city>
+        </address></registrar>
+        <nameserver><name>ns1.nfgs.net</name>
+        <ip>192.0.2.1</ip><ip>192.0.2.2</ip><ip>2001:db8::1</ip></nameserver>
+        <nameserver><name>ns2.nfgs.net</name><ip>192.0.2.3</ip></nameserver>
+        </whois-response>""").result()
+        self.failUnless(r.status == 'active')
+        self.failUnless(r.statuses == ('active', 'clientTransferProhibited'))
+        self.failUnless(r.registrar['address'] == dict(
+            street='Maagdenburgstraat 7', city='Deventer'))
+        self.failUnless(r.nameservers[0]['ip'] ==
+                        ['192.0.2.1', '192.0.2.2', '2001:db8::1'])
+        self.failUnless(r.nameservers[1]['ip'] == '192.0.2.3')
+
+    def testStop(self):
+        domains = ('nfg-%d.nl' % i for i in xrange(1000))
+        for domain, whois in lookup_many(domains, baseurl=self.baseurl):
+            break
+        # the workers stopped taking domains
+        self.failUnless(len(list(domains)) > 900)
+
+
+
+class testSIDNWhoisCache(WhoisTestCase):
+
+    def setUp(self):
+        WhoisTestCase.setUp(self)
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'whois.db')
+
+    def tearDown(self):
+        WhoisTestCase.tearDown(self)
+        shutil.rmtree(self.tmp)
+
+    def cache(self, **kwargs):
+        return SIDNWhoisCache(baseurl=self.baseurl, **kwargs)
+
+    def testHit(self):
+        c = self.cache()
+        w = c.lookup('nfg.nl')
+        # neither fetched nor parsed again
+        self.failUnless(c.lookup('NFG.nl') is w)
+        self.failUnless(self.server.requests == 1)
+        self.failUnless(c.stats()['hits'] == 1)
+
+    def testExpire(self):
+        c = self.cache(ttl=0.01)
+        w = c.lookup('nfg.nl')
+        time.sleep(0.02)
+        self.failIf(c.lookup('nfg.nl') is w)
+        self.failUnless(self.server.requests == 2)
+
+    def testStale(self):
+        c = self.cache(ttl=0.01, stale=60)
+        w = c.lookup('nfg.nl')
+        time.sleep(0.02)
+        # the stale result, while a fresh one is fetched
+        self.failUnless(c.lookup('nfg.nl') is w)
+        for i in range(100):
+            if c.stats()['fetches'] == 2 and not c.stats()['refreshing']:
+                break
+            time.sleep(0.01)
+        self.failUnless(self.server.requests == 2)
+        self.failIf(c.lookup('nfg.nl') is w)
+
+    def testStore(self):
+        c = self.cache(path=self.path)
+        c.lookup('nfg.nl')
+        c.close()
+        # a restart
+        c = self.cache(path=self.path)
+        w = c.lookup('nfg.nl')
+        self.failUnless(isinstance(w, SIDNWhoisResult))
+        self.failUnless(w.domain == 'nfg.nl')
+        self.failUnless(self.server.requests == 1)
+        c.invalidate('nfg.nl')
+        c.close()
+        c = self.cache(path=self.path)
+        c.lookup('nfg.nl')
+        self.failUnless(self.server.requests == 2)
+        c.close()
+
+    def testConcurrentMiss(self):
+        self.server.delay = 0.1
+        c = self.cache()
+        found = []
+        threads = [threading.Thread(target=lambda: found.append(
+            c.lookup('nfg.nl'))) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # one fetch, shared by all
+        self.failUnless(self.server.requests == 1)
+        self.failUnless(c.stats()['fetches'] == 1)
+        self.failUnless(len(set(map(id, found))) == 1)
+
+
 if __name__ == '__main__':
     unittest.main()
 
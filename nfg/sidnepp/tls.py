@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+# interface for SIDN EPP
+#
+# license: GPLv3
+#
+# copyright 2010-2013, NFG Net Facilities Group BV, www.nfg.nl
+#
+# Paul Stevens, paul@nfg.nl
+
+import ssl
+import threading
+
+# SSLContext per configuration, shared by all sessions
+_contexts = {}
+# last TLS session per (host, port), offered again on the next handshake
+_sessions = {}
+_lock = threading.Lock()
+
+# whether this python can offer a previous session to the server
+RESUMPTION = hasattr(ssl, 'SSLSession')
+
+
+def context(cafile=None, certfile=None, keyfile=None, verify=None):
+    """ the SSLContext for a configuration, made once per process
+
+    With a `cafile` the server certificate is verified against it, and
+    so is its name; without one it is not checked at all, as before
+    there were contexts. `certfile` and `keyfile` are the client
+    certificate and its key, for registries that ask for one.
+
+    >>> context() is context()
+    True
+    >>> context().verify_mode == ssl.CERT_NONE
+    True
+    >>> context(verify=True).check_hostname
+    True
+    """
+    if verify is None:
+        verify = bool(cafile)
+    key = (cafile, certfile, keyfile, verify)
+    with _lock:
+        ctx = _contexts.get(key)
+        if ctx is None:
+            ctx = _contexts[key] = _context(cafile, certfile, keyfile,
+                                            verify)
+        return ctx
+
+
+def _context(cafile, certfile, keyfile, verify):
+    ctx = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    ctx.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    if verify:
+        ctx.verify_mode = ssl.CERT_REQUIRED
+        ctx.check_hostname = True
+        if cafile:
+            ctx.load_verify_locations(cafile)
+        else:
+            ctx.load_default_certs()
+    if certfile:
+        ctx.load_cert_chain(certfile, keyfile)
+    return ctx
+
+
+def wrap(sock, host, port, ctx=None, handshake=True):
+    """ wrap a connected socket for `host`, resuming the TLS session of
+    the previous connection to it where possible """
+    if ctx is None or ctx is True:
+        ctx = context()
+    kwargs = {}
+    if RESUMPTION:
+        with _lock:
+            session = _sessions.get((host, port))
+        if session is not None:
+            kwargs['session'] = session
+    s = ctx.wrap_socket(sock, server_hostname=host,
+                        do_handshake_on_connect=handshake,
+                        suppress_ragged_eofs=False, **kwargs)
+    if handshake:
+        remember(s, host, port)
+    return s
+
+
+def remember(sock, host, port):
+    """ keep the session of a finished handshake for the next one """
+    if RESUMPTION and sock.session is not None:
+        with _lock:
+            _sessions[(host, port)] = sock.session
+
+
+def resumed(sock):
+    """ whether the handshake on `sock` resumed an earlier session """
+    return bool(RESUMPTION and sock.session_reused)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod(optionflags=doctest.ELLIPSIS)
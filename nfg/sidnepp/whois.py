@@ -1,31 +1,265 @@
 
 
+import time
+import socket
 import urllib
+import httplib
+import urlparse
+import threading
+import Queue
+import sqlite3
 import lxml.etree as et
 
+import sys
+import os.path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from nfg.sidnepp.cache import LRUCache
+from nfg.sidnepp.coalesce import SIDNEppSingleFlight
+
+import logging
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+formatter = logging.Formatter(
+    "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+ch.setFormatter(formatter)
+log.addHandler(ch)
+
 BASEURL="http://names.nfgs.net/whois/%s"
 
+class SIDNWhoisConnection(object):
+    """
+    persistent HTTP connection to the whois service
+
+    The connection is kept open between lookups. A lookup on a
+    connection the server has closed in the meantime is sent again, once,
+    on a new connection.
+    """
+
+    def __init__(self, baseurl=BASEURL, timeout=10):
+        url = urlparse.urlsplit(baseurl)
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path
+        self.timeout = timeout
+        self._conn = None
+
+    def get(self, domain):
+        """ the whois response for `domain`, as received """
+        path = self.path % urllib.quote(domain)
+        for attempt in (0, 1):
+            if self._conn is None:
+                self._conn = httplib.HTTPConnection(self.host, self.port,
+                                                    timeout=self.timeout)
+            try:
+                self._conn.request('GET', path)
+                r = self._conn.getresponse()
+                body = r.read()
+            except (httplib.HTTPException, socket.error):
+                self.close()
+                if attempt:
+                    raise
+                continue
+            if r.status != 200:
+                raise IOError("whois %s: HTTP %d %s" % (domain, r.status,
+                                                        r.reason))
+            return body
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class _Throttle(object):
+    """ spaces calls out to at most `rate` per second, over all threads """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+def lookup_many(domains, concurrency=4, rate=None, baseurl=BASEURL,
+                timeout=10):
+    """
+    look up many domains at once
+
+    `domains` may be any iterable, and is read as the lookups go.
+    `concurrency` lookups run at the same time, each thread on its own
+    persistent connection, and no more than `rate` lookups start per
+    second. Yields (domain, SIDNWhois) as lookups complete, in no
+    particular order; when a lookup failed the exception takes the place
+    of the SIDNWhois.
+    """
+    domains = iter(domains)
+    lock = threading.Lock()
+    stopped = threading.Event()
+    done = Queue.Queue(concurrency * 2)
+    throttle = rate and _Throttle(rate)
+
+    def work():
+        conn = SIDNWhoisConnection(baseurl, timeout)
+        try:
+            while not stopped.is_set():
+                with lock:
+                    domain = next(domains, None)
+                if domain is None:
+                    break
+                if throttle:
+                    throttle.wait()
+                try:
+                    result = SIDNWhois(domain, conn)
+                except Exception, why:
+                    result = why
+                done.put((domain, result))
+        finally:
+            conn.close()
+            done.put(None)
+
+    workers = [threading.Thread(target=work) for i in range(concurrency)]
+    for w in workers:
+        w.daemon = True
+        w.start()
+    running = len(workers)
+    try:
+        while running:
+            item = done.get()
+            if item is None:
+                running -= 1
+            else:
+                yield item
+    finally:
+        # the caller may stop early, let the workers finish up
+        stopped.set()
+        while running:
+            if done.get() is None:
+                running -= 1
+
+NAMESPACES = {'w':'http://rxsd.domain-registry.nl/sidn-whois-drs50'}
+
+def _xpath(q):
+    # plain strings, that don't keep the tree alive the way lxml's
+    # "smart" strings do
+    return et.XPath(q, namespaces=NAMESPACES, smart_strings=False)
+
+# compiled once per process
+_DOMAIN = _xpath('/w:whois-response/w:domain')
+_NAME = _xpath('/w:whois-response/w:domain/w:name/text()')
+_STATUS = _xpath('/w:whois-response/w:domain/w:status/w:code/text()')
+_REGISTRAR = _xpath('/w:whois-response/w:registrar')
+_CONTACT = _xpath('/w:whois-response/w:contact')
+_NAMESERVER = _xpath('/w:whois-response/w:nameserver')
+_CHILDREN = _xpath('*')
+
+# SIDNWhois.xpath() queries, compiled on first use
+_compiled = {}
+
+def _record(el):
+    """ attributes and children of an element, as a dict: the text of a
+    plain child, the record of a child with children or attributes of
+    its own, and a list of these for a child that occurs more than once
+    """
+    record = dict(el.attrib)
+    children = _CHILDREN(el)
+    if not children and el.text and el.text.strip():
+        record['text'] = el.text
+    for child in children:
+        name = child.tag.rsplit('}', 1)[-1]
+        if len(child) or child.attrib:
+            value = _record(child)
+        else:
+            value = child.text
+        if name not in record:
+            record[name] = value
+        elif isinstance(record[name], list):
+            record[name].append(value)
+        else:
+            record[name] = [record[name], value]
+    return record
+
 class SIDNWhoisResult(object):
+    """
+    what a whois response says about a domain, without the tree
+
+    `status` is the first status code of the domain, `statuses` all of
+    them. `registrar` is a dict of the fields of the registrar, see
+    _record(), `contacts` and `nameservers` are tuples of such dicts.
+
+    >>> r = SIDNWhoisResult.extract(et.fromstring(
+    ...     '<whois-response xmlns="%s">'
+    ...     '<domain><name>nfg.nl</name><status><code>active</code></status>'
+    ...     '</domain><registrar><name>NFG</name></registrar>'
+    ...     '<contact role="tech"><handle>NFG001</handle></contact>'
+    ...     '<nameserver><name>ns1.nfgs.net</name>'
+    ...     '<ip>192.0.2.1</ip><ip>2001:db8::1</ip></nameserver>'
+    ...     '</whois-response>' % NAMESPACES['w']))
+    >>> r
+    <SIDNWhoisResult nfg.nl: active>
+    >>> r.registrar
+    {'name': 'NFG'}
+    >>> sorted(r.contacts[0].items())
+    [('handle', 'NFG001'), ('role', 'tech')]
+    >>> sorted(r.nameservers[0].items())
+    [('ip', ['192.0.2.1', '2001:db8::1']), ('name', 'ns1.nfgs.net')]
+    """
 
+    __slots__ = ('domain', 'status', 'statuses', 'registrar', 'contacts',
+                 'nameservers')
 
-    def __init__(self, el):
-        self._element = el
+    def __init__(self, domain, status=None, registrar=None, contacts=(),
+                 nameservers=(), statuses=None):
+        self.domain = domain
+        self.status = status
+        if statuses is None:
+            statuses = status and (status,) or ()
+        self.statuses = statuses
+        self.registrar = registrar
+        self.contacts = contacts
+        self.nameservers = nameservers
 
-    def query(self, q):
-        return self._element.xpath(q,namespaces=self.namespace)
+    @classmethod
+    def extract(cls, element):
+        name = _NAME(element)
+        status = _STATUS(element)
+        registrar = _REGISTRAR(element)
+        return cls(name and name[0] or None,
+                   status and status[0] or None,
+                   registrar and _record(registrar[0]) or None,
+                   tuple(_record(c) for c in _CONTACT(element)),
+                   tuple(_record(n) for n in _NAMESERVER(element)),
+                   tuple(status))
+
+    def __repr__(self):
+        return '<SIDNWhoisResult %s: %s>' % (self.domain, self.status)
 
 class SIDNWhois(object):
 
-    namespaces = {'w':'http://rxsd.domain-registry.nl/sidn-whois-drs50'}
+    namespaces = NAMESPACES
 
-    def __init__(self, domain):
+    def __init__(self, domain, connection=None, response=None):
         """
         >>> s = SIDNWhois('nfg.nl')
         >>> s._result
         <Element {http://rxsd.domain-registry.nl/sidn-whois-drs50}whois-response at ...>
 
         """
-        self._result = et.fromstring(urllib.urlopen(BASEURL % domain).read())
+        self.domain = domain
+        if response is None and connection is None:
+            response = urllib.urlopen(BASEURL % domain).read()
+        elif response is None:
+            response = connection.get(domain)
+        self.response = response
+        self._result = et.fromstring(response)
 
     def xpath(self, q):
         """
@@ -41,7 +275,16 @@ class SIDNWhois(object):
         'active'
 
         """
-        return self._result.xpath(q.replace("/","/w:"),namespaces=self.namespaces)
+        x = _compiled.get(q)
+        if x is None:
+            x = _compiled[q] = et.XPath(q.replace("/","/w:"),
+                                        namespaces=self.namespaces)
+        return x(self._result)
+
+    def result(self):
+        """ the parts of the response callers look at, see SIDNWhoisResult
+        """
+        return SIDNWhoisResult.extract(self._result)
 
     def getDomain(self):
         """
@@ -49,7 +292,7 @@ class SIDNWhois(object):
         >>> s.getDomain()
         [<Element {http://rxsd.domain-registry.nl/sidn-whois-drs50}domain at ...>]
         """
-        return self.xpath('/whois-response/domain')
+        return _DOMAIN(self._result)
 
     def getRegistrar(self):
         """
@@ -57,7 +300,7 @@ class SIDNWhois(object):
         >>> s.getRegistrar()
         [<Element {http://rxsd.domain-registry.nl/sidn-whois-drs50}registrar at ...>]
         """
-        return self.xpath('/whois-response/registrar')
+        return _REGISTRAR(self._result)
 
     def getContact(self):
         """
@@ -65,7 +308,7 @@ class SIDNWhois(object):
         >>> s.getContact()
         [<Element {http://rxsd.domain-registry.nl/sidn-whois-drs50}contact at ...>, ...]
         """
-        return self.xpath('/whois-response/contact')
+        return _CONTACT(self._result)
 
     def getNameserver(self):
         """
@@ -73,7 +316,182 @@ class SIDNWhois(object):
         >>> s.getNameserver()
         [<Element {http://rxsd.domain-registry.nl/sidn-whois-drs50}nameserver at ...>]
         """
-        return self.xpath('/whois-response/nameserver')
+        return _NAMESERVER(self._result)
+
+
+class SIDNWhoisStore(object):
+    """
+    whois responses on disk, in SQLite, so that they survive a restart
+
+    >>> s = SIDNWhoisStore(':memory:')
+    >>> s.put('nfg.nl', '<whois-response/>', fetched=100)
+    >>> s.get('nfg.nl')
+    (100.0, '<whois-response/>')
+    >>> s.purge(older=200)
+    1
+    >>> s.get('nfg.nl') is None
+    True
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS whois ("
+                             "domain TEXT PRIMARY KEY, "
+                             "fetched REAL, "
+                             "response BLOB)")
+            self._db.commit()
+
+    def get(self, domain):
+        """ (fetched, response) or None """
+        with self._lock:
+            row = self._db.execute("SELECT fetched, response FROM whois "
+                                   "WHERE domain = ?", (domain,)).fetchone()
+        return row and (row[0], str(row[1])) or None
+
+    def put(self, domain, response, fetched=None):
+        if fetched is None:
+            fetched = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO whois VALUES (?, ?, ?)",
+                             (domain, fetched, sqlite3.Binary(response)))
+            self._db.commit()
+
+    def delete(self, domain):
+        with self._lock:
+            self._db.execute("DELETE FROM whois WHERE domain = ?", (domain,))
+            self._db.commit()
+
+    def purge(self, older):
+        """ drop responses fetched before `older`, return how many """
+        with self._lock:
+            n = self._db.execute("DELETE FROM whois WHERE fetched < ?",
+                                 (older,)).rowcount
+            self._db.commit()
+        return n
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class SIDNWhoisCache(object):
+    """
+    whois lookups, answered from memory or disk where possible
+
+    lookup() returns a SIDNWhoisResult. Results are kept in memory, at
+    most `size` of them, and are fresh for `ttl` seconds. With a `path`
+    the responses are kept in SQLite as well, and are still good after a
+    restart for as long as they are fresh.
+
+    A result that is no longer fresh, but less than `stale` seconds
+    past that, is returned as is while a background thread fetches a
+    new one. Older results are fetched again before returning. Lookups
+    of a domain that is being fetched wait for that fetch instead of
+    starting their own.
+    """
+
+    def __init__(self, size=1024, ttl=3600, stale=0, path=None,
+                 baseurl=BASEURL, timeout=10):
+        self.ttl = ttl
+        self.stale = stale
+        self.baseurl = baseurl
+        self.timeout = timeout
+        # (fetched, SIDNWhoisResult), kept for as long as they may be
+        # served
+        self._memory = LRUCache(size, ttl + stale)
+        self._store = path and SIDNWhoisStore(path) or None
+        self._local = threading.local()
+        self._flights = SIDNEppSingleFlight()
+        # guards _refreshing and fetches
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self.fetches = 0
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = SIDNWhoisConnection(self.baseurl,
+                                                          self.timeout)
+        return conn
+
+    def _remember(self, key, fetched, result):
+        self._memory.put(key, (fetched, result),
+                         ttl=fetched + self.ttl + self.stale - time.time())
+
+    def _fetch(self, key):
+        """ fetch `key`, or wait for the fetch of it already running """
+        return self._flights.run(key, lambda: self._get(key))[0]
+
+    def _get(self, key):
+        with self._lock:
+            self.fetches += 1
+        fetched = time.time()
+        whois = SIDNWhois(key, self._connection())
+        result = whois.result()
+        self._remember(key, fetched, result)
+        if self._store:
+            self._store.put(key, whois.response, fetched)
+        return result
+
+    def _refresh(self, key):
+        try:
+            self._fetch(key)
+        except Exception, why:
+            log.debug("refresh of %s failed: %r" % (key, why))
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _revalidate(self, key):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        t = threading.Thread(target=self._refresh, args=(key,))
+        t.daemon = True
+        t.start()
+
+    def _load(self, key):
+        """ (fetched, SIDNWhoisResult) from disk, if it may still be
+        served """
+        row = self._store.get(key)
+        if row is None or row[0] + self.ttl + self.stale < time.time():
+            return None
+        result = SIDNWhois(key, response=row[1]).result()
+        self._remember(key, row[0], result)
+        return row[0], result
+
+    def lookup(self, domain):
+        key = domain.lower()
+        entry = self._memory.get(key)
+        if entry is None and self._store:
+            entry = self._load(key)
+        if entry is None:
+            return self._fetch(key)
+        fetched, result = entry
+        if time.time() - fetched > self.ttl:
+            self._revalidate(key)
+        return result
+
+    def invalidate(self, domain):
+        key = domain.lower()
+        self._memory.invalidate(key)
+        if self._store:
+            self._store.delete(key)
+
+    def stats(self):
+        stats = self._memory.stats()
+        with self._lock:
+            stats.update(fetches=self.fetches,
+                         refreshing=len(self._refreshing))
+        stats.update(coalesced=self._flights.coalesced)
+        return stats
+
+    def close(self):
+        if self._store:
+            self._store.close()
 
 
 if __name__ == '__main__':